@@ -0,0 +1,469 @@
+"""MessageForwarder 吞吐/延迟基准测试
+
+用法（在插件目录下运行）:
+    python bench/benchmark.py --count 500 --kinds text,image,video,cdn_video,appmsg,card
+    python bench/benchmark.py --latency-ms 50 --error-rate 0.05 --json bench_result.json
+    python bench/benchmark.py --count 200 --record traces   # 同时录制轨迹，供 bench/replay.py 回放
+
+插件发往本地 FakeWechatServer（模拟 WechatAPI，可配置延迟和错误率），合成消息覆盖
+文本、Base64/CDN 图片、Base64/CDN 视频、应用消息 XML、文件、表情和名片。每类消息分别报告吞吐量、
+端到端 p50/p99 延迟（处理器收到消息到最后一个目标发送完成）、处理器返回耗时、
+事件循环延迟和峰值 RSS。
+
+在 XYBot 目录中运行时使用真实框架模块；单独运行时只为缺失的框架模块安装最小替身。
+"""
+import argparse
+import asyncio
+import base64
+import importlib.util
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+from typing import Dict, List, Optional
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PLUGIN_DIR.parent.parent))  # XYBot 根目录
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_wechat import FakeWechatAPIClient, FakeWechatServer  # noqa: E402
+
+ALL_KINDS = ("text", "image", "cdn_image", "video", "cdn_video", "appmsg", "file", "emoji", "card")
+
+
+def _install_framework_shims():
+    """框架模块不可用时（脱离 XYBot 运行）安装最小替身，仅供基准测试使用"""
+    try:
+        import utils.plugin_base  # noqa: F401
+        import utils.decorators  # noqa: F401
+        import WechatAPI  # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    class PluginBase:
+        description = ""
+        author = ""
+        version = "1.0.0"
+
+        def __init__(self):
+            self.enabled = False
+
+        async def on_enable(self, bot=None):
+            self.enabled = True
+
+        async def on_disable(self):
+            self.enabled = False
+
+    def handler_decorator(event_type):
+        def decorator(priority=50):
+            def wrapper(func):
+                func._event_type = event_type
+                func._priority = priority
+                return func
+            return wrapper
+        return decorator
+
+    utils = types.ModuleType("utils")
+    plugin_base = types.ModuleType("utils.plugin_base")
+    plugin_base.PluginBase = PluginBase
+    decorators = types.ModuleType("utils.decorators")
+    for name in ("text", "image", "video", "xml", "other"):
+        setattr(decorators, f"on_{name}_message", handler_decorator(name))
+    wechat_api = types.ModuleType("WechatAPI")
+    wechat_api.WechatAPIClient = FakeWechatAPIClient
+    utils.plugin_base = plugin_base
+    utils.decorators = decorators
+    sys.modules.update({
+        "utils": utils,
+        "utils.plugin_base": plugin_base,
+        "utils.decorators": decorators,
+        "WechatAPI": wechat_api,
+    })
+
+
+def _load_plugin_module():
+    _install_framework_shims()
+    spec = importlib.util.spec_from_file_location("message_forwarder_bench_main", PLUGIN_DIR / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    # 注册到 sys.modules，媒体进程池才能按模块名序列化任务函数
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _bench_config(args, targets: List[str], port: int) -> str:
+    """基准测试使用的 config.toml 内容"""
+    senders = "".join(
+        f"""
+[[sender_pool.senders]]
+name = "bench{index}"
+ip = "127.0.0.1"
+port = {port}
+wxid = "wxid_bench_sender{index}"
+"""
+        for index in range(args.senders)
+    )
+    return f"""
+[[routes]]
+targets = {json.dumps(targets)}
+
+[send_queue]
+enable = true
+workers = {args.workers}
+max_queue_size = {args.max_queue_size}
+
+[thumbnail]
+max_concurrency = {args.ffmpeg_concurrency}
+
+[media_cache]
+enable = {str(not args.no_media_cache).lower()}
+
+[media_pool]
+enable = {str(getattr(args, "media_pool", -1) >= 0).lower()}
+processes = {max(0, getattr(args, "media_pool", 0))}
+
+[outbox]
+enable = {str(args.outbox).lower()}
+db_path = "{(Path(args.workdir) / 'outbox.db').as_posix()}"
+
+[metrics]
+enable = true
+
+[hot_reload]
+enable = false
+
+[recorder]
+enable = {str(bool(getattr(args, "record", ""))).lower()}
+dir = {json.dumps(str(Path(getattr(args, "record", "") or "traces").resolve().as_posix()))}
+
+[attribution]
+enable = {str(getattr(args, "attribution", False)).lower()}
+media_header = {str(getattr(args, "attribution", False)).lower()}
+
+[sender_pool]
+enable = {str(args.senders > 0).lower()}
+include_primary = true
+health_check_interval = 0
+{senders}"""
+
+
+def _make_video(seconds: int = 3) -> bytes:
+    """用 ffmpeg 生成测试视频；ffmpeg 不可用时返回随机字节（缩略图会失败，但发送路径仍被测量）"""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "bench.mp4"
+            result = subprocess.run(
+                [ffmpeg, "-hide_banner", "-loglevel", "error", "-y", "-f", "lavfi",
+                 "-i", f"testsrc=duration={seconds}:size=640x360:rate=25", "-pix_fmt", "yuv420p", str(path)],
+                capture_output=True
+            )
+            if result.returncode == 0:
+                return path.read_bytes()
+    print("警告: 未找到 ffmpeg，视频使用随机数据", file=sys.stderr)
+    return os.urandom(256 * 1024)
+
+
+class MessageFactory:
+    """合成测试消息"""
+
+    APPMSG = (
+        '<?xml version="1.0"?>\n<msg><appmsg appid="" sdkver="0"><title>基准测试链接 {n}</title>'
+        '<des>描述 {n}</des><type>5</type><url>https://example.com/{n}</url></appmsg>'
+        '<fromusername>wxid_src</fromusername></msg>'
+    )
+    CDN_IMAGE = (
+        '<?xml version="1.0"?>\n<msg><img aeskey="{n:032x}" cdnmidimgurl="3057020100044b304902{n:08x}" '
+        'cdnthumburl="3057020100044b3049{n:08x}" length="{length}" md5="{n:032x}" /></msg>'
+    )
+    FILE = (
+        '<?xml version="1.0"?>\n<msg><appmsg appid="" sdkver="0"><title>报告{n}.pdf</title><type>6</type>'
+        '<appattach><totallen>{length}</totallen><fileext>pdf</fileext><cdnattachurl>3057020100{n:08x}</cdnattachurl>'
+        '<aeskey>{n:032x}</aeskey></appattach></appmsg><fromusername>wxid_src</fromusername></msg>'
+    )
+    EMOJI = '<msg><emoji fromusername="wxid_src" type="2" md5="{n:032x}" len="{length}" cdnurl="http://emoji.example.com/{n}" /></msg>'
+    CARD = '<?xml version="1.0"?>\n<msg bigheadimgurl="" smallheadimgurl="" username="wxid_card{n}" nickname="名片{n}" alias="alias{n}" />'
+    CDN_VIDEO = (
+        '<?xml version="1.0"?>\n<msg><videomsg aeskey="{n:032x}" cdnvideourl="3057020100044b304902{n:08x}" '
+        'cdnthumburl="3057020100044b3049{n:08x}" length="{length}" playlength="3" md5="{n:032x}" /></msg>'
+    )
+
+    def __init__(self, args):
+        self.args = args
+        self.image = base64.b64encode(os.urandom(args.image_kb * 1024)).decode()
+        self.video = _make_video() if "video" in args.kinds else b""
+        self.video_b64 = base64.b64encode(self.video).decode()
+        self._next_id = 0
+
+    def make(self, kind: str) -> dict:
+        self._next_id += 1
+        n = self._next_id
+        source = f"{n % self.args.sources}@chatroom"
+        message = {"MsgId": n, "FromWxid": source, "SenderWxid": f"wxid_user{n % 97}", "IsGroup": True}
+        if kind == "text":
+            message.update(MsgType=1, Content=f"基准测试文本消息 {n}")
+        elif kind == "image":
+            message.update(MsgType=3, Content=self.image)
+        elif kind == "cdn_image":
+            message.update(MsgType=3, Content=self.CDN_IMAGE.format(n=n, length=self.args.image_kb * 1024))
+        elif kind == "file":
+            message.update(MsgType=49, Content=f"wxid_user{n % 97}:\n" + self.FILE.format(n=n, length=1024 * 1024))
+        elif kind == "emoji":
+            message.update(MsgType=47, Content=f"wxid_user{n % 97}:\n" + self.EMOJI.format(n=n, length=20480))
+        elif kind == "video":
+            video_b64 = self.video_b64
+            if self.args.unique_media:
+                # 在文件尾追加随机字节，使每条视频的摘要不同，避免命中缩略图缓存
+                video_b64 = base64.b64encode(self.video + os.urandom(16)).decode()
+            message.update(MsgType=43, Video=video_b64)
+        elif kind == "cdn_video":
+            message.update(MsgType=43, Content=self.CDN_VIDEO.format(n=n, length=len(self.video) or 1024))
+        elif kind == "appmsg":
+            message.update(MsgType=49, Content=f"wxid_user{n % 97}:\n" + self.APPMSG.format(n=n))
+        elif kind == "card":
+            message.update(MsgType=42, Content=f"wxid_user{n % 97}:\n" + self.CARD.format(n=n))
+        else:
+            raise ValueError(f"未知的消息类型: {kind}")
+        return message
+
+
+class LoopMonitor:
+    """事件循环延迟与 RSS 采样"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags: List[float] = []
+        self.peak_rss = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def current_rss() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            # 非 Linux：退回进程历史峰值（Linux 上单位为 KB，macOS 为字节）
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+
+    def start(self):
+        self.lags = []
+        self.peak_rss = self.current_rss()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+            self.peak_rss = max(self.peak_rss, self.current_rss())
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _make_bench_plugin(module, config_path: Path):
+    """基于插件类创建基准测试子类：读取基准配置，并记录每条消息最后一次发送完成的时间"""
+
+    class BenchForwarder(module.MessageForwarder):
+        _config_path = staticmethod(lambda: str(config_path))
+
+        def __init__(self):
+            self.bench_done: Dict[int, float] = {}
+            self.bench_results: Dict[str, int] = {"ok": 0, "error": 0}
+            super().__init__()
+
+        def _record(self, message: dict, ok: bool):
+            self.bench_done[message.get("MsgId")] = time.perf_counter()
+            self.bench_results["ok" if ok else "error"] += 1
+
+        async def _send_once(self, message, *args, **kwargs):
+            ok = await super()._send_once(message, *args, **kwargs)
+            self._record(message, ok)
+            return ok
+
+        async def _send_forward(self, message, *args, **kwargs):
+            ok = await super()._send_forward(message, *args, **kwargs)
+            self._record(message, ok)
+            return ok
+
+    return BenchForwarder()
+
+
+HANDLERS = {
+    "text": "handle_text_message",
+    "image": "handle_image_message",
+    "cdn_image": "handle_image_message",
+    "video": "handle_video_message",
+    "cdn_video": "handle_video_message",
+    "appmsg": "handle_xml_message",
+    "file": "handle_xml_message",
+    "emoji": "handle_other_message",
+    "card": "handle_other_message",
+}
+
+
+async def _run_kind(plugin, bot, factory: MessageFactory, kind: str, args) -> dict:
+    handler = getattr(plugin, HANDLERS[kind])
+    messages = [factory.make(kind) for _ in range(args.count)]
+    started: Dict[int, float] = {}
+    handler_times: List[float] = []
+    plugin.bench_done.clear()
+    plugin.bench_results.update(ok=0, error=0)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(message):
+        async with semaphore:
+            started[message["MsgId"]] = t0 = time.perf_counter()
+            await handler(bot, message)
+            handler_times.append(time.perf_counter() - t0)
+
+    dispatcher = plugin.dispatcher
+    shed_before = sum(c.shed for c in dispatcher.classes) if dispatcher else 0
+    degraded_before = sum(c.degraded for c in dispatcher.classes) if dispatcher else 0
+    monitor = LoopMonitor()
+    monitor.start()
+    begin = time.perf_counter()
+    await asyncio.gather(*(feed(message) for message in messages))
+    deadline = time.perf_counter() + args.timeout
+    while len(plugin.bench_done) < len(messages) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    # 等待剩余目标发送完成（多目标时最后一个目标决定完成时间）
+    while plugin.dispatcher is not None and not plugin.dispatcher.idle() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - begin
+    await monitor.stop()
+
+    # 被丢弃的消息不会完成，等待到超时；被降级的消息以降级发送的完成时间计
+    latencies = [plugin.bench_done[msg_id] - started[msg_id] for msg_id in plugin.bench_done if msg_id in started]
+    return {
+        "kind": kind,
+        "messages": len(messages),
+        "completed": len(latencies),
+        "sends_ok": plugin.bench_results["ok"],
+        "sends_failed": plugin.bench_results["error"],
+        "shed": (sum(c.shed for c in dispatcher.classes) - shed_before) if dispatcher else 0,
+        "degraded": (sum(c.degraded for c in dispatcher.classes) - degraded_before) if dispatcher else 0,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_msg_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+        "latency_p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+        "handler_p50_ms": round(_percentile(handler_times, 0.5) * 1000, 3),
+        "handler_p99_ms": round(_percentile(handler_times, 0.99) * 1000, 3),
+        "loop_lag_p99_ms": round(_percentile(monitor.lags, 0.99) * 1000, 2),
+        "loop_lag_max_ms": round(max(monitor.lags, default=0.0) * 1000, 2),
+        "peak_rss_mb": round(monitor.peak_rss / 1024 / 1024, 1),
+    }
+
+
+def _print_table(results: List[dict]):
+    columns = ("kind", "completed", "throughput_msg_s", "latency_p50_ms", "latency_p99_ms",
+               "handler_p99_ms", "loop_lag_p99_ms", "loop_lag_max_ms", "peak_rss_mb", "sends_failed", "shed", "degraded")
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+async def run(args) -> dict:
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    server = FakeWechatServer(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    port = await server.start()
+    bot = FakeWechatAPIClient(port=port)
+
+    module = _load_plugin_module()
+    config_path = Path(args.workdir) / "config.toml"
+    config_path.write_text(_bench_config(args, [f"wxid_target{i}" for i in range(args.targets)], port), encoding="utf-8")
+    plugin = _make_bench_plugin(module, config_path)
+    await plugin.on_enable(bot)
+
+    factory = MessageFactory(args)
+    results = []
+    try:
+        for kind in args.kinds:
+            results.append(await _run_kind(plugin, bot, factory, kind, args))
+    finally:
+        await plugin.on_disable()
+        await bot.close()
+        await server.stop()
+
+    _print_table(results)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "workdir"},
+        "results": results,
+        "server": server.stats(),
+        "forward_modes": dict(plugin.forward_mode_counts),
+        "plugin_metrics": plugin.metrics.snapshot(),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="MessageForwarder 吞吐/延迟基准测试")
+    parser.add_argument("--kinds", default=",".join(ALL_KINDS), help=f"逗号分隔的消息类型，可选: {','.join(ALL_KINDS)}")
+    parser.add_argument("--count", type=int, default=500, help="每类消息的数量")
+    parser.add_argument("--concurrency", type=int, default=50, help="同时调用处理器的消息数")
+    parser.add_argument("--sources", type=int, default=20, help="来源会话数量（影响出站队列分片）")
+    parser.add_argument("--targets", type=int, default=1, help="每条消息的转发目标数量")
+    parser.add_argument("--senders", type=int, default=0, help="额外的发送账号数量（多账号发送，均指向模拟服务端）")
+    parser.add_argument("--workers", type=int, default=4, help="出站队列 worker 数量")
+    parser.add_argument("--max-queue-size", type=int, default=500, help="出站队列单队列上限")
+    parser.add_argument("--ffmpeg-concurrency", type=int, default=2, help="缩略图 ffmpeg 并发上限")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="模拟服务端的平均响应延迟")
+    parser.add_argument("--jitter-ms", type=float, default=5.0, help="模拟服务端的延迟抖动")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟服务端返回失败的概率")
+    parser.add_argument("--image-kb", type=int, default=64, help="合成图片大小 (KB)")
+    parser.add_argument("--unique-media", action="store_true", help="每条视频内容不同，不命中缩略图缓存")
+    parser.add_argument("--no-media-cache", action="store_true", help="关闭媒体缓存")
+    parser.add_argument("--media-pool", type=int, default=-1, help="媒体进程池进程数（0 表示 CPU 核数，-1 表示不启用）")
+    parser.add_argument("--outbox", action="store_true", help="启用持久化发件箱")
+    parser.add_argument("--attribution", action="store_true", help="启用来源标注（名称经模拟服务端的联系人/群成员接口解析）")
+    parser.add_argument("--record", default="", help="把合成消息录制到该轨迹目录（供 bench/replay.py 回放）")
+    parser.add_argument("--timeout", type=float, default=120.0, help="每类消息等待发送完成的最长秒数")
+    parser.add_argument("--seed", type=int, default=None, help="模拟错误的随机种子")
+    parser.add_argument("--log-level", default="WARNING", help="插件日志级别")
+    parser.add_argument("--json", dest="json_path", default="", help="把结果写入 JSON 文件")
+    args = parser.parse_args(argv)
+    args.kinds = [kind.strip() for kind in args.kinds.split(",") if kind.strip()]
+    unknown = set(args.kinds) - set(ALL_KINDS)
+    if unknown:
+        parser.error(f"未知的消息类型: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="message_forwarder_bench_") as workdir:
+        args.workdir = workdir
+        report = asyncio.run(run(args))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
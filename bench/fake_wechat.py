@@ -0,0 +1,196 @@
+"""本地 WechatAPI 替身：aiohttp 模拟服务端 + 通过 HTTP 调用它的假 WechatAPIClient
+
+服务端模拟 /api/Msg/ShareCard、各发送接口及联系人/群成员查询接口，可配置响应延迟、抖动与错误率，
+返回格式与 WechatAPI 一致（{"Success": bool, "Message": str, "Data": ...}）。
+"""
+import asyncio
+import random
+import time
+from typing import Dict, List, Optional, Union
+
+import aiohttp
+from aiohttp import web
+
+# 假客户端发送方法 -> 模拟服务端路径
+ACTION_PATHS = {
+    "send_text_message": "/api/Msg/SendTxt",
+    "send_image_message": "/api/Msg/UploadImg",
+    "send_video_message": "/api/Msg/SendVideo",
+    "send_app_message": "/api/Msg/SendApp",
+    "send_cdn_video_msg": "/api/Msg/SendCDNVideo",
+    "send_cdn_img_msg": "/api/Msg/SendCDNImg",
+    "send_cdn_file_msg": "/api/Msg/SendCDNFile",
+    "send_emoji_message": "/api/Msg/SendEmoji",
+}
+SHARE_CARD_PATH = "/api/Msg/ShareCard"
+# 名称查询接口（来源标注的名称解析缓存使用）
+CONTACT_PATH = "/api/Friend/GetContact"
+MEMBERS_PATH = "/api/Group/GetChatRoomMemberDetail"
+
+
+class FakeWechatServer:
+    """模拟 WechatAPI 服务端
+
+    latency/jitter 单位为秒；error_rate 为返回 Success=false 的概率。
+    联系人查询返回 "昵称_<wxid>"，每个群返回 members 个成员 (wxid_user0 起)。
+    按路径统计请求数、失败数与请求体字节数。
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.02,
+                 jitter: float = 0.005, error_rate: float = 0.0, seed: Optional[int] = None, members: int = 100):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.members = members
+        self._random = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+        self.requests: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.bytes_in = 0
+
+    async def start(self) -> int:
+        """启动服务端，返回实际监听端口"""
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        for path in list(ACTION_PATHS.values()) + [SHARE_CARD_PATH]:
+            app.router.add_post(path, self._handle)
+        app.router.add_post(CONTACT_PATH, self._handle_contact)
+        app.router.add_post(MEMBERS_PATH, self._handle_members)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _simulate(self, request: web.Request) -> Optional[web.Response]:
+        """统计请求并模拟延迟；模拟失败时返回错误响应"""
+        body = await request.read()
+        path = request.path
+        self.bytes_in += len(body)
+        self.requests[path] = self.requests.get(path, 0) + 1
+        delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+        if delay:
+            await asyncio.sleep(delay)
+        if self._random.random() < self.error_rate:
+            self.errors[path] = self.errors.get(path, 0) + 1
+            return web.json_response({"Success": False, "Message": "模拟错误", "Data": None})
+        return None
+
+    async def _handle_contact(self, request: web.Request) -> web.Response:
+        error = await self._simulate(request)
+        if error is not None:
+            return error
+        wxids = [wxid for wxid in (await request.json()).get("RequestWxids", "").split(",") if wxid]
+        return web.json_response({
+            "Success": True,
+            "Message": "",
+            "Data": {"ContactList": [{"UserName": {"string": wxid}, "NickName": {"string": f"昵称_{wxid}"}} for wxid in wxids]},
+        })
+
+    async def _handle_members(self, request: web.Request) -> web.Response:
+        error = await self._simulate(request)
+        if error is not None:
+            return error
+        chatroom = (await request.json()).get("Chatroom", "")
+        members = [
+            {"UserName": f"wxid_user{i}", "NickName": f"昵称_wxid_user{i}", "DisplayName": f"群昵称{i}" if i % 2 else ""}
+            for i in range(self.members)
+        ]
+        return web.json_response({
+            "Success": True,
+            "Message": "",
+            "Data": {"NewChatroomData": {"ChatRoomName": chatroom, "ChatRoomMember": members}},
+        })
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        error = await self._simulate(request)
+        if error is not None:
+            return error
+        path = request.path
+        return web.json_response({
+            "Success": True,
+            "Message": "",
+            "Data": {"ClientMsgid": self.requests[path], "CreateTime": int(time.time()), "NewMsgId": self.requests[path]},
+        })
+
+    def stats(self) -> dict:
+        return {
+            "requests": dict(self.requests),
+            "errors": dict(self.errors),
+            "bytes_in": self.bytes_in,
+        }
+
+
+class FakeWechatAPIClient:
+    """通过 HTTP 调用 FakeWechatServer 的假 WechatAPIClient
+
+    发送方法的参数与 WechatAPIClient 相同，失败时同样抛出异常，
+    因此插件的发送、重试与发件箱逻辑与真实环境一致地运行。
+    """
+
+    def __init__(self, ip: str = "127.0.0.1", port: int = 9000, wxid: str = "wxid_bench_bot"):
+        self.ip = ip
+        self.port = port
+        self.wxid = wxid
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.calls: Dict[str, int] = {}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, action: str, path: str, payload: dict) -> dict:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        self.calls[action] = self.calls.get(action, 0) + 1
+        async with self._session.post(f"http://{self.ip}:{self.port}{path}", json=payload) as response:
+            json_resp = await response.json(content_type=None)
+        if not json_resp.get("Success"):
+            raise Exception(f"{action} 调用失败: {json_resp.get('Message')}")
+        return json_resp.get("Data") or {}
+
+    async def _post(self, action: str, payload: dict) -> dict:
+        data = await self._request(action, ACTION_PATHS[action], payload)
+        return data.get("ClientMsgid"), data.get("CreateTime"), data.get("NewMsgId")
+
+    async def get_nickname(self, wxid: Union[str, List[str]]) -> Union[str, List[str]]:
+        wxids = [wxid] if isinstance(wxid, str) else list(wxid)
+        data = await self._request("get_nickname", CONTACT_PATH, {"Wxid": self.wxid, "RequestWxids": ",".join(wxids)})
+        names = [item.get("NickName", {}).get("string", "") for item in data.get("ContactList", [])]
+        return names[0] if isinstance(wxid, str) else names
+
+    async def get_chatroom_member_list(self, chatroom: str) -> List[dict]:
+        data = await self._request("get_chatroom_member_list", MEMBERS_PATH, {"Wxid": self.wxid, "Chatroom": chatroom})
+        return data.get("NewChatroomData", {}).get("ChatRoomMember", [])
+
+    async def send_text_message(self, wxid: str, content: str, at=None):
+        return await self._post("send_text_message", {"Wxid": self.wxid, "ToWxid": wxid, "Content": content})
+
+    async def send_image_message(self, wxid: str, image):
+        return await self._post("send_image_message", {"Wxid": self.wxid, "ToWxid": wxid, "Base64": image})
+
+    async def send_video_message(self, wxid: str, video, image=None):
+        return await self._post("send_video_message", {"Wxid": self.wxid, "ToWxid": wxid, "Base64": video, "ImageBase64": image})
+
+    async def send_app_message(self, wxid: str, xml: str, type: int):
+        return await self._post("send_app_message", {"Wxid": self.wxid, "ToWxid": wxid, "Xml": xml, "Type": type})
+
+    async def send_cdn_video_msg(self, wxid: str, xml: str):
+        return await self._post("send_cdn_video_msg", {"Wxid": self.wxid, "ToWxid": wxid, "Content": xml})
+
+    async def send_cdn_img_msg(self, wxid: str, xml: str):
+        return await self._post("send_cdn_img_msg", {"Wxid": self.wxid, "ToWxid": wxid, "Content": xml})
+
+    async def send_cdn_file_msg(self, wxid: str, xml: str):
+        return await self._post("send_cdn_file_msg", {"Wxid": self.wxid, "ToWxid": wxid, "Content": xml})
+
+    async def send_emoji_message(self, wxid: str, md5: str, total_length: int):
+        return await self._post("send_emoji_message", {"Wxid": self.wxid, "ToWxid": wxid, "Md5": md5, "TotalLen": total_length})
@@ -0,0 +1,241 @@
+"""按录制的流量轨迹回放，测量各处理器的吞吐与延迟
+
+用法（在插件目录下运行）:
+    python bench/replay.py traces                   # 按原始时间间隔回放 (1x)
+    python bench/replay.py traces --speed 10        # 10 倍速
+    python bench/replay.py traces --speed 0         # 尽可能快
+    python bench/replay.py traces --speed 10 --max-gap 5 --json replay_result.json
+
+轨迹由插件的 [recorder] 录制（trace.jsonl + media/）。回放时插件发往本地 FakeWechatServer，
+所有来源都路由到 --targets 个模拟目标；每条消息重新编号 MsgId（去掉 NewMsgId），
+以便统计端到端延迟。按处理器报告吞吐量、处理器返回耗时与端到端 p50/p99 延迟。
+"""
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from benchmark import (  # noqa: E402
+    LoopMonitor,
+    _bench_config,
+    _load_plugin_module,
+    _make_bench_plugin,
+    _percentile,
+)
+from fake_wechat import FakeWechatAPIClient, FakeWechatServer  # noqa: E402
+
+HANDLERS = ("text", "image", "video", "xml", "other")
+
+
+def load_trace(module, trace_dir: Path, limit: int = 0) -> List[tuple]:
+    """读取轨迹并重新编号，返回 [(相对时间, 处理器, 消息)]（媒体在回放前全部载入内存）"""
+    records = []
+    start = None
+    for received_at, handler, message in module.TrafficRecorder.read(trace_dir):
+        if handler not in HANDLERS:
+            continue
+        if start is None:
+            start = received_at
+        message.pop("NewMsgId", None)
+        message["MsgId"] = len(records) + 1
+        records.append((received_at - start, handler, message))
+        if limit and len(records) >= limit:
+            break
+    return records
+
+
+def _schedule(records: List[tuple], speed: float, max_gap: float) -> List[float]:
+    """计算每条消息的回放时间偏移：按倍速缩放，空闲间隔最长压缩到 max_gap 秒（缩放前）"""
+    offsets = []
+    offset = 0.0
+    previous = None
+    for at, _, _ in records:
+        if previous is not None:
+            gap = max(0.0, at - previous)
+            if max_gap > 0:
+                gap = min(gap, max_gap)
+            offset += gap / speed
+        previous = at
+        offsets.append(offset)
+    return offsets
+
+
+async def _replay(plugin, bot, records: List[tuple], args) -> List[dict]:
+    started: Dict[int, float] = {}
+    handler_of: Dict[int, str] = {}
+    handler_times: Dict[str, List[float]] = {handler: [] for handler in HANDLERS}
+    plugin.bench_done.clear()
+    plugin.bench_results.update(ok=0, error=0)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(handler_name: str, message: dict):
+        handler = getattr(plugin, f"handle_{handler_name}_message")
+        msg_id = message["MsgId"]
+        handler_of[msg_id] = handler_name
+        started[msg_id] = t0 = time.perf_counter()
+        try:
+            await handler(bot, message)
+        except Exception as e:
+            print(f"处理器 {handler_name} 抛出异常: {e}", file=sys.stderr)
+        handler_times[handler_name].append(time.perf_counter() - t0)
+
+    async def feed_limited(handler_name: str, message: dict):
+        async with semaphore:
+            await feed(handler_name, message)
+
+    monitor = LoopMonitor()
+    monitor.start()
+    begin = time.perf_counter()
+    if args.speed <= 0:
+        await asyncio.gather(*(feed_limited(handler, message) for _, handler, message in records))
+    else:
+        tasks = []
+        for offset, (_, handler, message) in zip(_schedule(records, args.speed, args.max_gap), records):
+            delay = begin + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(feed(handler, message)))
+        await asyncio.gather(*tasks)
+    feed_elapsed = time.perf_counter() - begin
+
+    # 等待出站队列排空且在途任务全部完成（未路由、被过滤或被丢弃的消息不会完成）
+    deadline = time.perf_counter() + args.timeout
+    await asyncio.sleep(0.05)
+    while plugin.dispatcher is not None and not plugin.dispatcher.idle() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - begin
+    await monitor.stop()
+
+    results = []
+    for handler in HANDLERS:
+        ids = [msg_id for msg_id, name in handler_of.items() if name == handler]
+        if not ids:
+            continue
+        latencies = [plugin.bench_done[msg_id] - started[msg_id] for msg_id in ids if msg_id in plugin.bench_done]
+        first = min(started[msg_id] for msg_id in ids)
+        last = max([plugin.bench_done[msg_id] for msg_id in ids if msg_id in plugin.bench_done] or [first])
+        span = last - first
+        results.append({
+            "handler": handler,
+            "messages": len(ids),
+            "completed": len(latencies),
+            "throughput_msg_s": round(len(latencies) / span, 1) if span > 0 else 0.0,
+            "handler_p50_ms": round(_percentile(handler_times[handler], 0.5) * 1000, 3),
+            "handler_p99_ms": round(_percentile(handler_times[handler], 0.99) * 1000, 3),
+            "latency_p50_ms": round(_percentile(latencies, 0.5) * 1000, 2),
+            "latency_p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+        })
+    results.append({
+        "handler": "all",
+        "messages": len(records),
+        "completed": len(plugin.bench_done),
+        "throughput_msg_s": round(len(plugin.bench_done) / elapsed, 1) if elapsed else 0.0,
+        "handler_p50_ms": round(_percentile(sum(handler_times.values(), []), 0.5) * 1000, 3),
+        "handler_p99_ms": round(_percentile(sum(handler_times.values(), []), 0.99) * 1000, 3),
+        "latency_p50_ms": "",
+        "latency_p99_ms": "",
+        "feed_s": round(feed_elapsed, 3),
+        "elapsed_s": round(elapsed, 3),
+        "loop_lag_p99_ms": round(_percentile(monitor.lags, 0.99) * 1000, 2),
+        "peak_rss_mb": round(monitor.peak_rss / 1024 / 1024, 1),
+    })
+    return results
+
+
+def _print_table(results: List[dict]):
+    columns = ("handler", "messages", "completed", "throughput_msg_s", "handler_p50_ms", "handler_p99_ms",
+               "latency_p50_ms", "latency_p99_ms")
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+    total = results[-1]
+    print(f"回放耗时 {total['feed_s']}s，总耗时 {total['elapsed_s']}s，事件循环延迟 p99 {total['loop_lag_p99_ms']}ms，"
+          f"峰值 RSS {total['peak_rss_mb']}MB")
+
+
+async def run(args) -> dict:
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    module = _load_plugin_module()
+    records = load_trace(module, Path(args.trace), args.limit)
+    if not records:
+        raise SystemExit(f"轨迹为空: {args.trace}")
+    print(f"已载入 {len(records)} 条消息，原始时长 {records[-1][0]:.1f}s")
+
+    server = FakeWechatServer(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    port = await server.start()
+    bot = FakeWechatAPIClient(port=port)
+    config_path = Path(args.workdir) / "config.toml"
+    config_path.write_text(_bench_config(args, [f"wxid_target{i}" for i in range(args.targets)], port), encoding="utf-8")
+    plugin = _make_bench_plugin(module, config_path)
+    await plugin.on_enable(bot)
+    try:
+        results = await _replay(plugin, bot, records, args)
+    finally:
+        await plugin.on_disable()
+        await bot.close()
+        await server.stop()
+
+    _print_table(results)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "workdir"},
+        "results": results,
+        "server": server.stats(),
+        "forward_modes": dict(plugin.forward_mode_counts),
+        "plugin_metrics": plugin.metrics.snapshot(),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="MessageForwarder 流量轨迹回放")
+    parser.add_argument("trace", help="轨迹目录（包含 trace.jsonl 与 media/）")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，0 表示尽可能快")
+    parser.add_argument("--max-gap", type=float, default=0.0, help="压缩超过该秒数的空闲间隔，0 表示不压缩")
+    parser.add_argument("--limit", type=int, default=0, help="最多回放的消息数，0 表示全部")
+    parser.add_argument("--concurrency", type=int, default=50, help="尽可能快模式下同时调用处理器的消息数")
+    parser.add_argument("--targets", type=int, default=1, help="每条消息的转发目标数量")
+    parser.add_argument("--senders", type=int, default=0, help="额外的发送账号数量")
+    parser.add_argument("--workers", type=int, default=4, help="出站队列 worker 数量")
+    parser.add_argument("--max-queue-size", type=int, default=500, help="出站队列单队列上限")
+    parser.add_argument("--ffmpeg-concurrency", type=int, default=2, help="缩略图 ffmpeg 并发上限")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="模拟服务端的平均响应延迟")
+    parser.add_argument("--jitter-ms", type=float, default=5.0, help="模拟服务端的延迟抖动")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟服务端返回失败的概率")
+    parser.add_argument("--no-media-cache", action="store_true", help="关闭媒体缓存")
+    parser.add_argument("--media-pool", type=int, default=-1, help="媒体进程池进程数（0 表示 CPU 核数，-1 表示不启用）")
+    parser.add_argument("--outbox", action="store_true", help="启用持久化发件箱")
+    parser.add_argument("--attribution", action="store_true", help="启用来源标注（名称经模拟服务端的联系人/群成员接口解析）")
+    parser.add_argument("--timeout", type=float, default=120.0, help="回放结束后等待发送完成的最长秒数")
+    parser.add_argument("--seed", type=int, default=None, help="模拟错误的随机种子")
+    parser.add_argument("--log-level", default="WARNING", help="插件日志级别")
+    parser.add_argument("--json", dest="json_path", default="", help="把结果写入 JSON 文件")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="message_forwarder_replay_") as workdir:
+        args.workdir = workdir
+        report = asyncio.run(run(args))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
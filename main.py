@@ -8,12 +8,32 @@ import xml.etree.ElementTree as ET # 导入 XML 解析库
 import shutil # 新增导入 shutil 用于文件操作
 import asyncio # 新增导入 asyncio 用于异步操作
 import time # 新增导入 time 用于时间戳
-from typing import Optional # 新增导入 Optional
+from typing import Optional, List, Tuple, Dict # 新增导入 Optional
 import json # 新增导入 json 用于解析 ffprobe 输出
 import aiohttp # 新增导入 aiohttp 用于直接API调用
+import aiohttp.web # 指标 HTTP 端点
+import zlib # 用于出站队列的会话分片哈希
+import uuid # 用于生成不冲突的临时文件名
+import hashlib # 用于媒体内容摘要
+from collections import OrderedDict, deque
+import functools
+import contextvars # 来源标注文本随转发任务传递
+import sqlite3 # 发件箱持久化
+import random # 重试退避抖动
+import bisect # 直方图分桶
+import io
+import subprocess # 媒体进程池中同步运行 ffmpeg
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from loguru import logger
 
+try:
+    from PIL import Image as PILImage # 可选依赖：图片缩放与重新压缩
+except ImportError:
+    PILImage = None
+
 from utils.plugin_base import PluginBase
 from WechatAPI import WechatAPIClient
 from utils.decorators import (
@@ -25,10 +45,2744 @@ from utils.decorators import (
 )
 
 
+class Metrics:
+    """进程内指标注册表：计数器、直方图与采集回调
+
+    热路径上只做字典累加和一次二分查找分桶；各组件的 stats() 通过采集回调在导出时读取，
+    不增加热路径开销。支持导出为 Prometheus 文本格式或 JSON 快照。
+    """
+
+    # 延迟直方图分桶（秒）
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, prefix: str = "message_forwarder", enabled: bool = True, buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._counters: Dict[tuple, float] = {}
+        self._histograms: Dict[tuple, list] = {}
+        self._collectors = []
+
+    @staticmethod
+    def _label_key(labels: dict) -> tuple:
+        # 标签值统一转为字符串：导出时按标签排序，None 与整数等混合类型无法比较
+        return tuple((key, str(value)) for key, value in labels.items())
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, self._label_key(labels))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, self._label_key(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            # 各分桶计数 + 溢出桶，末尾两项为总和与次数
+            histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    def add_collector(self, name: str, stats_func):
+        """注册采集回调：导出时调用 stats_func()，把返回字典中的数值导出为 gauge"""
+        self._collectors.append((name, stats_func))
+
+    def remove_collectors(self):
+        self._collectors = []
+
+    def _collect(self) -> List[tuple]:
+        gauges = []
+        for component, stats_func in self._collectors:
+            try:
+                stats = stats_func()
+            except Exception as e:
+                logger.warning(f"[MessageForwarder] 采集 {component} 指标失败: {e}")
+                continue
+            for key, value in (stats or {}).items():
+                if isinstance(value, dict):
+                    for sub_key, sub_value in value.items():
+                        if isinstance(sub_value, (int, float)):
+                            gauges.append((f"{component}_{key}", (("key", str(sub_key)),), sub_value))
+                elif isinstance(value, (int, float)):
+                    gauges.append((f"{component}_{key}", (), value))
+        return gauges
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        items = labels + extra
+        if not items:
+            return ""
+        body = ",".join(
+            '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for key, value in items
+        )
+        return "{" + body + "}"
+
+    def render_prometheus(self) -> str:
+        """导出 Prometheus 文本格式"""
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self._counters.items()):
+            metric = f"{self.prefix}_{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{self._format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            metric = f"{self.prefix}_{name}_seconds"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram):
+                cumulative += count
+                lines.append(f"{metric}_bucket{self._format_labels(labels, (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{metric}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {histogram[-1]}")
+            lines.append(f"{metric}_sum{self._format_labels(labels)} {histogram[-2]}")
+            lines.append(f"{metric}_count{self._format_labels(labels)} {histogram[-1]}")
+        for name, labels, value in self._collect():
+            metric = f"{self.prefix}_{name}"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _quantile(self, histogram: list, q: float) -> Optional[float]:
+        """按分桶估算分位数（取所在桶的上界）"""
+        total = histogram[-1]
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets, histogram):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        """导出 JSON 友好的快照"""
+        def label_str(labels):
+            return ",".join(f"{k}={v}" for k, v in labels)
+        return {
+            "timestamp": time.time(),
+            "counters": {f"{name}{{{label_str(labels)}}}": value for (name, labels), value in self._counters.items()},
+            "histograms": {
+                f"{name}{{{label_str(labels)}}}": {
+                    "count": histogram[-1],
+                    "sum": round(histogram[-2], 6),
+                    "p50": self._quantile(histogram, 0.5),
+                    "p99": self._quantile(histogram, 0.99),
+                }
+                for (name, labels), histogram in self._histograms.items()
+            },
+            "gauges": {f"{name}{{{label_str(labels)}}}": value for name, labels, value in self._collect()},
+        }
+
+
+# 路由规则中可使用的消息类型别名
+MSG_TYPE_ALIASES = {
+    "text": 1,
+    "image": 3,
+    "voice": 34,
+    "card": 42,
+    "video": 43,
+    "emoji": 47,
+    "app": 49,
+}
+
+# 当前转发任务待发送的来源标注：{"header": 标注文本, "sent": 已发送标注的目标}
+_pending_attribution: contextvars.ContextVar = contextvars.ContextVar("message_forwarder_attribution", default=None)
+
+
+class ForwardRoute:
+    """一条编译后的转发规则（不可变）"""
+
+    __slots__ = ("group_wxids", "user_wxids", "msg_types", "targets")
+
+    def __init__(self, group_wxids: frozenset, user_wxids: frozenset, msg_types: Optional[frozenset], targets: Tuple[str, ...]):
+        self.group_wxids = group_wxids
+        self.user_wxids = user_wxids
+        self.msg_types = msg_types
+        self.targets = targets
+
+    def matches(self, from_wxid: str, sender_wxid: str, msg_type) -> bool:
+        if self.msg_types is not None and msg_type not in self.msg_types:
+            return False
+        if self.group_wxids and from_wxid not in self.group_wxids:
+            return False
+        if self.user_wxids and from_wxid not in self.user_wxids and sender_wxid not in self.user_wxids:
+            return False
+        return True
+
+
+class RoutingTable:
+    """编译后的多对多路由表
+
+    加载配置时把每条规则编译为 frozenset，并按来源建立哈希索引：
+    指定了群聊的规则按 FromWxid 索引，只指定了用户的规则按用户 wxid 索引（同时匹配 FromWxid 与 SenderWxid），
+    其余为通配规则。每条消息只需几次字典查找即可得到候选规则，与配置的来源数量无关。
+    """
+
+    # 解析结果缓存上限，超过后整体清空
+    RESOLVE_CACHE_SIZE = 4096
+
+    def __init__(self, routes: List[ForwardRoute]):
+        self.routes = tuple(routes)
+        by_group: Dict[str, list] = {}
+        by_user: Dict[str, list] = {}
+        wildcard = []
+        for route in self.routes:
+            if route.group_wxids:
+                for wxid in route.group_wxids:
+                    by_group.setdefault(wxid, []).append(route)
+            elif route.user_wxids:
+                for wxid in route.user_wxids:
+                    by_user.setdefault(wxid, []).append(route)
+            else:
+                wildcard.append(route)
+        self._by_group = {wxid: tuple(routes) for wxid, routes in by_group.items()}
+        self._by_user = {wxid: tuple(routes) for wxid, routes in by_user.items()}
+        self._wildcard = tuple(wildcard)
+        self._cache: Dict[tuple, Tuple[str, ...]] = {}
+
+    @staticmethod
+    def _parse_msg_types(values) -> Optional[frozenset]:
+        if not values:
+            return None
+        msg_types = set()
+        for value in values:
+            if isinstance(value, str) and not value.isdigit():
+                if value.lower() not in MSG_TYPE_ALIASES:
+                    raise ValueError(f"未知的消息类型: {value}")
+                msg_types.add(MSG_TYPE_ALIASES[value.lower()])
+            else:
+                msg_types.add(int(value))
+        return frozenset(msg_types)
+
+    @classmethod
+    def from_config(cls, config: dict) -> "RoutingTable":
+        """从配置编译路由表；未配置 [[routes]] 时由旧的 [forwarder]/[listen_source] 生成单条规则"""
+        routes = []
+        for index, route_config in enumerate(config.get("routes", [])):
+            targets = route_config.get("targets", [])
+            if isinstance(targets, str):
+                targets = [targets]
+            targets = tuple(dict.fromkeys(t for t in targets if t))
+            if not targets:
+                raise ValueError(f"第 {index + 1} 条路由规则未配置 targets")
+            routes.append(ForwardRoute(
+                frozenset(route_config.get("group_wxids", [])),
+                frozenset(route_config.get("user_wxids", [])),
+                cls._parse_msg_types(route_config.get("msg_types", [])),
+                targets
+            ))
+        if routes:
+            return cls(routes)
+
+        forwarder_config = config.get("forwarder", {})
+        target_type = forwarder_config.get("target_type", "user")
+        target_wxid = forwarder_config.get("target_group_wxid" if target_type == "group" else "target_user_wxid")
+        if not target_wxid:
+            return cls([])
+        listen_source_config = config.get("listen_source", {})
+        listen_type = listen_source_config.get("listen_type", "all")
+        if listen_type == "all":
+            return cls([ForwardRoute(frozenset(), frozenset(), None, (target_wxid,))])
+        if listen_type == "user":
+            user_wxids = frozenset(listen_source_config.get("listen_user_wxids", []))
+            return cls([ForwardRoute(frozenset(), user_wxids, None, (target_wxid,))] if user_wxids else [])
+        if listen_type == "group":
+            group_wxids = frozenset(listen_source_config.get("listen_group_wxids", []))
+            return cls([ForwardRoute(group_wxids, frozenset(), None, (target_wxid,))] if group_wxids else [])
+        logger.warning(f"未知监听类型: {listen_type}，不转发任何消息。")
+        return cls([])
+
+    def resolve(self, from_wxid: str, sender_wxid: str, msg_type) -> Tuple[str, ...]:
+        """返回消息应转发到的目标列表（去重且保持配置顺序）"""
+        key = (from_wxid, sender_wxid, msg_type)
+        targets = self._cache.get(key)
+        if targets is not None:
+            return targets
+        candidates = self._by_group.get(from_wxid, ()) + self._by_user.get(from_wxid, ())
+        if sender_wxid and sender_wxid != from_wxid:
+            candidates += self._by_user.get(sender_wxid, ())
+        candidates += self._wildcard
+        result = {}
+        for route in candidates:
+            if route.matches(from_wxid, sender_wxid, msg_type):
+                for target in route.targets:
+                    result[target] = None
+        targets = tuple(result)
+        if len(self._cache) >= self.RESOLVE_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[key] = targets
+        return targets
+
+    def __len__(self) -> int:
+        return len(self.routes)
+
+
+class KeywordAutomaton:
+    """Aho-Corasick 多模式关键字匹配器
+
+    构建时把所有关键字插入字典树并用 BFS 计算失败指针，匹配时每个字符只做常数次（均摊）跳转，
+    耗时与文本长度成正比，与关键字数量无关。
+    """
+
+    def __init__(self, keywords, ignore_case: bool = True):
+        self.ignore_case = ignore_case
+        self.keywords: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # 以该状态结尾（含经失败指针可达）的关键字下标，没有时为 -1
+        self._output: List[int] = [-1]
+        for keyword in dict.fromkeys(k for k in keywords if k):
+            self._add(keyword.casefold() if ignore_case else keyword)
+        self._build()
+
+    def _add(self, keyword: str):
+        state = 0
+        for ch in keyword:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(-1)
+            state = next_state
+        if self._output[state] < 0:
+            self._output[state] = len(self.keywords)
+        self.keywords.append(keyword)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                if self._output[next_state] < 0:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def search(self, text: str) -> Optional[str]:
+        """返回文本中第一个出现的关键字，没有匹配时返回 None"""
+        if not self.keywords or not text:
+            return None
+        if self.ignore_case:
+            text = text.casefold()
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state] >= 0:
+                return self.keywords[output[state]]
+        return None
+
+    def __len__(self) -> int:
+        return len(self.keywords)
+
+
+class ContentFilter:
+    """按消息内容的包含/排除过滤器（编译后不可变）
+
+    关键字编译为 Aho-Corasick 自动机，正则合并为单个分组的交替表达式，每段文本各扫描一次，
+    不再逐条 re.search。排除优先：命中任一排除规则即丢弃；配置了包含规则时，至少命中一条才转发。
+    只对 msg_types 内的消息生效（默认文本与应用消息），其余类型不受影响。
+    """
+
+    DEFAULT_MSG_TYPES = ("text", "app")
+
+    def __init__(self, include_keywords=(), exclude_keywords=(), include_patterns=(), exclude_patterns=(),
+                 msg_types: Optional[frozenset] = None, ignore_case: bool = True):
+        self.msg_types = msg_types
+        self.include_keywords = KeywordAutomaton(include_keywords, ignore_case)
+        self.exclude_keywords = KeywordAutomaton(exclude_keywords, ignore_case)
+        self.include_regex = self._combine(include_patterns, ignore_case)
+        self.exclude_regex = self._combine(exclude_patterns, ignore_case)
+        self.has_include = bool(len(self.include_keywords) or self.include_regex)
+
+    @staticmethod
+    def _combine(patterns, ignore_case: bool):
+        patterns = [p for p in patterns if p]
+        if not patterns:
+            return None
+        flags = re.IGNORECASE if ignore_case else 0
+        for pattern in patterns:
+            try:
+                re.compile(pattern, flags)
+            except re.error as e:
+                raise ValueError(f"无效的内容过滤正则 {pattern!r}: {e}")
+        return re.compile("|".join(f"(?:{p})" for p in patterns), flags)
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["ContentFilter"]:
+        """从 [content_filter] 编译过滤器；未启用或没有任何规则时返回 None"""
+        if not config.get("enable", False):
+            return None
+        lists = {}
+        for key in ("include_keywords", "exclude_keywords", "include_patterns", "exclude_patterns"):
+            values = config.get(key, [])
+            if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+                raise TypeError(f"content_filter.{key} 必须是字符串列表")
+            lists[key] = values
+        if not any(lists.values()):
+            return None
+        return cls(
+            msg_types=RoutingTable._parse_msg_types(config.get("msg_types", list(cls.DEFAULT_MSG_TYPES))),
+            ignore_case=bool(config.get("ignore_case", True)),
+            **lists
+        )
+
+    def applies_to(self, msg_type) -> bool:
+        return self.msg_types is None or msg_type in self.msg_types
+
+    def check(self, texts) -> Optional[str]:
+        """检查消息的各段文本，允许转发时返回 None，否则返回被过滤的原因"""
+        for text in texts:
+            keyword = self.exclude_keywords.search(text)
+            if keyword is not None:
+                return f"命中排除关键字 {keyword!r}"
+            if self.exclude_regex is not None:
+                match = self.exclude_regex.search(text)
+                if match:
+                    return f"命中排除正则 {match.group(0)!r}"
+        if not self.has_include:
+            return None
+        for text in texts:
+            if self.include_keywords.search(text) is not None:
+                return None
+            if self.include_regex is not None and self.include_regex.search(text):
+                return None
+        return "未命中任何包含规则"
+
+
+class CompiledConfig:
+    """处理器热路径读取的只读配置快照
+
+    由 config.toml 解析、校验并编译而成（路由表索引、集合等）。热更新时整体替换
+    MessageForwarder.compiled 属性，处理器每条消息只读取一次该属性，
+    因此只会看到完整的旧配置或完整的新配置，不会看到更新到一半的状态。
+    """
+
+    __slots__ = ("routing_table", "dedup_content_digest", "skip_duplicate_media", "duplicate_window_minutes",
+                 "content_filter", "listen_wxids", "raw")
+
+    # 可热更新的配置：None 表示整段，否则为段内可热更新的键；其余修改需重新启用插件后生效
+    HOT_KEYS = {
+        "forwarder": None,
+        "listen_source": None,
+        "routes": None,
+        "hot_reload": None,
+        "dedup": ("content_digest_fallback",),
+        "media_cache": ("skip_duplicate_forward", "duplicate_window_minutes"),
+        "content_filter": None,
+    }
+
+    def __init__(self, routing_table: RoutingTable, dedup_content_digest: bool = True,
+                 skip_duplicate_media: bool = False, duplicate_window_minutes: float = 10,
+                 content_filter: Optional[ContentFilter] = None, listen_wxids: Tuple[str, ...] = (),
+                 raw: Optional[dict] = None):
+        object.__setattr__(self, "routing_table", routing_table)
+        object.__setattr__(self, "dedup_content_digest", dedup_content_digest)
+        object.__setattr__(self, "skip_duplicate_media", skip_duplicate_media)
+        object.__setattr__(self, "duplicate_window_minutes", duplicate_window_minutes)
+        object.__setattr__(self, "content_filter", content_filter)
+        # [listen_source] 中列出的群聊与用户 wxid（名称缓存预热使用）
+        object.__setattr__(self, "listen_wxids", tuple(listen_wxids))
+        object.__setattr__(self, "raw", raw or {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledConfig 为只读对象，请编译新的配置后整体替换")
+
+    @property
+    def media_forward_ttl(self) -> float:
+        return self.duplicate_window_minutes * 60 if self.skip_duplicate_media else 0.0
+
+    @staticmethod
+    def _section(config: dict, name: str) -> dict:
+        section = config.get(name, {})
+        if not isinstance(section, dict):
+            raise TypeError(f"配置段 [{name}] 必须是表")
+        return section
+
+    @classmethod
+    def compile(cls, config: dict, require_routes: bool = False) -> "CompiledConfig":
+        """校验并编译配置；配置无效时抛出 ValueError/TypeError
+
+        require_routes 为 True 时（热更新），编译出空路由表的配置视为无效，
+        避免编辑器先清空文件再写入的中间状态导致停止转发。
+        """
+        for name in config:
+            if name != "routes" and not isinstance(config[name], dict):
+                raise TypeError(f"配置段 [{name}] 必须是表")
+        forwarder_config = cls._section(config, "forwarder")
+        if forwarder_config.get("target_type", "user") not in ("user", "group"):
+            raise ValueError(f"未知的目标类型: {forwarder_config.get('target_type')}")
+        listen_source_config = cls._section(config, "listen_source")
+        if listen_source_config.get("listen_type", "all") not in ("all", "user", "group"):
+            raise ValueError(f"未知的监听类型: {listen_source_config.get('listen_type')}")
+        for key in ("listen_user_wxids", "listen_group_wxids"):
+            if not isinstance(listen_source_config.get(key, []), list):
+                raise TypeError(f"listen_source.{key} 必须是列表")
+        routes = config.get("routes", [])
+        if not isinstance(routes, list) or not all(isinstance(route, dict) for route in routes):
+            raise TypeError("routes 必须是 [[routes]] 表数组")
+
+        routing_table = RoutingTable.from_config(config)
+        if require_routes and not len(routing_table):
+            raise ValueError("配置中没有任何转发目标")
+
+        dedup_config = cls._section(config, "dedup")
+        media_cache_config = cls._section(config, "media_cache")
+        duplicate_window_minutes = media_cache_config.get("duplicate_window_minutes", 10)
+        if not isinstance(duplicate_window_minutes, (int, float)) or duplicate_window_minutes < 0:
+            raise ValueError("media_cache.duplicate_window_minutes 必须是非负数")
+        return cls(
+            routing_table,
+            dedup_content_digest=bool(dedup_config.get("content_digest_fallback", True)),
+            skip_duplicate_media=bool(media_cache_config.get("skip_duplicate_forward", False)),
+            duplicate_window_minutes=duplicate_window_minutes,
+            content_filter=ContentFilter.from_config(cls._section(config, "content_filter")),
+            listen_wxids=tuple(listen_source_config.get("listen_group_wxids", []))
+            + tuple(listen_source_config.get("listen_user_wxids", [])),
+            raw=config
+        )
+
+    def cold_changes(self, previous: "CompiledConfig") -> List[str]:
+        """返回与 previous 相比，修改了不可热更新部分的配置段"""
+        changed = []
+        for name in sorted(set(self.raw) | set(previous.raw)):
+            hot_keys = self.HOT_KEYS.get(name, ())
+            if hot_keys is None:
+                continue
+            old = {k: v for k, v in previous.raw.get(name, {}).items() if k not in hot_keys}
+            new = {k: v for k, v in self.raw.get(name, {}).items() if k not in hot_keys}
+            if old != new:
+                changed.append(name)
+        return changed
+
+
+class DedupIndex:
+    """固定内存的 TTL 去重索引
+
+    环形缓冲区按插入顺序保存键，配合字典做常数时间查找；缓冲区写满后覆盖最旧的键，
+    因此内存占用与消息速率无关，只由 capacity 决定。
+    """
+
+    def __init__(self, capacity: int = 50000, ttl: float = 300.0):
+        self.capacity = max(1, int(capacity))
+        self.ttl = float(ttl)
+        self._ring: List[Optional[tuple]] = [None] * self.capacity
+        self._pos = 0
+        self._seen: Dict[str, float] = {}
+        # 统计数据
+        self.checked = 0
+        self.suppressed = 0
+
+    def seen(self, key: str) -> bool:
+        """键在 TTL 内出现过则返回 True（计为一次抑制），否则记录该键并返回 False"""
+        self.checked += 1
+        now = time.monotonic()
+        seen_at = self._seen.get(key)
+        if seen_at is not None and now - seen_at <= self.ttl:
+            self.suppressed += 1
+            return True
+        oldest = self._ring[self._pos]
+        # 只有字典中的时间戳仍属于被覆盖的槽位时才删除（该键可能已被重新记录）
+        if oldest is not None and self._seen.get(oldest[0]) == oldest[1]:
+            del self._seen[oldest[0]]
+        self._ring[self._pos] = (key, now)
+        self._pos = (self._pos + 1) % self.capacity
+        self._seen[key] = now
+        return False
+
+    def stats(self) -> dict:
+        return {"checked": self.checked, "suppressed": self.suppressed, "size": len(self._seen)}
+
+
+class XmlInfo:
+    """一次 XML 解析的结果（不可变使用）
+
+    kind 取值: "appmsg" / "file" / "card" / "cdn_video" / "cdn_image" / "emoji" / "other" / "invalid"
+    """
+
+    __slots__ = ("kind", "sender", "xml", "appmsg", "appmsg_type", "title", "des", "media", "card", "error")
+
+    def __init__(self, kind: str, sender: str = "", xml: str = "", appmsg: Optional[str] = None,
+                 appmsg_type: str = "", title: str = "", des: str = "", media: Optional[dict] = None,
+                 card: Optional[dict] = None, error: str = ""):
+        self.kind = kind
+        self.sender = sender
+        self.xml = xml
+        self.appmsg = appmsg
+        self.appmsg_type = appmsg_type
+        self.title = title
+        self.des = des
+        self.media = media or {}
+        self.card = card
+        self.error = error
+
+
+class XmlClassifier:
+    """单次解析的 XML 消息分类器
+
+    每条 XML 只去掉一次发送者前缀、只调用一次 ET.fromstring，同时判断消息种类并提取
+    appmsg 片段（直接从原文切片，不再 ET.tostring 重新序列化）、标题描述、CDN 属性与名片信息。
+    结果按去掉前缀后的正文摘要做 LRU 缓存，同一篇文章分享到多个群时只解析一次。
+    """
+
+    def __init__(self, cache_size: int = 2048):
+        self.cache_size = max(0, int(cache_size))
+        self._cache: "OrderedDict[str, XmlInfo]" = OrderedDict()
+        # 统计数据
+        self.hits = 0
+        self.misses = 0
+        self.parse_errors = 0
+
+    @staticmethod
+    def split_prefix(xml_content: str) -> Tuple[str, str]:
+        """拆分群聊消息的发送者前缀（格式：发送者id:\n<xml...>），返回 (发送者, 正文)"""
+        lt = xml_content.find("<")
+        if lt > 0:
+            head = xml_content[:lt].rstrip()
+            if head.endswith(":"):
+                return head[:-1].strip(), xml_content[lt:]
+        return "", xml_content[lt:] if lt > 0 else xml_content
+
+    def classify(self, xml_content: str) -> XmlInfo:
+        sender, body = self.split_prefix(xml_content)
+        # 缓存键对完整的 UTF-8 正文计算，只差中文标题/描述的两条 XML 不会命中同一条目
+        key = hashlib.blake2b(body.encode("utf-8"), digest_size=16).hexdigest() if self.cache_size else None
+        info = self._cache.get(key) if key else None
+        if info is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+            info = self._parse(body)
+            if key:
+                self._cache[key] = info
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        if sender and sender != info.sender:
+            # 同一正文可能来自不同发送者，前缀不进入缓存
+            info = XmlInfo(info.kind, sender, info.xml, info.appmsg, info.appmsg_type, info.title,
+                           info.des, info.media, info.card, info.error)
+        return info
+
+    def _parse(self, body: str) -> XmlInfo:
+        try:
+            root = ET.fromstring(body)
+        except ET.ParseError as e:
+            self.parse_errors += 1
+            return XmlInfo("invalid", xml=body, error=str(e))
+
+        appmsg_element = root if root.tag == "appmsg" else next(root.iter("appmsg"), None)
+        if appmsg_element is not None:
+            appmsg_type = (appmsg_element.findtext("type") or "").strip()
+            start = body.find("<appmsg")
+            end = body.rfind("</appmsg>")
+            if start >= 0 and end > start:
+                appmsg = body[start:end + len("</appmsg>")]
+            else:
+                appmsg = ET.tostring(appmsg_element, encoding="unicode")
+            return XmlInfo(
+                "file" if appmsg_type == "6" else "appmsg",
+                xml=body,
+                appmsg=appmsg,
+                appmsg_type=appmsg_type,
+                title=appmsg_element.findtext("title") or "",
+                des=appmsg_element.findtext("des") or "",
+            )
+
+        for tag, kind, url_attrs in (
+            ("videomsg", "cdn_video", ("cdnvideourl",)),
+            ("img", "cdn_image", ("cdnmidimgurl", "cdnbigimgurl", "cdnthumburl")),
+            ("emoji", "emoji", ("md5", "cdnurl")),
+        ):
+            element = root if root.tag == tag else root.find(tag)
+            if element is not None and any(element.get(attr) for attr in url_attrs):
+                return XmlInfo(kind, xml=body, media=dict(element.attrib))
+
+        if root.get("username") and root.get("nickname"):
+            return XmlInfo("card", xml=body, card={
+                "wxid": root.get("username", ""),
+                "nickname": root.get("nickname", ""),
+                "alias": root.get("alias", ""),
+            })
+        return XmlInfo("other", xml=body)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "parse_errors": self.parse_errors, "entries": len(self._cache)}
+
+
+class PriorityClass:
+    """出站队列的一个优先级类别：自己的有界缓冲区与溢出策略
+
+    溢出策略:
+      - block: 缓冲区满时处理器等待（背压）
+      - drop_oldest: 丢弃该类别中最早排队的任务，接收新任务
+      - drop_newest: 丢弃新任务
+      - degrade: 把新任务替换为降级任务（如视频只走 CDN 转发或只发送提示），无法降级时丢弃
+    """
+
+    OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest", "degrade")
+
+    def __init__(self, name: str, msg_types=None, max_pending: int = 500, overflow: str = "block", degrade: str = ""):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"优先级类别 {name} 的溢出策略无效: {overflow}")
+        self.name = name
+        self.msg_types = msg_types  # frozenset 或 None（匹配其余所有类型）
+        self.max_pending = max(1, int(max_pending))
+        self.overflow = overflow
+        self.degrade = degrade
+        self.pending = 0
+        self.submitted = 0
+        self.shed = 0
+        self.degraded = 0
+        # 本类别排队中的任务（按到达顺序），供 drop_oldest 查找最早的任务
+        self._entries = deque()
+        self._space: Optional[asyncio.Event] = None
+
+    @classmethod
+    def from_config(cls, class_configs: list) -> List["PriorityClass"]:
+        """从 [[priority.classes]] 编译优先级类别（按配置顺序从高到低）"""
+        classes = []
+        for index, class_config in enumerate(class_configs):
+            name = class_config.get("name") or f"class{index}"
+            msg_types = RoutingTable._parse_msg_types(class_config.get("msg_types", []))
+            classes.append(cls(
+                name,
+                msg_types,
+                class_config.get("max_pending", 500),
+                class_config.get("overflow", "block"),
+                class_config.get("degrade", "")
+            ))
+        return classes
+
+
+class _QueuedJob:
+    __slots__ = ("job", "priority", "on_shed", "alive")
+
+    def __init__(self, job, priority: PriorityClass, on_shed=None):
+        self.job = job
+        self.priority = priority
+        self.on_shed = on_shed
+        self.alive = True
+
+
+class ForwardDispatcher:
+    """出站转发调度器
+
+    处理器只负责把转发任务放入队列并立即返回，由固定数量的 worker 异步消费。
+    任务按来源会话（FromWxid）哈希分片到固定 worker，因此同一会话内同一优先级类别的消息按到达顺序发出，
+    不同会话之间并行发送。每个 worker 总是先处理高优先级类别的任务，
+    大视频刷屏时文本/名片等高优先级消息不会被堵在后面；每个类别的排队数量有上限，溢出时按类别的策略处理。
+    """
+
+    def __init__(self, workers: int = 4, max_queue_size: int = 500, classes: Optional[List[PriorityClass]] = None,
+                 metrics: Optional[Metrics] = None):
+        self.workers = max(1, int(workers))
+        self.max_queue_size = max(0, int(max_queue_size))
+        if not classes:
+            # 未配置优先级时只有一个类别，排队上限与原先每个 worker 的队列上限总和一致
+            classes = [PriorityClass("default", None, (self.max_queue_size or 1000) * self.workers, "block")]
+        self.classes = classes
+        self._class_by_type: Dict[int, PriorityClass] = {}
+        self._default_class = classes[-1]
+        for priority in classes:
+            if priority.msg_types is None:
+                self._default_class = priority
+            else:
+                for msg_type in priority.msg_types:
+                    self._class_by_type.setdefault(msg_type, priority)
+        self.metrics = metrics
+        self._lanes: List[List[deque]] = []
+        self._wakeups: List[asyncio.Event] = []
+        self._tasks: List[asyncio.Task] = []
+        self._active = 0
+        self._idle: Optional[asyncio.Event] = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        """启动 worker（需在事件循环中调用）"""
+        if self.running:
+            return
+        # 每个 worker 按优先级为每个类别维护一条队列
+        self._lanes = [[deque() for _ in self.classes] for _ in range(self.workers)]
+        self._wakeups = [asyncio.Event() for _ in range(self.workers)]
+        self._idle = asyncio.Event()
+        self._idle.set()
+        for priority in self.classes:
+            priority._space = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(index)) for index in range(self.workers)]
+        logger.info(f"[MessageForwarder] 出站队列已启动，worker数量: {self.workers}, 优先级类别: "
+                    f"{[(c.name, c.max_pending, c.overflow) for c in self.classes]}")
+
+    def pending(self) -> int:
+        """当前排队中的任务数（不含正在执行的任务）"""
+        return sum(priority.pending for priority in self.classes)
+
+    def idle(self) -> bool:
+        """没有排队中的任务，也没有正在执行的任务"""
+        return not self.pending() and not self._active
+
+    def class_for(self, msg_type) -> PriorityClass:
+        return self._class_by_type.get(msg_type, self._default_class)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending(),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "class_pending": {c.name: c.pending for c in self.classes},
+            "class_shed": {c.name: c.shed for c in self.classes},
+            "class_degraded": {c.name: c.degraded for c in self.classes},
+        }
+
+    def _shard(self, key: str) -> int:
+        return zlib.crc32(key.encode("utf-8")) % self.workers
+
+    def _count_shed(self, priority: PriorityClass, policy: str, queued: Optional[_QueuedJob] = None):
+        priority.shed += 1
+        if self.metrics is not None:
+            self.metrics.inc("shed", priority=priority.name, policy=policy)
+        if queued is not None and queued.on_shed is not None:
+            try:
+                queued.on_shed()
+            except Exception as e:
+                logger.error(f"[MessageForwarder] 丢弃任务回调异常: {e}")
+
+    def _drop_oldest(self, priority: PriorityClass) -> bool:
+        entries = priority._entries
+        while entries:
+            victim = entries.popleft()
+            if victim.alive:
+                victim.alive = False
+                victim.job = None  # 立即释放任务持有的媒体数据
+                priority.pending -= 1
+                self._count_shed(priority, "drop_oldest", victim)
+                return True
+        return False
+
+    async def submit(self, key: str, job, msg_type=None, degrade=None, on_shed=None) -> bool:
+        """提交转发任务（无参协程函数），返回是否被接收；调度器未运行时直接在当前协程中执行
+
+        degrade 为可选的降级任务工厂，签名为 degrade(mode) -> job 或 None，只在需要降级时调用。
+        on_shed 在任务被丢弃时调用。
+        """
+        if not self.running:
+            await self._run(job)
+            return True
+        priority = self.class_for(msg_type)
+        if priority.pending >= priority.max_pending:
+            if priority.overflow == "block":
+                # 缓冲区满时在此等待，形成背压
+                while priority.pending >= priority.max_pending and self.running:
+                    priority._space.clear()
+                    await priority._space.wait()
+                if not self.running:
+                    await self._run(job)
+                    return True
+            elif priority.overflow == "drop_newest":
+                self._count_shed(priority, "drop_newest", _QueuedJob(job, priority, on_shed))
+                return False
+            elif priority.overflow == "drop_oldest":
+                if not self._drop_oldest(priority):
+                    self._count_shed(priority, "drop_newest", _QueuedJob(job, priority, on_shed))
+                    return False
+            elif priority.overflow == "degrade":
+                # 降级任务放入最低优先级类别，同样受该类别的排队上限约束；该类别也已满时丢弃
+                lowest = self.classes[-1]
+                degraded = None
+                if degrade is not None and lowest.pending < lowest.max_pending:
+                    degraded = degrade(priority.degrade)
+                if degraded is None:
+                    self._count_shed(priority, "degrade", _QueuedJob(job, priority, on_shed))
+                    return False
+                # 原任务（及其媒体数据）随即释放
+                priority.degraded += 1
+                if self.metrics is not None:
+                    self.metrics.inc("degraded", priority=priority.name, mode=priority.degrade or "default")
+                job = degraded
+                priority = lowest
+        queued = _QueuedJob(job, priority, on_shed)
+        index = self._shard(key or "")
+        self._lanes[index][self.classes.index(priority)].append(queued)
+        priority._entries.append(queued)
+        # 清理已被取走的任务，避免索引无限增长
+        while priority._entries and not priority._entries[0].alive:
+            priority._entries.popleft()
+        priority.pending += 1
+        priority.submitted += 1
+        self.submitted += 1
+        self._idle.clear()
+        self._wakeups[index].set()
+        return True
+
+    def _next_job(self, index: int) -> Optional[_QueuedJob]:
+        for lane in self._lanes[index]:
+            while lane:
+                queued = lane.popleft()
+                if queued.alive:
+                    queued.alive = False
+                    queued.priority.pending -= 1
+                    queued.priority._space.set()
+                    return queued
+        return None
+
+    async def _worker(self, index: int):
+        wakeup = self._wakeups[index]
+        while True:
+            queued = self._next_job(index)
+            if queued is None:
+                if not self._active and not self.pending():
+                    self._idle.set()
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+            self._active += 1
+            try:
+                await self._run(queued.job)
+            finally:
+                self._active -= 1
+                queued.job = None
+
+    async def _run(self, job):
+        try:
+            await job()
+            self.completed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"[MessageForwarder] 出站任务执行异常: {e}")
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """等待队列排空（最多 drain_timeout 秒）后停止所有 worker"""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._drained(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"[MessageForwarder] 出站队列未能在 {drain_timeout} 秒内排空，丢弃剩余 {self.pending()} 个任务")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._lanes = []
+        for priority in self.classes:
+            priority.pending = 0
+            priority._entries.clear()
+            if priority._space is not None:
+                # 唤醒仍在等待缓冲区空间的处理器，调度器停止后它们会直接执行任务
+                priority._space.set()
+        logger.info(f"[MessageForwarder] 出站队列已停止，已完成: {self.completed}, 失败: {self.failed}")
+
+    async def _drained(self):
+        while self.pending() or self._active:
+            self._idle.clear()
+            await self._idle.wait()
+
+
+class ThumbnailEngine:
+    """基于 asyncio 子进程的视频缩略图引擎
+
+    ffmpeg 以异步子进程运行，不阻塞事件循环；通过信号量限制同时运行的 ffmpeg 数量，
+    每个任务有独立超时，超时后强制 kill。快速定位模式把 -ss 放在 -i 之前，
+    由 ffmpeg 直接按关键帧定位，大视频无需从头解码。
+    JPEG 结果直接从 ffmpeg 的 stdout 读取；视频内容可通过匿名 memfd 或 stdin 管道输入，
+    无需落盘。同时统计任务的排队耗时与运行耗时。
+    """
+
+    def __init__(self, ffmpeg_path: str = "ffmpeg", max_concurrency: int = 2, timeout: float = 20.0,
+                 fast_seek: bool = True, seek_time: str = "00:00:01", pipeline: str = "memfd",
+                 metrics: Optional[Metrics] = None):
+        self.ffmpeg_path = ffmpeg_path
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.timeout = float(timeout)
+        self.fast_seek = fast_seek
+        self.seek_time = seek_time
+        # memfd 不可用（非 Linux）时退回 stdin 管道
+        if pipeline == "memfd" and not hasattr(os, "memfd_create"):
+            pipeline = "pipe"
+        self.pipeline = pipeline
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.metrics = metrics
+        # 统计数据
+        self.jobs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_wait = 0.0
+        self.max_run = 0.0
+
+    def _build_command(self, input_spec: str, seek_time: Optional[str]) -> List[str]:
+        cmd = [self.ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y']
+        if seek_time and self.fast_seek:
+            # 输入前定位：按关键帧跳转，不解码前面的内容
+            cmd += ['-ss', seek_time, '-i', input_spec]
+        elif seek_time:
+            cmd += ['-i', input_spec, '-ss', seek_time]
+        else:
+            cmd += ['-i', input_spec]
+        # 单帧 JPEG 直接写到 stdout
+        cmd += ['-frames:v', '1', '-an', '-f', 'image2pipe', '-c:v', 'mjpeg', 'pipe:1']
+        return cmd
+
+    async def _run_ffmpeg(self, cmd: List[str], input_data: Optional[bytes] = None, pass_fds=()) -> Optional[bytes]:
+        """运行一次 ffmpeg 并返回 stdout 内容，失败或超时返回 None（超时会 kill 子进程）"""
+        logger.opt(lazy=True).debug("执行ffmpeg命令: {}", lambda: ' '.join(cmd))
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if input_data is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            pass_fds=pass_fds
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(input_data), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            process.kill()
+            await process.wait()
+            logger.error(f"ffmpeg 提取封面超时 ({self.timeout} 秒)，已终止进程")
+            return None
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            logger.error(f"ffmpeg 提取封面失败 (返回码: {process.returncode}): {stderr.decode('utf-8', 'replace')}")
+            return None
+        return stdout
+
+    async def _extract(self, input_spec: str, input_data: Optional[bytes] = None, pass_fds=()) -> Optional[bytes]:
+        image_data = await self._run_ffmpeg(self._build_command(input_spec, self.seek_time), input_data, pass_fds)
+        if image_data == b"" and self.seek_time:
+            # 视频短于定位时间时输出为空，退回取第一帧
+            image_data = await self._run_ffmpeg(self._build_command(input_spec, None), input_data, pass_fds)
+        return image_data or None
+
+    async def _timed(self, job) -> Optional[bytes]:
+        """在并发限制下执行任务，并记录排队/运行耗时"""
+        queued_at = time.monotonic()
+        async with self._semaphore:
+            started_at = time.monotonic()
+            wait = started_at - queued_at
+            self.jobs += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            try:
+                image_data = await job()
+                if not image_data:
+                    self.failures += 1
+                return image_data
+            finally:
+                run = time.monotonic() - started_at
+                self.total_run += run
+                self.max_run = max(self.max_run, run)
+                if self.metrics is not None:
+                    self.metrics.observe("ffmpeg_wait", wait, pipeline=self.pipeline)
+                    self.metrics.observe("ffmpeg_run", run, pipeline=self.pipeline)
+                logger.debug("[MessageForwarder] 缩略图任务排队 {:.1f} ms，运行 {:.1f} ms", wait * 1000, run * 1000)
+
+    async def extract_frame(self, video_path: Path) -> Optional[bytes]:
+        """从本地视频文件提取一帧，返回 JPEG 字节"""
+        return await self._timed(lambda: self._extract(str(video_path)))
+
+    async def extract_frame_from_bytes(self, video_data: bytes) -> Optional[bytes]:
+        """不落盘地从内存中的视频数据提取一帧，返回 JPEG 字节
+
+        memfd 模式下视频写入匿名内存文件，ffmpeg 通过 /dev/fd 读取（可随机访问，
+        兼容 moov 在文件尾部的 mp4）；pipe 模式下通过 stdin 输入。
+        """
+        if self.pipeline == "memfd":
+            return await self._timed(lambda: self._extract_via_memfd(video_data))
+        return await self._timed(lambda: self._extract("pipe:0", input_data=video_data))
+
+    async def extract_frame_from_file(self, file_obj) -> Optional[bytes]:
+        """从已打开的文件对象（如已落盘的 SpooledTemporaryFile）提取一帧，ffmpeg 通过 /dev/fd 读取"""
+        fd = file_obj.fileno()
+        return await self._timed(lambda: self._extract(f"/dev/fd/{fd}", pass_fds=(fd,)))
+
+    async def _extract_via_memfd(self, video_data: bytes) -> Optional[bytes]:
+        fd = os.memfd_create("message_forwarder_video", 0)
+        try:
+            view = memoryview(video_data)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+            return await self._extract(f"/dev/fd/{fd}", pass_fds=(fd,))
+        finally:
+            os.close(fd)
+
+    def stats(self) -> dict:
+        """返回排队/运行耗时统计"""
+        jobs = self.jobs or 1
+        return {
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(self.total_wait / jobs * 1000, 1),
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "avg_run_ms": round(self.total_run / jobs * 1000, 1),
+            "max_run_ms": round(self.max_run * 1000, 1),
+        }
+
+
+# 分块处理 base64 媒体时每块的字符数（4 的倍数，解码后为 768 KB）
+MEDIA_CHUNK_CHARS = 1024 * 1024
+
+
+def spool_base64(data: str, spool_threshold: int, spool_dir=None) -> tempfile.SpooledTemporaryFile:
+    """把 base64 字符串分块解码到 SpooledTemporaryFile：小于阈值时留在内存，超过后自动落盘
+
+    与一次性 b64decode 相比，内存中不会同时存在完整的解码结果；返回的文件已定位到开头。
+    """
+    if any(ch in data for ch in " \r\n\t"):
+        # 含换行等空白时分块边界可能错位，先去掉空白（少见）
+        data = "".join(data.split())
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_threshold, dir=spool_dir)
+    try:
+        for offset in range(0, len(data), MEDIA_CHUNK_CHARS):
+            spool.write(base64.b64decode(data[offset:offset + MEDIA_CHUNK_CHARS]))
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return spool
+
+
+def _write_base64_to_fd(data: str, fd: int):
+    """把 base64 字符串分块解码写入文件描述符"""
+    if any(ch in data for ch in " \r\n\t"):
+        data = "".join(data.split())
+    for offset in range(0, len(data), MEDIA_CHUNK_CHARS):
+        view = memoryview(base64.b64decode(data[offset:offset + MEDIA_CHUNK_CHARS]))
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+
+def _media_video_thumbnail(video_base64: str, commands: List[List[str]], timeout: float, pipeline: str,
+                           spool_threshold: int, spool_dir: str) -> Optional[bytes]:
+    """媒体进程池中执行：解码 base64 视频并用 ffmpeg 提取一帧 JPEG
+
+    commands 为依次尝试的 ffmpeg 命令（输入位置为 "{input}" 占位），前一条输出为空时才尝试下一条。
+    memfd 模式直接分块解码到匿名内存文件；spool_threshold > 0（低内存模式）或 file 模式时解码到
+    SpooledTemporaryFile，落盘后 ffmpeg 通过 /dev/fd 读取；其余情况通过 stdin 输入。
+    """
+    fd = None
+    spool = None
+    input_data = None
+    try:
+        if pipeline == "memfd" and spool_threshold <= 0 and hasattr(os, "memfd_create"):
+            fd = os.memfd_create("message_forwarder_video", 0)
+            _write_base64_to_fd(video_base64, fd)
+            input_spec = f"/dev/fd/{fd}"
+        elif spool_threshold > 0 or pipeline == "file":
+            # max_size 为 0 时 SpooledTemporaryFile 永不落盘，file 模式用 1 使其立即落盘
+            spool = spool_base64(video_base64, spool_threshold if pipeline != "file" else 1, spool_dir)
+            if spool._rolled:
+                input_spec = f"/dev/fd/{spool.fileno()}"
+            else:
+                input_spec, input_data = "pipe:0", spool.read()
+        else:
+            input_spec, input_data = "pipe:0", base64.b64decode(video_base64)
+        pass_fds = (int(input_spec[len("/dev/fd/"):]),) if input_spec.startswith("/dev/fd/") else ()
+        for command in commands:
+            result = subprocess.run(
+                [input_spec if arg == "{input}" else arg for arg in command],
+                input=input_data,
+                stdin=None if input_data is not None else subprocess.DEVNULL,
+                capture_output=True,
+                timeout=timeout,
+                pass_fds=pass_fds
+            )
+            if result.returncode != 0:
+                raise RuntimeError(f"ffmpeg 返回码 {result.returncode}: {result.stderr.decode('utf-8', 'replace')[-500:]}")
+            if result.stdout:
+                return result.stdout
+        return None
+    finally:
+        if fd is not None:
+            os.close(fd)
+        if spool is not None:
+            spool.close()
+
+
+def _media_fit_image(image_base64: str, max_bytes: int, max_side: int = 0, quality: int = 85) -> Optional[str]:
+    """媒体进程池中执行：把图片缩放到 max_side 以内并重新压缩为不超过 max_bytes 的 JPEG（0 表示不限制）
+
+    返回新的 base64；不需要处理、Pillow 不可用、动图或压缩后反而更大时返回 None（使用原图）。
+    """
+    if PILImage is None:
+        return None
+    data = base64.b64decode(image_base64)
+    if not max_side and len(data) <= max_bytes:
+        return None
+    image = PILImage.open(io.BytesIO(data))
+    if getattr(image, "is_animated", False):
+        return None
+    oversized = bool(max_side) and max(image.size) > max_side
+    if (not max_bytes or len(data) <= max_bytes) and not oversized:
+        return None
+    if oversized:
+        image.thumbnail((max_side, max_side))
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    # 先降低质量，仍超出预算时按比例缩小尺寸，次数有上限
+    for _ in range(8):
+        output.seek(0)
+        output.truncate()
+        image.save(output, "JPEG", quality=quality, optimize=True)
+        if not max_bytes or output.tell() <= max_bytes:
+            break
+        if quality > 60:
+            quality -= 10
+        elif min(image.size) > 160:
+            image = image.resize((max(1, int(image.width * 0.75)), max(1, int(image.height * 0.75))))
+        else:
+            break
+    if output.tell() >= len(data):
+        return None
+    return base64.b64encode(output.getvalue()).decode("ascii")
+
+
+def _media_noop() -> int:
+    return os.getpid()
+
+
+MEDIA_JOBS = {
+    "video_thumbnail": _media_video_thumbnail,
+    "fit_image": _media_fit_image,
+    "noop": _media_noop,
+}
+
+
+def _run_media_batch(jobs: list) -> list:
+    """媒体进程池中执行一批任务，返回 [(是否成功, 结果或 (错误类型, 错误信息))]"""
+    results = []
+    for kind, args in jobs:
+        try:
+            results.append((True, MEDIA_JOBS[kind](*args)))
+        except Exception as e:
+            results.append((False, ("value" if isinstance(e, ValueError) else "error", f"{type(e).__name__}: {e}")))
+    return results
+
+
+class MediaStage:
+    """CPU 密集的媒体处理阶段：基于进程池批量执行解码、缩略图与图片重新压缩
+
+    事件循环只负责排队与分发：任务在 batch_window 内攒批（或攒满 batch_size × 进程数时立即分发），
+    每批按进程数拆分后交给 ProcessPoolExecutor，大载荷的 base64 解码/编码与 ffmpeg 等待都不在事件循环线程中进行。
+    进程池在启动时预先创建；子进程异常退出导致进程池损坏时，下一批任务自动重建进程池。
+    """
+
+    def __init__(self, processes: int = 0, batch_size: int = 4, batch_window: float = 0.005,
+                 start_method: str = "", metrics: Optional[Metrics] = None):
+        self.processes = max(1, int(processes or os.cpu_count() or 1))
+        self.batch_size = max(1, int(batch_size))
+        self.batch_window = max(0.0, float(batch_window))
+        self.start_method = start_method
+        self.metrics = metrics
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending: List[tuple] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        # 统计数据
+        self.jobs = 0
+        self.batches = 0
+        self.failures = 0
+        self.restarts = 0
+
+    def _ensure_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            mp_context = multiprocessing.get_context(self.start_method) if self.start_method else None
+            self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=mp_context)
+        return self._executor
+
+    async def start(self):
+        """创建进程池并预热（子进程在插件启用时创建，而不是在第一条媒体消息到达时）"""
+        loop = asyncio.get_running_loop()
+        executor = self._ensure_executor()
+        await asyncio.gather(*(loop.run_in_executor(executor, _media_noop) for _ in range(self.processes)))
+
+    async def run(self, kind: str, *args):
+        """提交一个任务并等待结果；任务内部的 ValueError 原样抛出，其他错误抛出 RuntimeError"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((kind, args, future, time.perf_counter()))
+        self.jobs += 1
+        if len(self._pending) >= self.batch_size * self.processes:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        ok, result = await future
+        if ok:
+            return result
+        self.failures += 1
+        error_type, error = result
+        raise ValueError(error) if error_type == "value" else RuntimeError(error)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        jobs, self._pending = self._pending, []
+        if not jobs:
+            return
+        count = min(len(jobs), self.processes)
+        for index in range(count):
+            task = asyncio.get_running_loop().create_task(self._run_batch(jobs[index::count]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[tuple]):
+        self.batches += 1
+        loop = asyncio.get_running_loop()
+        results = []
+        try:
+            executor = self._ensure_executor()
+            try:
+                results = await loop.run_in_executor(
+                    executor, _run_media_batch, [(kind, args) for kind, args, _, _ in batch]
+                )
+            except BrokenProcessPool as e:
+                results = [(False, ("error", f"媒体进程池异常: {e}"))] * len(batch)
+                # 并发的多个批次会同时收到同一个进程池的异常，只由第一个批次关闭并重建
+                if self._executor is executor:
+                    logger.error(f"[MessageForwarder] 媒体进程池异常，将重建: {e}")
+                    self._executor = None
+                    self.restarts += 1
+                    executor.shutdown(wait=False)
+        except Exception as e:
+            results = [(False, ("error", f"{type(e).__name__}: {e}"))] * len(batch)
+        finally:
+            # 无论成功、出错还是被取消都要完成每个任务的 future，否则 run() 会一直等待
+            finished_at = time.perf_counter()
+            for index, (kind, _, future, queued_at) in enumerate(batch):
+                if self.metrics is not None:
+                    self.metrics.observe("media_stage", finished_at - queued_at, job=kind)
+                if not future.done():
+                    future.set_result(results[index] if index < len(results) else (False, ("error", "媒体处理批次未完成")))
+
+    async def stop(self):
+        """分发剩余任务并等待完成，然后关闭进程池"""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "processes": self.processes,
+            "jobs": self.jobs,
+            "batches": self.batches,
+            "failures": self.failures,
+            "restarts": self.restarts,
+            "pending": len(self._pending),
+        }
+
+
+class MediaBudget:
+    """进程级在途媒体字节预算
+
+    媒体任务开始前按预计占用的字节数申请额度，总量超过上限时新任务等待已有任务释放，
+    而不是继续分配内存。单个任务超过上限时，只要当前没有其他在途任务就放行，避免永久等待。
+    同时记录在途字节峰值。max_bytes 为 0 时不限制，只做统计。
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max(0, int(max_bytes))
+        self.in_use = 0
+        self.peak = 0
+        self.active = 0
+        self.waits = 0
+        self.total_wait = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+
+    def _fits(self, size: int) -> bool:
+        return not self.max_bytes or self.active == 0 or self.in_use + size <= self.max_bytes
+
+    async def acquire(self, size: int):
+        if not self._fits(size):
+            if self._condition is None:
+                self._condition = asyncio.Condition()
+            self.waits += 1
+            started_at = time.monotonic()
+            async with self._condition:
+                await self._condition.wait_for(lambda: self._fits(size))
+            self.total_wait += time.monotonic() - started_at
+        self.in_use += size
+        self.active += 1
+        self.peak = max(self.peak, self.in_use)
+
+    async def release(self, size: int):
+        self.in_use -= size
+        self.active -= 1
+        if self._condition is not None:
+            async with self._condition:
+                self._condition.notify_all()
+
+    def reserve(self, size: int) -> "_BudgetReservation":
+        """async with budget.reserve(n): ... 在代码块期间占用 n 字节额度"""
+        return _BudgetReservation(self, size)
+
+    def stats(self) -> dict:
+        return {
+            "max_bytes": self.max_bytes,
+            "in_use_bytes": self.in_use,
+            "peak_bytes": self.peak,
+            "active": self.active,
+            "waits": self.waits,
+            "total_wait_s": round(self.total_wait, 3),
+        }
+
+
+class _BudgetReservation:
+    __slots__ = ("budget", "size")
+
+    def __init__(self, budget: MediaBudget, size: int):
+        self.budget = budget
+        self.size = size
+
+    async def __aenter__(self):
+        await self.budget.acquire(self.size)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.budget.release(self.size)
+
+
+class TempDirJanitor:
+    """临时目录清理与磁盘配额
+
+    按修改时间清理超过 max_age 的遗留文件（进程崩溃、被 kill 或 ffmpeg 卡住时 finally 未执行留下的视频），
+    启动时清理一次，之后定期清理。插件自己正在使用的文件登记在 active 中，清理时跳过。
+    设置了 quota 时，目录总大小达到配额后新的媒体任务在 wait_for_space() 中等待：
+    等待期间每秒重新清理一次（此时删除所有未在使用的文件，不再看文件年龄），直到低于配额或等待超时。
+    """
+
+    # 超出配额时重新检查的间隔秒数
+    QUOTA_RECHECK_INTERVAL = 1.0
+
+    def __init__(self, directory: Path, max_age: float = 1800.0, interval: float = 300.0,
+                 quota_bytes: int = 0, quota_wait_timeout: float = 60.0):
+        self.directory = directory
+        self.max_age = float(max_age)
+        self.interval = max(1.0, float(interval))
+        self.quota_bytes = int(quota_bytes)
+        self.quota_wait_timeout = float(quota_wait_timeout)
+        self.active: Dict[str, int] = {}
+        self.usage = 0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        # 统计数据
+        self.sweeps = 0
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self.quota_waits = 0
+        self.quota_timeouts = 0
+
+    @property
+    def over_quota(self) -> bool:
+        return self.quota_bytes > 0 and self.usage >= self.quota_bytes
+
+    def track(self, path: Path, size: int):
+        """登记插件正在使用的临时文件（清理时跳过），并计入目录占用"""
+        self.active[str(path)] = size
+        self.usage += size
+
+    def untrack(self, path: Path):
+        size = self.active.pop(str(path), None)
+        if size is not None:
+            self.usage = max(0, self.usage - size)
+
+    def _sweep(self, force: bool) -> Tuple[int, int, int]:
+        """删除过期（force 时为全部）未在使用的文件，返回 (删除数, 释放字节, 剩余总字节)"""
+        now = time.time()
+        removed = freed = total = 0
+        active = set(self.active)
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0, 0, 0
+        for entry in entries:
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if entry.path not in active and (force or now - st.st_mtime > self.max_age):
+                    os.unlink(entry.path)
+                    removed += 1
+                    freed += st.st_size
+                    continue
+                total += st.st_size
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning(f"[MessageForwarder] 清理临时文件失败: {entry.path} - {e}")
+        return removed, freed, total
+
+    async def sweep(self, force: bool = False):
+        async with self._lock:
+            removed, freed, total = await asyncio.get_running_loop().run_in_executor(None, self._sweep, force)
+        self.sweeps += 1
+        self.usage = total
+        if removed:
+            self.removed_files += removed
+            self.removed_bytes += freed
+            logger.info(f"[MessageForwarder] 已清理 {removed} 个遗留临时文件，释放 {freed / 1024 / 1024:.1f} MB")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[MessageForwarder] 临时目录清理失败: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def wait_for_space(self) -> bool:
+        """目录占用低于配额时立即返回 True；否则等待清理或其他任务释放空间，超时返回 False"""
+        if not self.over_quota:
+            return True
+        self.quota_waits += 1
+        logger.warning(f"[MessageForwarder] 临时目录占用 {self.usage / 1024 / 1024:.1f} MB 已达到配额，媒体任务等待")
+        deadline = time.monotonic() + self.quota_wait_timeout
+        while True:
+            await self.sweep(force=True)
+            if not self.over_quota:
+                return True
+            if time.monotonic() >= deadline:
+                self.quota_timeouts += 1
+                return False
+            await asyncio.sleep(self.QUOTA_RECHECK_INTERVAL)
+
+    def stats(self) -> dict:
+        return {
+            "usage_bytes": self.usage,
+            "quota_bytes": self.quota_bytes,
+            "over_quota": int(self.over_quota),
+            "active_files": len(self.active),
+            "sweeps": self.sweeps,
+            "removed_files": self.removed_files,
+            "removed_bytes": self.removed_bytes,
+            "quota_waits": self.quota_waits,
+            "quota_timeouts": self.quota_timeouts,
+        }
+
+
+class MediaCache:
+    """按内容摘要索引的媒体缓存
+
+    - 缩略图：摘要 -> JPEG 字节，内存中按 LRU 淘汰并受字节预算限制，可选落盘作为二级缓存
+    - 转发标记：(摘要, 目标) -> 过期时间，用于跳过 N 分钟内已发往同一目标的相同媒体
+    """
+
+    def __init__(self, max_memory_bytes: int = 32 * 1024 * 1024, max_entries: int = 1024,
+                 disk_dir: Optional[Path] = None, max_disk_bytes: int = 256 * 1024 * 1024,
+                 forward_ttl: float = 0.0, max_forward_markers: int = 10000):
+        self.max_memory_bytes = max(0, int(max_memory_bytes))
+        self.max_entries = max(1, int(max_entries))
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max(0, int(max_disk_bytes))
+        self.forward_ttl = float(forward_ttl)
+        self.max_forward_markers = max(1, int(max_forward_markers))
+        self._thumbnails: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._forwarded: "OrderedDict[tuple, float]" = OrderedDict()
+        # 磁盘层占用字节数：写入时增量累计，超出预算时才扫描目录
+        self._disk_bytes = 0
+        # 统计数据
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.duplicate_skips = 0
+        self.disk_scans = 0
+        if self.disk_dir is not None:
+            try:
+                self.disk_dir.mkdir(parents=True, exist_ok=True)
+                self._disk_bytes = sum(size for _, size, _ in self._scan_disk())
+            except Exception as e:
+                logger.error(f"[MessageForwarder] 创建媒体缓存目录失败，禁用磁盘缓存: {e}")
+                self.disk_dir = None
+
+    @staticmethod
+    def digest(data) -> str:
+        """计算内容摘要（直接对 base64 字符串、文本或字节计算，无需先解码）
+
+        字符串按块以 UTF-8 编码后增量计算，保留全部字符（base64 的摘要与其 ASCII 字节相同），
+        不会为大 base64 字符串复制出一份完整的字节串。
+        """
+        if not isinstance(data, str):
+            return hashlib.blake2b(data, digest_size=16).hexdigest()
+        hasher = hashlib.blake2b(digest_size=16)
+        for offset in range(0, len(data), MEDIA_CHUNK_CHARS):
+            hasher.update(data[offset:offset + MEDIA_CHUNK_CHARS].encode("utf-8"))
+        return hasher.hexdigest()
+
+    def get_thumbnail(self, digest: str) -> Optional[bytes]:
+        data = self._thumbnails.get(digest)
+        if data is not None:
+            self._thumbnails.move_to_end(digest)
+            self.hits += 1
+            return data
+        if self.disk_dir is not None:
+            path = self.disk_dir / f"{digest}.jpg"
+            try:
+                data = path.read_bytes()
+                os.utime(path)  # 刷新 mtime，磁盘层按 mtime 近似 LRU
+                self.disk_hits += 1
+                self._remember(digest, data)
+                return data
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"[MessageForwarder] 读取磁盘缓存失败: {e}")
+        self.misses += 1
+        return None
+
+    def put_thumbnail(self, digest: str, data: bytes):
+        if not data:
+            return
+        self._remember(digest, data)
+        if self.disk_dir is not None:
+            path = self.disk_dir / f"{digest}.jpg"
+            try:
+                try:
+                    self._disk_bytes -= path.stat().st_size
+                except FileNotFoundError:
+                    pass
+                path.write_bytes(data)
+                self._disk_bytes += len(data)
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._trim_disk()
+            except Exception as e:
+                logger.warning(f"[MessageForwarder] 写入磁盘缓存失败: {e}")
+
+    def _remember(self, digest: str, data: bytes):
+        if len(data) > self.max_memory_bytes:
+            return
+        old = self._thumbnails.pop(digest, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._thumbnails[digest] = data
+        self._memory_bytes += len(data)
+        while self._thumbnails and (self._memory_bytes > self.max_memory_bytes or len(self._thumbnails) > self.max_entries):
+            _, evicted = self._thumbnails.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.evictions += 1
+
+    def _scan_disk(self) -> List[tuple]:
+        files = []
+        for path in self.disk_dir.glob("*.jpg"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _trim_disk(self):
+        """磁盘层超出预算时按 mtime 删除最旧的文件，降到预算的 90%，避免每次写入都扫描目录"""
+        self.disk_scans += 1
+        files = self._scan_disk()
+        total = sum(size for _, size, _ in files)
+        if total > self.max_disk_bytes:
+            low_water = self.max_disk_bytes * 0.9
+            files.sort()
+            for _, size, path in files:
+                if total <= low_water:
+                    break
+                try:
+                    path.unlink()
+                    total -= size
+                    self.evictions += 1
+                except FileNotFoundError:
+                    pass
+        self._disk_bytes = total
+
+    def was_forwarded(self, digest: str, target_wxid: str) -> bool:
+        """检查相同媒体是否在有效期内已发往该目标"""
+        if self.forward_ttl <= 0:
+            return False
+        key = (digest, target_wxid)
+        expires_at = self._forwarded.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._forwarded[key]
+            return False
+        self.duplicate_skips += 1
+        return True
+
+    def mark_forwarded(self, digest: str, target_wxid: str):
+        if self.forward_ttl <= 0:
+            return
+        key = (digest, target_wxid)
+        self._forwarded.pop(key, None)
+        self._forwarded[key] = time.monotonic() + self.forward_ttl
+        while len(self._forwarded) > self.max_forward_markers:
+            self._forwarded.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "duplicate_skips": self.duplicate_skips,
+            "entries": len(self._thumbnails),
+            "memory_bytes": self._memory_bytes,
+            "disk_bytes": self._disk_bytes,
+            "disk_scans": self.disk_scans,
+        }
+
+
+class TextCoalescer:
+    """文本突发合并（摘要模式）
+
+    按 (来源, 目标) 缓冲文本，时间窗口到期、累计字符数或条数达到阈值时（以先到者为准）
+    合并为一条带发送者前缀的消息发出，减少活跃群聊中的出站 API 调用次数。
+    window 即单条文本的最大额外延迟。
+    """
+
+    def __init__(self, flush_func, window: float = 3.0, max_chars: int = 2000, max_count: int = 20,
+                 prefix_sender: bool = True, raw_single: bool = True):
+        # flush_func(source, target, text, count, context) 为协程函数
+        self.flush_func = flush_func
+        self.window = max(0.0, float(window))
+        self.max_chars = max(1, int(max_chars))
+        self.max_count = max(1, int(max_count))
+        self.prefix_sender = prefix_sender
+        # 只有一条时是否按原文发送（不带发送者前缀）
+        self.raw_single = raw_single
+        self._buffers: Dict[tuple, dict] = {}
+        self._tasks = set()
+        # 统计数据
+        self.messages_in = 0
+        self.flushes = 0
+        self.flush_reasons = {"window": 0, "chars": 0, "count": 0, "shutdown": 0}
+
+    def add(self, source: str, target: str, sender: str, text: str, context=None):
+        """加入一条文本；达到阈值时立即触发发送"""
+        self.messages_in += 1
+        key = (source, target)
+        line = f"{sender}: {text}" if self.prefix_sender and sender else text
+        buffer = self._buffers.get(key)
+        if buffer is not None and buffer["chars"] + len(line) + 1 > self.max_chars:
+            self._flush(key, "chars")
+            buffer = None
+        if buffer is None:
+            loop = asyncio.get_running_loop()
+            buffer = {
+                "lines": [],
+                "raw": [],
+                "chars": 0,
+                "context": context,
+                "timer": loop.call_later(self.window, self._flush, key, "window"),
+            }
+            self._buffers[key] = buffer
+        buffer["lines"].append(line)
+        buffer["raw"].append(text)
+        buffer["chars"] += len(line) + 1
+        buffer["context"] = context
+        if len(buffer["lines"]) >= self.max_count:
+            self._flush(key, "count")
+        elif buffer["chars"] >= self.max_chars:
+            self._flush(key, "chars")
+
+    def _flush(self, key: tuple, reason: str):
+        buffer = self._buffers.pop(key, None)
+        if buffer is None:
+            return
+        buffer["timer"].cancel()
+        count = len(buffer["lines"])
+        # 只有一条时按原文发送，与未合并时一致
+        text = buffer["raw"][0] if count == 1 and self.raw_single else "\n".join(buffer["lines"])
+        self.flushes += 1
+        self.flush_reasons[reason] += 1
+        task = asyncio.get_running_loop().create_task(
+            self.flush_func(key[0], key[1], text, count, buffer["context"])
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush_all(self):
+        """立即发送所有缓冲中的文本（插件停用时调用）"""
+        for key in list(self._buffers):
+            self._flush(key, "shutdown")
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "messages_in": self.messages_in,
+            "flushes": self.flushes,
+            "flush_reasons": dict(self.flush_reasons),
+            "buffered": sum(len(buffer["lines"]) for buffer in self._buffers.values()),
+        }
+
+
+class NameResolver:
+    """联系人/群名称解析缓存（TTL + LRU）
+
+    来源标注需要群名与发送者昵称，逐条消息调用 API 查询会使出站调用翻倍。
+    名称缓存在有界的 LRU 字典中，查到的名称按 ttl 过期，查询失败或查不到时缓存空串 negative_ttl 秒。
+    未命中时：联系人查询在 batch_window 内攒批（最多 batch_size 个），合并为一次批量联系人查询；
+    群成员按群合并为一次成员列表查询，一次调用即缓存整个群的成员显示名。
+    同一 wxid（或同一个群）已有查询在途时，后来的请求直接等待同一个查询结果。
+    """
+
+    def __init__(self, fetch_contacts, fetch_members, ttl: float = 3600.0, negative_ttl: float = 300.0,
+                 max_entries: int = 10000, batch_size: int = 20, batch_window: float = 0.02, timeout: float = 5.0):
+        # fetch_contacts(wxids) -> {wxid: 名称}；fetch_members(chatroom) -> {wxid: 群内显示名}，均为协程函数
+        self.fetch_contacts = fetch_contacts
+        self.fetch_members = fetch_members
+        self.ttl = float(ttl)
+        self.negative_ttl = float(negative_ttl)
+        self.max_entries = max(1, int(max_entries))
+        self.batch_size = max(1, int(batch_size))
+        self.batch_window = max(0.0, float(batch_window))
+        self.timeout = float(timeout)
+        # 键: ("c", wxid) 联系人/群名称，("m", chatroom, wxid) 群成员显示名；值: (名称, 过期时间)
+        self._cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        # 在途查询：("c", wxid) / ("r", chatroom) -> Future
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._pending: List[str] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        # 统计数据
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self.contact_batches = 0
+        self.contact_lookups = 0
+        self.member_queries = 0
+        self.errors = 0
+        self.evictions = 0
+
+    def _get(self, key: tuple) -> Optional[str]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return entry[0]
+
+    def _put(self, key: tuple, name: str):
+        self._cache[key] = (name, time.monotonic() + (self.ttl if name else self.negative_ttl))
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def contact(self, wxid: str) -> str:
+        """联系人昵称或群名称；查不到时返回空串"""
+        if not wxid:
+            return ""
+        name = self._get(("c", wxid))
+        if name is not None:
+            self.hits += 1
+            return name
+        self.misses += 1
+        return await asyncio.shield(self._contact_future(wxid))
+
+    async def member(self, chatroom: str, wxid: str) -> str:
+        """群成员的群内显示名（未设置时为昵称）；查不到时返回空串"""
+        if not chatroom or not wxid:
+            return ""
+        key = ("m", chatroom, wxid)
+        name = self._get(key)
+        if name is not None:
+            self.hits += 1
+            return name
+        self.misses += 1
+        await asyncio.shield(self._room_future(chatroom))
+        name = self._get(key)
+        if name is None:
+            # 成员列表中没有该成员（或查询失败），短期内不再为它重新查询整个群
+            name = ""
+            self._put(key, name)
+        return name
+
+    def cached(self, wxid: str, chatroom: str = "") -> Optional[str]:
+        """只读缓存、不等待：命中返回名称；未命中返回 None，并在后台发起查询供后续消息使用"""
+        key = ("m", chatroom, wxid) if chatroom else ("c", wxid)
+        name = self._get(key)
+        if name is not None:
+            self.hits += 1
+            return name
+        self._spawn(self.member(chatroom, wxid) if chatroom else self.contact(wxid))
+        return None
+
+    async def warm(self, wxids) -> int:
+        """预热：批量查询所有 wxid 的名称，并加载其中群聊的成员列表；返回缓存条目数"""
+        wxids = list(dict.fromkeys(wxid for wxid in wxids if wxid))
+        futures = [self._contact_future(wxid) for wxid in wxids if self._get(("c", wxid)) is None]
+        futures += [self._room_future(wxid) for wxid in wxids if wxid.endswith("@chatroom")]
+        if futures:
+            await asyncio.gather(*(asyncio.shield(future) for future in futures))
+        return len(self._cache)
+
+    def _contact_future(self, wxid: str) -> asyncio.Future:
+        key = ("c", wxid)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.merged += 1
+            return future
+        loop = asyncio.get_running_loop()
+        future = self._inflight[key] = loop.create_future()
+        self._pending.append(wxid)
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            batch, self._pending = self._pending, []
+            self._spawn(self._fetch_contacts(batch))
+
+    def _settle(self, key: tuple, result):
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    async def _fetch_contacts(self, wxids: List[str]):
+        self.contact_batches += 1
+        self.contact_lookups += len(wxids)
+        names = {}
+        try:
+            names = await asyncio.wait_for(self.fetch_contacts(wxids), self.timeout) or {}
+        except asyncio.TimeoutError:
+            self.errors += 1
+            logger.warning(f"[MessageForwarder] 批量查询联系人名称超时 ({len(wxids)} 个)")
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"[MessageForwarder] 批量查询联系人名称失败 ({len(wxids)} 个): {e}")
+        finally:
+            for wxid in wxids:
+                name = names.get(wxid) or ""
+                self._put(("c", wxid), name)
+                self._settle(("c", wxid), name)
+
+    def _room_future(self, chatroom: str) -> asyncio.Future:
+        key = ("r", chatroom)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.merged += 1
+            return future
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        self._spawn(self._fetch_room(chatroom))
+        return future
+
+    async def _fetch_room(self, chatroom: str):
+        self.member_queries += 1
+        members = {}
+        try:
+            members = await asyncio.wait_for(self.fetch_members(chatroom), self.timeout) or {}
+        except asyncio.TimeoutError:
+            self.errors += 1
+            logger.warning(f"[MessageForwarder] 查询群成员列表超时 ({chatroom})")
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"[MessageForwarder] 查询群成员列表失败 ({chatroom}): {e}")
+        finally:
+            for wxid, name in members.items():
+                self._put(("m", chatroom, wxid), name or "")
+            self._settle(("r", chatroom), len(members))
+
+    async def stop(self):
+        """取消在途查询，等待中的请求得到空串"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending = []
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        for key in list(self._inflight):
+            self._settle(key, "" if key[0] == "c" else 0)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "merged": self.merged,
+            "contact_batches": self.contact_batches,
+            "contact_lookups": self.contact_lookups,
+            "member_queries": self.member_queries,
+            "errors": self.errors,
+            "evictions": self.evictions,
+            "in_flight": len(self._inflight),
+        }
+
+
+class DurableOutbox:
+    """基于 SQLite (WAL 模式) 的持久化发件箱
+
+    待发送的转发在发送前写入 outbox 表，成功后删除；失败的记录按带抖动的指数退避重试，
+    超过最大次数后移入 dead_letter 表，保留 dead_letter_retention 秒后删除并释放其媒体引用。
+    超过 inline_limit 的大参数（如视频 base64）按内容摘要另存到 media_dir，表中只保存引用，数据库保持小巧。
+    所有数据库操作都在单线程执行器中串行执行，不阻塞事件循环。
+    """
+
+    def __init__(self, db_path: Path, media_dir: Path, max_attempts: int = 8, base_delay: float = 2.0,
+                 max_delay: float = 600.0, inline_limit: int = 64 * 1024, lease_seconds: float = 300.0,
+                 dead_letter_retention: float = 7 * 86400.0):
+        self.db_path = db_path
+        self.media_dir = media_dir
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self.inline_limit = int(inline_limit)
+        # 首次发送期间记录被"租用"的时长，避免重试任务与首次发送同时进行
+        self.lease_seconds = float(lease_seconds)
+        # 死信保留秒数，0 表示永久保留（其媒体文件也不会删除）
+        self.dead_letter_retention = float(dead_letter_retention)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="MessageForwarderOutbox")
+        self._conn: Optional[sqlite3.Connection] = None
+        # 统计数据
+        self.enqueued = 0
+        self.completed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.dead_letters_purged = 0
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def open(self) -> int:
+        """打开数据库并把上次运行遗留的记录标记为立即可重放，返回遗留记录数"""
+        return await self._run(self._open)
+
+    def _open(self) -> int:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.media_dir.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                action TEXT NOT NULL,
+                target TEXT NOT NULL,
+                source TEXT NOT NULL,
+                msg_type INTEGER,
+                payload TEXT NOT NULL,
+                refs TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                last_error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at);
+            CREATE TABLE IF NOT EXISTS dead_letter (
+                id INTEGER PRIMARY KEY,
+                action TEXT NOT NULL,
+                target TEXT NOT NULL,
+                source TEXT NOT NULL,
+                msg_type INTEGER,
+                payload TEXT NOT NULL,
+                refs TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                failed_at REAL NOT NULL,
+                last_error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS media_refs (
+                digest TEXT PRIMARY KEY,
+                refcount INTEGER NOT NULL
+            );
+        """)
+        pending = conn.execute("UPDATE outbox SET next_attempt_at = 0").rowcount
+        conn.commit()
+        self._conn = conn
+        self._purge_dead_letters()
+        return pending
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+    def _encode(self, value, refs: list):
+        """大字符串/字节另存为媒体文件，返回可 JSON 序列化的值"""
+        if isinstance(value, bytes):
+            value = base64.b64encode(value).decode("ascii")
+        if isinstance(value, str) and len(value) > self.inline_limit:
+            digest = MediaCache.digest(value)
+            path = self.media_dir / digest
+            if not path.exists():
+                tmp_path = self.media_dir / f"{digest}.{uuid.uuid4().hex}.tmp"
+                try:
+                    tmp_path.write_text(value, encoding="utf-8")
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    tmp_path.unlink(missing_ok=True)
+                    raise
+            refs.append(digest)
+            return {"$ref": digest}
+        return value
+
+    def _decode(self, value):
+        if isinstance(value, dict) and "$ref" in value:
+            return (self.media_dir / value["$ref"]).read_text(encoding="utf-8")
+        return value
+
+    async def add(self, action: str, target: str, source: str, msg_type, args, kwargs) -> int:
+        """记录一条待发送的转发，返回记录 id"""
+        return await self._run(self._add, action, target, source, msg_type, args, kwargs)
+
+    def _add(self, action, target, source, msg_type, args, kwargs) -> int:
+        refs = []
+        payload = json.dumps({
+            "args": [self._encode(value, refs) for value in args],
+            "kwargs": {key: self._encode(value, refs) for key, value in kwargs.items()},
+        }, ensure_ascii=False)
+        now = time.time()
+        conn = self._conn
+        with conn:
+            for digest in refs:
+                conn.execute(
+                    "INSERT INTO media_refs (digest, refcount) VALUES (?, 1) "
+                    "ON CONFLICT(digest) DO UPDATE SET refcount = refcount + 1",
+                    (digest,)
+                )
+            cursor = conn.execute(
+                "INSERT INTO outbox (action, target, source, msg_type, payload, refs, attempts, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)",
+                (action, target, source, msg_type if isinstance(msg_type, int) else None, payload,
+                 json.dumps(refs), now + self.lease_seconds, now)
+            )
+        self.enqueued += 1
+        return cursor.lastrowid
+
+    async def complete(self, item_id: int):
+        """发送成功，删除记录并释放媒体引用"""
+        try:
+            await self._run(self._complete, item_id)
+            self.completed += 1
+        except Exception as e:
+            logger.error(f"[MessageForwarder] 更新发件箱失败: {e}")
+
+    def _complete(self, item_id: int):
+        conn = self._conn
+        with conn:
+            row = conn.execute("SELECT refs FROM outbox WHERE id = ?", (item_id,)).fetchone()
+            conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+            if row:
+                self._release_refs(conn, json.loads(row[0]))
+
+    def _release_refs(self, conn: sqlite3.Connection, refs: list):
+        for digest in refs:
+            conn.execute("UPDATE media_refs SET refcount = refcount - 1 WHERE digest = ?", (digest,))
+            row = conn.execute("SELECT refcount FROM media_refs WHERE digest = ?", (digest,)).fetchone()
+            if row and row[0] <= 0:
+                conn.execute("DELETE FROM media_refs WHERE digest = ?", (digest,))
+                try:
+                    (self.media_dir / digest).unlink()
+                except FileNotFoundError:
+                    pass
+
+    def backoff(self, attempts: int) -> float:
+        """带抖动的指数退避：上限内的退避时间取其一半加上随机的另一半"""
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempts - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def fail(self, item_id: int, attempts: int, error: str) -> bool:
+        """记录一次发送失败；超过最大次数时移入死信表并返回 True"""
+        dead = await self._run(self._fail, item_id, attempts, error)
+        if dead:
+            self.dead_lettered += 1
+        else:
+            self.retried += 1
+        return dead
+
+    def _fail(self, item_id: int, attempts: int, error: str) -> bool:
+        conn = self._conn
+        now = time.time()
+        with conn:
+            if attempts >= self.max_attempts:
+                conn.execute(
+                    "INSERT OR REPLACE INTO dead_letter (id, action, target, source, msg_type, payload, refs, attempts, created_at, failed_at, last_error) "
+                    "SELECT id, action, target, source, msg_type, payload, refs, ?, created_at, ?, ? FROM outbox WHERE id = ?",
+                    (attempts, now, error, item_id)
+                )
+                conn.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+                return True
+            conn.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (attempts, now + self.backoff(attempts), error, item_id)
+            )
+            return False
+
+    async def purge_dead_letters(self) -> int:
+        """删除超过保留期的死信并释放其媒体引用，返回删除条数"""
+        return await self._run(self._purge_dead_letters)
+
+    def _purge_dead_letters(self) -> int:
+        if self.dead_letter_retention <= 0:
+            return 0
+        conn = self._conn
+        with conn:
+            rows = conn.execute(
+                "SELECT id, refs FROM dead_letter WHERE failed_at < ?",
+                (time.time() - self.dead_letter_retention,)
+            ).fetchall()
+            for item_id, refs in rows:
+                conn.execute("DELETE FROM dead_letter WHERE id = ?", (item_id,))
+                self._release_refs(conn, json.loads(refs))
+        self.dead_letters_purged += len(rows)
+        return len(rows)
+
+    async def due(self, limit: int, exclude=()) -> List[dict]:
+        """取出到期待重试的记录（按 id 顺序），并解析出发送参数"""
+        return await self._run(self._due, limit, tuple(exclude))
+
+    def _due(self, limit: int, exclude: tuple) -> List[dict]:
+        rows = self._conn.execute(
+            "SELECT id, action, target, source, msg_type, payload, attempts FROM outbox "
+            "WHERE next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (time.time(), limit + len(exclude))
+        ).fetchall()
+        items = []
+        for item_id, action, target, source, msg_type, payload, attempts in rows:
+            if item_id in exclude:
+                continue
+            try:
+                data = json.loads(payload)
+                args = [self._decode(value) for value in data["args"]]
+                kwargs = {key: self._decode(value) for key, value in data["kwargs"].items()}
+            except Exception as e:
+                logger.error(f"[MessageForwarder] 发件箱记录 {item_id} 已损坏，移入死信表: {e}")
+                self._fail(item_id, self.max_attempts, f"记录损坏: {e}")
+                self.dead_lettered += 1
+                continue
+            items.append({
+                "id": item_id, "action": action, "target": target, "source": source,
+                "msg_type": msg_type, "args": args, "kwargs": kwargs, "attempts": attempts,
+            })
+            if len(items) >= limit:
+                break
+        return items
+
+    def stats(self) -> dict:
+        return {
+            "enqueued": self.enqueued,
+            "completed": self.completed,
+            "retried": self.retried,
+            "dead_lettered": self.dead_lettered,
+            "dead_letters_purged": self.dead_letters_purged,
+        }
+
+
+class TrafficRecorder:
+    """处理器入口流量录制器：仅追加的 JSONL 轨迹，媒体按内容摘要单独存储
+
+    热路径只把 (时间, 处理器, 消息浅拷贝) 追加到内存缓冲区，不做序列化和 IO；后台任务定期把缓冲区
+    交给单线程执行器，在那里把超过 inline_limit 的字符串（base64 媒体、大段 XML）写入 media 目录
+    （相同内容只写一次），轨迹中只保存 {"$ref": 摘要}，再以紧凑 JSON 逐行追加到 trace.jsonl。
+    缓冲区写满（磁盘跟不上）或轨迹超过大小上限时丢弃新记录并计数，录制不会阻塞消息处理。
+
+    轨迹每行格式: {"t": 收到时间(Unix 秒), "h": 处理器("text"/"image"/"video"/"xml"/"other"), "m": 消息}
+    """
+
+    TRACE_FILE = "trace.jsonl"
+    MEDIA_DIR = "media"
+
+    def __init__(self, directory: Path, flush_interval: float = 1.0, max_buffer: int = 10000,
+                 inline_limit: int = 4096, max_trace_bytes: int = 0):
+        self.directory = directory
+        self.flush_interval = float(flush_interval)
+        self.max_buffer = max(1, int(max_buffer))
+        self.inline_limit = int(inline_limit)
+        self.max_trace_bytes = int(max_trace_bytes)
+        self._buffer: List[tuple] = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="MessageForwarderRecorder")
+        self._file = None
+        self._task: Optional[asyncio.Task] = None
+        self._known_media = set()
+        self.full = False
+        # 统计数据
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.trace_bytes = 0
+        self.media_files = 0
+        self.media_bytes = 0
+
+    def record(self, handler: str, message: dict):
+        """在处理器入口调用：只做一次浅拷贝和列表追加"""
+        if self.full or len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self._buffer.append((time.time(), handler, dict(message)))
+        self.recorded += 1
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def start(self):
+        await self._run(self._open)
+        self._task = asyncio.create_task(self._flush_loop())
+
+    def _open(self):
+        media_dir = self.directory / self.MEDIA_DIR
+        media_dir.mkdir(parents=True, exist_ok=True)
+        self._known_media = {path.name for path in media_dir.iterdir()}
+        self._file = open(self.directory / self.TRACE_FILE, "a", encoding="utf-8")
+        self.trace_bytes = self._file.tell()
+
+    async def stop(self):
+        """停止后台任务，写出缓冲区中剩余的记录并关闭文件"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._file is not None:
+            await self._run(self._file.close)
+            self._file = None
+        self._executor.shutdown(wait=False)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[MessageForwarder] 写入流量轨迹失败: {e}")
+
+    async def flush(self):
+        if not self._buffer or self._file is None:
+            return
+        batch, self._buffer = self._buffer, []
+        await self._run(self._write, batch)
+
+    def _write(self, batch: List[tuple]):
+        lines = []
+        for received_at, handler, message in batch:
+            record = {"t": round(received_at, 3), "h": handler, "m": self._encode(message)}
+            lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str))
+        data = "\n".join(lines) + "\n"
+        self._file.write(data)
+        self._file.flush()
+        self.written += len(batch)
+        self.trace_bytes += len(data.encode("utf-8"))
+        if self.max_trace_bytes and self.trace_bytes >= self.max_trace_bytes and not self.full:
+            self.full = True
+            logger.warning(f"[MessageForwarder] 流量轨迹已达到大小上限，停止录制: {self.directory / self.TRACE_FILE}")
+
+    def _encode(self, value):
+        """大字符串按摘要另存（相同内容只写一次），返回可 JSON 序列化的值"""
+        if isinstance(value, dict):
+            return {key: self._encode(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._encode(item) for item in value]
+        if isinstance(value, bytes):
+            value = base64.b64encode(value).decode("ascii")
+        if isinstance(value, str) and len(value) > self.inline_limit:
+            digest = MediaCache.digest(value)
+            if digest not in self._known_media:
+                media_dir = self.directory / self.MEDIA_DIR
+                tmp_path = media_dir / f"{digest}.{uuid.uuid4().hex}.tmp"
+                tmp_path.write_text(value, encoding="utf-8")
+                os.replace(tmp_path, media_dir / digest)
+                self._known_media.add(digest)
+                self.media_files += 1
+                self.media_bytes += len(value)
+            return {"$ref": digest}
+        return value
+
+    @classmethod
+    def read(cls, directory: Path):
+        """按顺序读取轨迹，逐条返回 (收到时间, 处理器, 消息)；媒体引用替换为原内容（相同摘要只读一次）"""
+        directory = Path(directory)
+        media_dir = directory / cls.MEDIA_DIR
+        media: Dict[str, str] = {}
+
+        def decode(value):
+            if isinstance(value, dict):
+                if len(value) == 1 and "$ref" in value:
+                    digest = value["$ref"]
+                    if digest not in media:
+                        media[digest] = (media_dir / digest).read_text(encoding="utf-8")
+                    return media[digest]
+                return {key: decode(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [decode(item) for item in value]
+            return value
+
+        with open(directory / cls.TRACE_FILE, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程被强制结束时最后一行可能不完整
+                    continue
+                yield record["t"], record["h"], decode(record["m"])
+
+    def stats(self) -> dict:
+        return {
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "written": self.written,
+            "buffered": len(self._buffer),
+            "trace_bytes": self.trace_bytes,
+            "media_files": self.media_files,
+            "media_bytes": self.media_bytes,
+        }
+
+
+class SenderEndpoint:
+    """发送账号（一个 WechatAPI 客户端）及其健康状态"""
+
+    __slots__ = ("name", "client", "weight", "healthy", "failures", "down_until", "sends", "errors", "failovers", "last_error")
+
+    def __init__(self, name: str, client=None, weight: int = 1):
+        self.name = name
+        self.client = client
+        self.weight = max(1, int(weight))
+        self.healthy = True
+        self.failures = 0  # 连续失败次数
+        self.down_until = 0.0
+        self.sends = 0
+        self.errors = 0
+        self.failovers = 0
+        self.last_error = ""
+
+    def available(self, now: float) -> bool:
+        """健康，或下线冷却已结束（半开状态，允许重新尝试）"""
+        return self.client is not None and (self.healthy or now >= self.down_until)
+
+
+class SenderPool:
+    """多发送账号池
+
+    目标 wxid 通过一致性哈希（带虚拟节点）映射到固定账号，同一目标的消息始终由同一账号发出，保持顺序；
+    账号增减时只有少量目标改变归属。账号被限流、掉线或连续失败时标记下线，
+    其目标顺延到哈希环上的下一个可用账号，冷却结束或健康检查通过后恢复。
+    """
+
+    VIRTUAL_NODES = 64
+
+    def __init__(self, endpoints: List[SenderEndpoint], failure_threshold: int = 3, cooldown: float = 60.0,
+                 failover_keywords=()):
+        self.endpoints = endpoints
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown = float(cooldown)
+        self.failover_keywords = tuple(keyword.lower() for keyword in failover_keywords)
+        ring = []
+        for endpoint in endpoints:
+            for replica in range(self.VIRTUAL_NODES * endpoint.weight):
+                ring.append((self._hash(f"{endpoint.name}#{replica}"), endpoint))
+        ring.sort(key=lambda node: node[0])
+        self._ring_keys = [node[0] for node in ring]
+        self._ring = [node[1] for node in ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def get(self, name: str) -> Optional[SenderEndpoint]:
+        return next((endpoint for endpoint in self.endpoints if endpoint.name == name), None)
+
+    def pick(self, target_wxid: str, exclude=()) -> Optional[SenderEndpoint]:
+        """按一致性哈希选择发送账号，跳过不可用的账号；没有任何可用账号时：
+        未排除任何账号则仍返回目标的归属账号（尽力发送），否则返回 None"""
+        if not self._ring:
+            return None
+        now = time.monotonic()
+        start = bisect.bisect_left(self._ring_keys, self._hash(target_wxid)) % len(self._ring)
+        owner = None
+        visited = set()
+        for offset in range(len(self._ring)):
+            endpoint = self._ring[(start + offset) % len(self._ring)]
+            if endpoint.name in visited:
+                continue
+            visited.add(endpoint.name)
+            if endpoint in exclude or endpoint.client is None:
+                continue
+            if owner is None:
+                owner = endpoint
+            if endpoint.available(now):
+                return endpoint
+            if len(visited) == len(self.endpoints):
+                break
+        return None if exclude else owner
+
+    def is_failover_error(self, error: Exception) -> bool:
+        """是否为需要立即切换账号的错误（限流、掉线等）"""
+        message = str(error).lower()
+        return any(keyword in message for keyword in self.failover_keywords)
+
+    def record_success(self, endpoint: SenderEndpoint):
+        endpoint.sends += 1
+        endpoint.failures = 0
+        if not endpoint.healthy:
+            endpoint.healthy = True
+            logger.info(f"[MessageForwarder] 发送账号 {endpoint.name} 已恢复")
+
+    def record_failure(self, endpoint: SenderEndpoint, error: Exception) -> bool:
+        """记录发送失败，返回是否应立即切换到其他账号重试"""
+        endpoint.errors += 1
+        endpoint.failures += 1
+        endpoint.last_error = str(error)[:200]
+        failover = self.is_failover_error(error)
+        if failover or endpoint.failures >= self.failure_threshold:
+            self.mark_down(endpoint, endpoint.last_error)
+        if failover:
+            endpoint.failovers += 1
+        return failover
+
+    def mark_down(self, endpoint: SenderEndpoint, reason: str):
+        endpoint.down_until = time.monotonic() + self.cooldown
+        if endpoint.healthy:
+            endpoint.healthy = False
+            logger.warning(f"[MessageForwarder] 发送账号 {endpoint.name} 标记为不可用 {self.cooldown:.0f} 秒: {reason}")
+
+    async def check_health(self, timeout: float = 5.0):
+        """通过 heartbeat 接口检查各账号；客户端没有 heartbeat 时只依赖冷却时间恢复"""
+        for endpoint in self.endpoints:
+            heartbeat = getattr(endpoint.client, "heartbeat", None) if endpoint.client is not None else None
+            if heartbeat is None:
+                continue
+            try:
+                alive = await asyncio.wait_for(heartbeat(), timeout=timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.mark_down(endpoint, f"健康检查失败: {e}")
+                continue
+            if alive is False:
+                self.mark_down(endpoint, "健康检查失败: 未登录")
+            elif not endpoint.healthy:
+                endpoint.healthy = True
+                endpoint.failures = 0
+                logger.info(f"[MessageForwarder] 发送账号 {endpoint.name} 健康检查通过，已恢复")
+
+    def stats(self) -> dict:
+        return {
+            "endpoints": len(self.endpoints),
+            "healthy": sum(1 for endpoint in self.endpoints if endpoint.healthy and endpoint.client is not None),
+            "sends": {endpoint.name: endpoint.sends for endpoint in self.endpoints},
+            "errors": {endpoint.name: endpoint.errors for endpoint in self.endpoints},
+            "failovers": {endpoint.name: endpoint.failovers for endpoint in self.endpoints},
+            "up": {endpoint.name: int(endpoint.healthy) for endpoint in self.endpoints},
+        }
+
+
+class AimdLimiter:
+    """单个 (发送动作, 发送账号) 的 AIMD 并发上限
+
+    发送成功且延迟正常、并发已用满时，每次完成把上限加 increase/limit（约每轮往返加 increase）；
+    发送失败或延迟超过基线的 latency_factor 倍（或超过 max_latency）时，上限乘以 decrease_ratio。
+    同一轮往返内只削减一次，避免同一批在途请求的失败被重复计算。
+    基线延迟快速跟随下降、缓慢跟随上升，近似近期的最小延迟。
+    """
+
+    # 开始判断延迟尖峰前需要的成功样本数
+    WARMUP_SAMPLES = 10
+
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 32, increase: float = 1.0,
+                 decrease_ratio: float = 0.5, latency_factor: float = 2.0, max_latency: float = 0.0):
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.limit = float(min(max(int(initial), self.min_limit), self.max_limit))
+        self.increase = float(increase)
+        self.decrease_ratio = float(decrease_ratio)
+        self.latency_factor = float(latency_factor)
+        self.max_latency = float(max_latency)
+        self.in_flight = 0
+        self.baseline: Optional[float] = None
+        self.rtt: Optional[float] = None
+        self.samples = 0
+        self._last_decrease = 0.0
+        self._waiters: deque = deque()
+        # 统计数据
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def idle(self) -> bool:
+        return self.in_flight == 0 and not self._waiters
+
+    async def acquire(self):
+        if not self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 已分配到名额但随即被取消，归还名额
+                self.in_flight -= 1
+                self._wake()
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            raise
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def release(self, latency: Optional[float], ok: bool):
+        """归还名额并按结果调整上限；latency 为 None（如被取消）时不调整"""
+        saturated = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        if latency is not None:
+            self._adjust(latency, ok, saturated)
+        self._wake()
+
+    def _adjust(self, latency: float, ok: bool, saturated: bool):
+        spike = False
+        if ok:
+            self.samples += 1
+            self.rtt = latency if self.rtt is None else self.rtt + 0.2 * (latency - self.rtt)
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += 0.01 * (latency - self.baseline)
+            spike = (self.samples > self.WARMUP_SAMPLES and latency > self.latency_factor * self.baseline) or \
+                (self.max_latency > 0 and latency > self.max_latency)
+        if not ok or spike:
+            now = time.monotonic()
+            if now - self._last_decrease >= (self.rtt or 0.0):
+                self._last_decrease = now
+                new_limit = max(float(self.min_limit), self.limit * self.decrease_ratio)
+                if new_limit < self.limit:
+                    self.limit = new_limit
+                    self.decreases += 1
+        elif saturated and self.limit < self.max_limit:
+            self.limit = min(float(self.max_limit), self.limit + self.increase / self.limit)
+            self.increases += 1
+
+
+class AdaptiveConcurrency:
+    """按 (发送动作, 发送账号) 维护 AIMD 并发上限
+
+    服务端按账号限流，因此同一账号发往所有目标的同类发送共用一个上限；
+    按目标划分时，单个目标的在途数受按来源分片的 worker 数限制，上限无法真正增长。
+    限流器按需创建，数量超过 max_keys 时回收最久未使用且空闲的限流器，指标标签数量因此有上限。
+    """
+
+    def __init__(self, max_keys: int = 1024, **limiter_options):
+        self.max_keys = max(1, int(max_keys))
+        self.limiter_options = limiter_options
+        self._limiters: "OrderedDict[Tuple[str, str], AimdLimiter]" = OrderedDict()
+        self.evicted = 0
+
+    def get(self, action: str, sender: str) -> AimdLimiter:
+        key = (action, sender)
+        limiter = self._limiters.get(key)
+        if limiter is not None:
+            self._limiters.move_to_end(key)
+            return limiter
+        # 先回收再插入，新建的限流器（尚未取得名额，处于空闲状态）不会被立即回收
+        if len(self._limiters) >= self.max_keys:
+            for old_key in [k for k, v in self._limiters.items() if v.idle][:len(self._limiters) - self.max_keys + 1]:
+                del self._limiters[old_key]
+                self.evicted += 1
+        limiter = self._limiters[key] = AimdLimiter(**self.limiter_options)
+        return limiter
+
+    def stats(self) -> dict:
+        limiters = self._limiters.items()
+        return {
+            "limiters": len(self._limiters),
+            "evicted": self.evicted,
+            "increases": sum(limiter.increases for limiter in self._limiters.values()),
+            "decreases": sum(limiter.decreases for limiter in self._limiters.values()),
+            "limit": {f"{action}:{sender}": round(limiter.limit, 2) for (action, sender), limiter in limiters},
+            "in_flight": {f"{action}:{sender}": limiter.in_flight for (action, sender), limiter in limiters},
+            "waiting": {f"{action}:{sender}": len(limiter._waiters) for (action, sender), limiter in limiters},
+        }
+
+
 class MessageForwarder(PluginBase):
     description = "消息转发插件"
     author = "sxkiss"
-    version = "1.2.0"
+    version = "1.3.0"
+
+    # CDN 直接转发：XML 种类 -> 发送动作 / 日志名称
+    CDN_ACTIONS = {"cdn_video": "send_cdn_video_msg", "cdn_image": "send_cdn_img_msg", "file": "send_cdn_file_msg"}
+    CDN_LABELS = {"cdn_video": "视频", "cdn_image": "图片", "file": "文件"}
+    CDN_MEDIA = {"cdn_video": "video", "cdn_image": "image", "file": "file"}
+
+    # 默认优先级类别：文本/名片 > 应用消息 > 图片 > 视频 > 其他
+    DEFAULT_PRIORITY_CLASSES = [
+        {"name": "text", "msg_types": ["text", "card"], "max_pending": 2000, "overflow": "block"},
+        {"name": "app", "msg_types": ["app"], "max_pending": 500, "overflow": "drop_oldest"},
+        {"name": "image", "msg_types": ["image", "emoji"], "max_pending": 200, "overflow": "drop_oldest"},
+        {"name": "video", "msg_types": ["video"], "max_pending": 20, "overflow": "degrade", "degrade": "cdn_or_link"},
+        {"name": "other", "msg_types": [], "max_pending": 500, "overflow": "drop_newest"},
+    ]
 
     def __init__(self):
         super().__init__()
@@ -37,17 +2791,187 @@ class MessageForwarder(PluginBase):
         self.listen_type = "all"
         self.listen_user_wxids = []
         self.listen_group_wxids = []
+        # 重复消息抑制配置
+        self.dedup_enabled = True
+        self.dedup_ttl = 300.0
+        self.dedup_capacity = 50000
+        self.dedup_index: Optional[DedupIndex] = None
+        # XML 分类器（解析结果缓存）
+        self.xml_cache_size = 2048
+        self.xml_classifier = XmlClassifier(self.xml_cache_size)
+        # 热路径读取的编译后配置（路由表等），热更新时整体替换
+        self.compiled = CompiledConfig(RoutingTable([]))
+        # 配置热更新
+        self.hot_reload_enabled = True
+        self.hot_reload_interval = 2.0
+        self._config_stamp = None
+        self._config_watch_task: Optional[asyncio.Task] = None
+        # 出站队列配置
+        self.send_queue_enabled = True
+        self.send_queue_workers = 4
+        self.send_queue_max_size = 500
+        self.send_queue_drain_timeout = 10.0
+        # 优先级类别与过载保护配置（按顺序从高到低）
+        self.priority_enabled = True
+        self.priority_classes_config = self.DEFAULT_PRIORITY_CLASSES
+        self.degrade_notice_template = "[视频] {sender} 发送了一个视频（转发繁忙，已降级为提示）"
+        self.dispatcher: Optional[ForwardDispatcher] = None
+        # 直连 WechatAPI 的共享 HTTP 客户端配置
+        self.http_limit = 100
+        self.http_limit_per_host = 30
+        self.http_keepalive_timeout = 30.0
+        self.http_total_timeout = 30.0
+        self.http_connect_timeout = 5.0
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        # 视频缩略图引擎配置
+        self.thumbnail_max_concurrency = 2
+        self.thumbnail_timeout = 20.0
+        self.thumbnail_fast_seek = True
+        self.thumbnail_seek_time = "00:00:01"
+        self.thumbnail_pipeline = "memfd"
+        self.thumbnail_engine: Optional[ThumbnailEngine] = None
+        # 媒体缓存配置
+        self.media_cache_enabled = True
+        self.media_cache_max_memory_mb = 32
+        self.media_cache_max_entries = 1024
+        self.media_cache_disk_enabled = False
+        self.media_cache_disk_dir = "cache"
+        self.media_cache_max_disk_mb = 256
+        self.media_cache: Optional[MediaCache] = None
+        # CDN 直接转发配置
+        self.cdn_forward_video = True
+        self.cdn_forward_image = True
+        self.cdn_forward_file = True
+        self.cdn_forward_emoji = True
+        self.forward_mode_counts: Dict[str, int] = {}
+        # 多发送账号配置
+        self.sender_pool_enabled = False
+        self.sender_pool_include_primary = True
+        self.sender_pool_senders = []
+        self.sender_pool_failure_threshold = 3
+        self.sender_pool_cooldown = 60.0
+        self.sender_pool_health_interval = 30.0
+        self.sender_pool_health_timeout = 5.0
+        self.sender_pool_failover_keywords = ["频繁", "限制", "登录", "离线", "掉线", "logout", "limit"]
+        self.sender_pool: Optional[SenderPool] = None
+        self._sender_health_task: Optional[asyncio.Task] = None
+        # 自适应发送并发配置（按发送动作与发送账号的 AIMD 上限）
+        self.send_concurrency_enabled = True
+        self.send_concurrency_initial = 4
+        self.send_concurrency_min = 1
+        self.send_concurrency_max = 32
+        self.send_concurrency_increase = 1.0
+        self.send_concurrency_decrease_ratio = 0.5
+        self.send_concurrency_latency_factor = 2.0
+        self.send_concurrency_max_latency = 0.0
+        self.send_concurrency_max_keys = 1024
+        self.send_concurrency: Optional[AdaptiveConcurrency] = None
+        # 低内存媒体模式与在途媒体字节预算
+        self.media_low_memory = False
+        self.media_spool_threshold = 1024 * 1024
+        self.media_budget_mb = 0
+        self.media_budget = MediaBudget()
+        # 媒体进程池配置
+        self.media_pool_enabled = False
+        self.media_pool_processes = 0
+        self.media_pool_batch_size = 4
+        self.media_pool_batch_window_ms = 5
+        self.media_pool_start_method = ""
+        self.image_max_kb = 0
+        self.image_max_side = 0
+        self.image_quality = 85
+        self.media_stage: Optional[MediaStage] = None
+        # 文本合并配置
+        self.text_coalesce_enabled = False
+        self.text_coalesce_window = 3.0
+        self.text_coalesce_max_chars = 2000
+        self.text_coalesce_max_count = 20
+        self.text_coalesce_prefix_sender = True
+        self.text_coalescer: Optional[TextCoalescer] = None
+        # 来源标注与名称解析缓存配置
+        self.attribution_enabled = False
+        self.attribution_group_prefix = "[{group}] {sender}:\n"
+        self.attribution_private_prefix = "[{sender}]:\n"
+        self.attribution_coalesce_header = "[{group}]\n"
+        self.attribution_media_header = False
+        self.attribution_warm = True
+        self.name_cache_ttl = 3600.0
+        self.name_cache_negative_ttl = 300.0
+        self.name_cache_max_entries = 10000
+        self.name_lookup_batch_size = 20
+        self.name_lookup_batch_window_ms = 20
+        self.name_lookup_timeout = 5.0
+        self.name_resolver: Optional[NameResolver] = None
+        self._resolver_bot: Optional[WechatAPIClient] = None
+        self._resolver_warm_task: Optional[asyncio.Task] = None
+        # 持久化发件箱配置
+        self.outbox_enabled = False
+        self.outbox_db_path = "outbox.db"
+        self.outbox_max_attempts = 8
+        self.outbox_base_delay = 2.0
+        self.outbox_max_delay = 600.0
+        self.outbox_replay_batch_size = 50
+        self.outbox_poll_interval = 1.0
+        self.outbox_inline_limit_kb = 64
+        self.outbox_dead_letter_retention_hours = 168
+        self.outbox: Optional[DurableOutbox] = None
+        self._outbox_bot: Optional[WechatAPIClient] = None
+        self._outbox_task: Optional[asyncio.Task] = None
+        self._outbox_inflight = set()
+        # 流量录制配置
+        self.recorder_enabled = False
+        self.recorder_dir = "traces"
+        self.recorder_flush_interval = 1.0
+        self.recorder_max_buffer = 10000
+        self.recorder_inline_limit_kb = 4
+        self.recorder_max_trace_mb = 1024
+        self.recorder: Optional[TrafficRecorder] = None
+        # 指标配置
+        self.metrics_enabled = True
+        self.metrics_http_enabled = False
+        self.metrics_http_host = "127.0.0.1"
+        self.metrics_http_port = 9464
+        self.metrics_snapshot_file = ""
+        self.metrics_snapshot_interval = 60.0
+        self.metrics = Metrics()
+        self._metrics_runner: Optional[aiohttp.web.AppRunner] = None
+        self._metrics_snapshot_task: Optional[asyncio.Task] = None
         # 初始化临时目录
         self.temp_dir = Path(__file__).parent / "temp"
+        # 临时目录清理、配额与 tmpfs 配置
+        self.temp_janitor_enabled = True
+        self.temp_max_age_minutes = 30
+        self.temp_sweep_interval = 300.0
+        self.temp_quota_mb = 2048
+        self.temp_quota_wait = 60.0
+        self.temp_tmpfs = False
+        self.temp_tmpfs_path = "/dev/shm"
+        self.temp_janitor: Optional[TempDirJanitor] = None
         self._ensure_temp_dir()
         self._load_config()
 
+    @staticmethod
+    def _config_path() -> str:
+        return os.path.join(os.path.dirname(__file__), "config.toml")
+
+    def _config_file_stamp(self):
+        """配置文件的 (修改时间, 大小)，文件不存在时返回 None"""
+        try:
+            st = os.stat(self._config_path())
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _read_config_file(self) -> dict:
+        with open(self._config_path(), "rb") as f:
+            return tomli.load(f)
+
     def _load_config(self):
         """加载配置文件"""
-        config_path = os.path.join(os.path.dirname(__file__), "config.toml")
+        config_path = self._config_path()
         if os.path.exists(config_path):
-            with open(config_path, "rb") as f:
-                config = tomli.load(f)
+            self._config_stamp = self._config_file_stamp()
+            config = self._read_config_file()
 
             forwarder_config = config.get("forwarder", {})
             self.target_type = forwarder_config.get("target_type", "user")
@@ -62,6 +2986,157 @@ class MessageForwarder(PluginBase):
             self.listen_user_wxids = listen_source_config.get("listen_user_wxids", [])
             self.listen_group_wxids = listen_source_config.get("listen_group_wxids", [])
             logger.info(f"消息转发插件监听源配置加载成功，监听类型: {self.listen_type}, 监听用户WXID: {self.listen_user_wxids}, 监听群聊WXID: {self.listen_group_wxids}")
+
+            try:
+                self._apply_compiled(CompiledConfig.compile(config))
+                if not len(self.compiled.routing_table):
+                    logger.warning("未配置转发目标WXID或路由规则，无法转发消息。")
+            except (ValueError, TypeError) as e:
+                logger.error(f"路由规则配置错误，保留原有路由表: {e}")
+
+            hot_reload_config = config.get("hot_reload", {})
+            self.hot_reload_enabled = hot_reload_config.get("enable", True)
+            self.hot_reload_interval = float(hot_reload_config.get("poll_interval", 2))
+
+            dedup_config = config.get("dedup", {})
+            self.dedup_enabled = dedup_config.get("enable", True)
+            self.dedup_ttl = float(dedup_config.get("ttl_seconds", 300))
+            self.dedup_capacity = dedup_config.get("capacity", 50000)
+
+            xml_config = config.get("xml_classifier", {})
+            self.xml_cache_size = xml_config.get("cache_size", 2048)
+
+            send_queue_config = config.get("send_queue", {})
+            self.send_queue_enabled = send_queue_config.get("enable", True)
+            self.send_queue_workers = send_queue_config.get("workers", 4)
+            self.send_queue_max_size = send_queue_config.get("max_queue_size", 500)
+            self.send_queue_drain_timeout = float(send_queue_config.get("drain_timeout", 10))
+
+            priority_config = config.get("priority", {})
+            self.priority_enabled = priority_config.get("enable", True)
+            self.priority_classes_config = priority_config.get("classes", self.DEFAULT_PRIORITY_CLASSES)
+            self.degrade_notice_template = priority_config.get("degrade_notice", self.degrade_notice_template)
+
+            http_config = config.get("http_client", {})
+            self.http_limit = http_config.get("limit", 100)
+            self.http_limit_per_host = http_config.get("limit_per_host", 30)
+            self.http_keepalive_timeout = float(http_config.get("keepalive_timeout", 30))
+            self.http_total_timeout = float(http_config.get("total_timeout", 30))
+            self.http_connect_timeout = float(http_config.get("connect_timeout", 5))
+
+            thumbnail_config = config.get("thumbnail", {})
+            self.thumbnail_max_concurrency = thumbnail_config.get("max_concurrency", 2)
+            self.thumbnail_timeout = float(thumbnail_config.get("timeout", 20))
+            self.thumbnail_fast_seek = thumbnail_config.get("fast_seek", True)
+            self.thumbnail_seek_time = thumbnail_config.get("seek_time", "00:00:01")
+            self.thumbnail_pipeline = thumbnail_config.get("pipeline", "memfd")
+
+            sender_pool_config = config.get("sender_pool", {})
+            self.sender_pool_enabled = sender_pool_config.get("enable", False)
+            self.sender_pool_include_primary = sender_pool_config.get("include_primary", True)
+            self.sender_pool_senders = sender_pool_config.get("senders", [])
+            self.sender_pool_failure_threshold = sender_pool_config.get("failure_threshold", 3)
+            self.sender_pool_cooldown = float(sender_pool_config.get("cooldown_seconds", 60))
+            self.sender_pool_health_interval = float(sender_pool_config.get("health_check_interval", 30))
+            self.sender_pool_health_timeout = float(sender_pool_config.get("health_check_timeout", 5))
+            self.sender_pool_failover_keywords = sender_pool_config.get("failover_keywords", self.sender_pool_failover_keywords)
+
+            send_concurrency_config = config.get("send_concurrency", {})
+            self.send_concurrency_enabled = send_concurrency_config.get("enable", True)
+            self.send_concurrency_initial = send_concurrency_config.get("initial_limit", 4)
+            self.send_concurrency_min = send_concurrency_config.get("min_limit", 1)
+            self.send_concurrency_max = send_concurrency_config.get("max_limit", 32)
+            self.send_concurrency_increase = float(send_concurrency_config.get("increase", 1))
+            self.send_concurrency_decrease_ratio = float(send_concurrency_config.get("decrease_ratio", 0.5))
+            self.send_concurrency_latency_factor = float(send_concurrency_config.get("latency_factor", 2))
+            self.send_concurrency_max_latency = float(send_concurrency_config.get("max_latency", 0))
+            self.send_concurrency_max_keys = send_concurrency_config.get("max_keys", 1024)
+
+            cdn_forward_config = config.get("cdn_forward", {})
+            self.cdn_forward_video = cdn_forward_config.get("video", True)
+            self.cdn_forward_image = cdn_forward_config.get("image", True)
+            self.cdn_forward_file = cdn_forward_config.get("file", True)
+            self.cdn_forward_emoji = cdn_forward_config.get("emoji", True)
+
+            media_memory_config = config.get("media_memory", {})
+            self.media_low_memory = media_memory_config.get("low_memory", False)
+            self.media_spool_threshold = int(media_memory_config.get("spool_threshold_kb", 1024) * 1024)
+            self.media_budget_mb = media_memory_config.get("budget_mb", 0)
+
+            temp_dir_config = config.get("temp_dir", {})
+            self.temp_janitor_enabled = temp_dir_config.get("janitor", True)
+            self.temp_max_age_minutes = temp_dir_config.get("max_age_minutes", 30)
+            self.temp_sweep_interval = float(temp_dir_config.get("sweep_interval", 300))
+            self.temp_quota_mb = temp_dir_config.get("quota_mb", 2048)
+            self.temp_quota_wait = float(temp_dir_config.get("quota_wait_seconds", 60))
+            self.temp_tmpfs = temp_dir_config.get("tmpfs", False)
+            self.temp_tmpfs_path = temp_dir_config.get("tmpfs_path", "/dev/shm")
+
+            media_pool_config = config.get("media_pool", {})
+            self.media_pool_enabled = media_pool_config.get("enable", False)
+            self.media_pool_processes = media_pool_config.get("processes", 0)
+            self.media_pool_batch_size = media_pool_config.get("batch_size", 4)
+            self.media_pool_batch_window_ms = media_pool_config.get("batch_window_ms", 5)
+            self.media_pool_start_method = media_pool_config.get("start_method", "")
+            self.image_max_kb = media_pool_config.get("image_max_kb", 0)
+            self.image_max_side = media_pool_config.get("image_max_side", 0)
+            self.image_quality = media_pool_config.get("image_quality", 85)
+
+            media_cache_config = config.get("media_cache", {})
+            self.media_cache_enabled = media_cache_config.get("enable", True)
+            self.media_cache_max_memory_mb = media_cache_config.get("max_memory_mb", 32)
+            self.media_cache_max_entries = media_cache_config.get("max_entries", 1024)
+            self.media_cache_disk_enabled = media_cache_config.get("disk_enable", False)
+            self.media_cache_disk_dir = media_cache_config.get("disk_dir", "cache")
+            self.media_cache_max_disk_mb = media_cache_config.get("max_disk_mb", 256)
+
+            text_coalesce_config = config.get("text_coalesce", {})
+            self.text_coalesce_enabled = text_coalesce_config.get("enable", False)
+            self.text_coalesce_window = float(text_coalesce_config.get("window_seconds", 3))
+            self.text_coalesce_max_chars = text_coalesce_config.get("max_chars", 2000)
+            self.text_coalesce_max_count = text_coalesce_config.get("max_count", 20)
+            self.text_coalesce_prefix_sender = text_coalesce_config.get("prefix_sender", True)
+
+            attribution_config = config.get("attribution", {})
+            self.attribution_enabled = attribution_config.get("enable", False)
+            self.attribution_group_prefix = attribution_config.get("group_prefix", "[{group}] {sender}:\n")
+            self.attribution_private_prefix = attribution_config.get("private_prefix", "[{sender}]:\n")
+            self.attribution_coalesce_header = attribution_config.get("coalesce_header", "[{group}]\n")
+            self.attribution_media_header = attribution_config.get("media_header", False)
+            self.attribution_warm = attribution_config.get("warm_on_enable", True)
+            self.name_cache_ttl = float(attribution_config.get("cache_ttl", 3600))
+            self.name_cache_negative_ttl = float(attribution_config.get("negative_ttl", 300))
+            self.name_cache_max_entries = attribution_config.get("max_entries", 10000)
+            self.name_lookup_batch_size = attribution_config.get("batch_size", 20)
+            self.name_lookup_batch_window_ms = attribution_config.get("batch_window_ms", 20)
+            self.name_lookup_timeout = float(attribution_config.get("lookup_timeout", 5))
+
+            outbox_config = config.get("outbox", {})
+            self.outbox_enabled = outbox_config.get("enable", False)
+            self.outbox_db_path = outbox_config.get("db_path", "outbox.db")
+            self.outbox_max_attempts = outbox_config.get("max_attempts", 8)
+            self.outbox_base_delay = float(outbox_config.get("base_delay", 2))
+            self.outbox_max_delay = float(outbox_config.get("max_delay", 600))
+            self.outbox_replay_batch_size = outbox_config.get("replay_batch_size", 50)
+            self.outbox_poll_interval = float(outbox_config.get("poll_interval", 1))
+            self.outbox_inline_limit_kb = outbox_config.get("inline_limit_kb", 64)
+            self.outbox_dead_letter_retention_hours = outbox_config.get("dead_letter_retention_hours", 168)
+
+            recorder_config = config.get("recorder", {})
+            self.recorder_enabled = recorder_config.get("enable", False)
+            self.recorder_dir = recorder_config.get("dir", "traces")
+            self.recorder_flush_interval = float(recorder_config.get("flush_interval", 1))
+            self.recorder_max_buffer = recorder_config.get("max_buffer", 10000)
+            self.recorder_inline_limit_kb = recorder_config.get("inline_limit_kb", 4)
+            self.recorder_max_trace_mb = recorder_config.get("max_trace_mb", 1024)
+
+            metrics_config = config.get("metrics", {})
+            self.metrics_enabled = metrics_config.get("enable", True)
+            self.metrics_http_enabled = metrics_config.get("http_enable", False)
+            self.metrics_http_host = metrics_config.get("http_host", "127.0.0.1")
+            self.metrics_http_port = metrics_config.get("http_port", 9464)
+            self.metrics_snapshot_file = metrics_config.get("snapshot_file", "")
+            self.metrics_snapshot_interval = float(metrics_config.get("snapshot_interval", 60))
         else:
             logger.warning("消息转发插件配置文件 config.toml 不存在，请检查配置。")
 
@@ -77,177 +3152,1189 @@ class MessageForwarder(PluginBase):
             self.temp_dir.mkdir(parents=True, exist_ok=True)
             logger.warning(f"[MessageForwarder] 使用备用临时目录: {self.temp_dir}")
 
+    def _configure_temp_dir(self):
+        """按配置选择临时目录：启用 tmpfs 时放在 tmpfs_path 下（不可写时保留磁盘目录）"""
+        temp_dir = Path(__file__).parent / "temp"
+        if self.temp_tmpfs:
+            tmpfs_path = Path(self.temp_tmpfs_path)
+            if tmpfs_path.is_dir() and os.access(tmpfs_path, os.W_OK):
+                temp_dir = tmpfs_path / "MessageForwarder_temp"
+            else:
+                logger.warning(f"[MessageForwarder] tmpfs 目录不可用，继续使用磁盘临时目录: {tmpfs_path}")
+        if temp_dir != self.temp_dir:
+            self.temp_dir = temp_dir
+            self._ensure_temp_dir()
+            logger.info(f"[MessageForwarder] 临时目录: {self.temp_dir}")
+
     async def on_enable(self, bot=None):
         """插件启用时调用，重新加载配置"""
         self._load_config()
         await super().on_enable(bot)
+        if self.temp_janitor is None:
+            self._configure_temp_dir()
+            if self.temp_janitor_enabled:
+                self.temp_janitor = TempDirJanitor(
+                    self.temp_dir,
+                    max_age=self.temp_max_age_minutes * 60,
+                    interval=self.temp_sweep_interval,
+                    quota_bytes=int(self.temp_quota_mb * 1024 * 1024),
+                    quota_wait_timeout=self.temp_quota_wait
+                )
+                self.temp_janitor.start()
+        await self._open_http_session()
+        self.thumbnail_engine = self._build_thumbnail_engine()
+        self.media_cache = self._build_media_cache()
+        if self.media_budget.active == 0:
+            self.media_budget = MediaBudget(int(self.media_budget_mb * 1024 * 1024))
+        if self.media_pool_enabled and self.media_stage is None:
+            await self._start_media_stage()
+        if (self.image_max_kb or self.image_max_side) and PILImage is None:
+            logger.warning("[MessageForwarder] 未安装 Pillow，图片缩放与重新压缩不可用 (pip install Pillow)")
+        if self.xml_classifier.cache_size != self.xml_cache_size:
+            self.xml_classifier = XmlClassifier(self.xml_cache_size)
+        if self.dedup_enabled and self.dedup_index is None:
+            self.dedup_index = DedupIndex(self.dedup_capacity, self.dedup_ttl)
+        elif not self.dedup_enabled:
+            self.dedup_index = None
+        if self.text_coalesce_enabled and self.text_coalescer is None:
+            self.text_coalescer = TextCoalescer(
+                self._flush_coalesced_text,
+                window=self.text_coalesce_window,
+                max_chars=self.text_coalesce_max_chars,
+                max_count=self.text_coalesce_max_count,
+                prefix_sender=self.text_coalesce_prefix_sender,
+                # 启用来源标注时，单条文本也保留发送者前缀，与合并后的格式一致
+                raw_single=not self.attribution_enabled
+            )
+        if self.attribution_enabled and self.name_resolver is None:
+            self._start_name_resolver(bot)
+        if self.send_queue_enabled and self.dispatcher is None:
+            self.dispatcher = self._build_dispatcher()
+            self.dispatcher.start()
+        if self.sender_pool_enabled and self.sender_pool is None:
+            self.sender_pool = self._build_sender_pool(bot)
+            if self.sender_pool is not None and self.sender_pool_health_interval > 0:
+                self._sender_health_task = asyncio.create_task(self._sender_health_loop())
+        if self.send_concurrency_enabled and self.send_concurrency is None:
+            self.send_concurrency = self._build_send_concurrency()
+        elif not self.send_concurrency_enabled:
+            self.send_concurrency = None
+        if self.outbox_enabled and self.outbox is None:
+            await self._open_outbox(bot)
+        if self.recorder_enabled and self.recorder is None:
+            await self._start_recorder()
+        await self._start_metrics()
+        if self.hot_reload_enabled and self._config_watch_task is None:
+            self._config_watch_task = asyncio.create_task(self._config_watch_loop())
+
+    async def on_disable(self):
+        """插件停用时调用，排空并停止出站队列"""
+        if self._config_watch_task is not None:
+            self._config_watch_task.cancel()
+            await asyncio.gather(self._config_watch_task, return_exceptions=True)
+            self._config_watch_task = None
+        await self._stop_metrics()
+        if self.recorder is not None:
+            await self.recorder.stop()
+            logger.info(f"[MessageForwarder] 流量录制统计: {self.recorder.stats()}")
+            self.recorder = None
+        if self.text_coalescer is not None:
+            await self.text_coalescer.flush_all()
+            logger.info(f"[MessageForwarder] 文本合并统计: {self.text_coalescer.stats()}")
+            self.text_coalescer = None
+        if self._resolver_warm_task is not None:
+            self._resolver_warm_task.cancel()
+            await asyncio.gather(self._resolver_warm_task, return_exceptions=True)
+            self._resolver_warm_task = None
+        if self._outbox_task is not None:
+            self._outbox_task.cancel()
+            await asyncio.gather(self._outbox_task, return_exceptions=True)
+            self._outbox_task = None
+        if self.dispatcher is not None:
+            await self.dispatcher.stop(self.send_queue_drain_timeout)
+            self.dispatcher = None
+        if self._sender_health_task is not None:
+            self._sender_health_task.cancel()
+            await asyncio.gather(self._sender_health_task, return_exceptions=True)
+            self._sender_health_task = None
+        if self.sender_pool is not None:
+            logger.info(f"[MessageForwarder] 发送账号统计: {self.sender_pool.stats()}")
+            self.sender_pool = None
+        if self.outbox is not None:
+            logger.info(f"[MessageForwarder] 发件箱统计: {self.outbox.stats()}")
+            await self.outbox.close()
+            self.outbox = None
+            self._outbox_inflight.clear()
+        if self.name_resolver is not None:
+            await self.name_resolver.stop()
+            logger.info(f"[MessageForwarder] 名称缓存统计: {self.name_resolver.stats()}")
+            self.name_resolver = None
+        if self.media_stage is not None:
+            await self.media_stage.stop()
+            logger.info(f"[MessageForwarder] 媒体进程池统计: {self.media_stage.stats()}")
+            self.media_stage = None
+        if self.temp_janitor is not None:
+            await self.temp_janitor.stop()
+            logger.info(f"[MessageForwarder] 临时目录统计: {self.temp_janitor.stats()}")
+            self.temp_janitor = None
+        await self._close_http_session()
+        if self.thumbnail_engine is not None:
+            logger.info(f"[MessageForwarder] 缩略图引擎统计: {self.thumbnail_engine.stats()}")
+        if self.media_cache is not None:
+            logger.info(f"[MessageForwarder] 媒体缓存统计: {self.media_cache.stats()}")
+        logger.info(f"[MessageForwarder] 在途媒体字节统计: {self.media_budget.stats()}")
+        if self.forward_mode_counts:
+            logger.info(f"[MessageForwarder] 媒体转发方式统计: {self.forward_mode_counts}")
+        if self.dedup_index is not None:
+            logger.info(f"[MessageForwarder] 重复消息抑制统计: {self.dedup_index.stats()}")
+        logger.info(f"[MessageForwarder] XML解析缓存统计: {self.xml_classifier.stats()}")
+        await super().on_disable()
+
+    def _apply_compiled(self, compiled: CompiledConfig):
+        """原子替换编译后的配置（单次属性赋值），并同步到依赖它的组件"""
+        previous, self.compiled = self.compiled, compiled
+        if self.media_cache is not None:
+            self.media_cache.forward_ttl = compiled.media_forward_ttl
+        if len(compiled.routing_table):
+            logger.info(f"消息转发插件路由表编译完成，规则数: {len(compiled.routing_table)}")
+        return previous
+
+    async def _config_watch_loop(self):
+        """轮询 config.toml，文件变化后在线程池中解析并编译，校验通过才整体替换，否则保留原配置"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.hot_reload_interval)
+            stamp = self._config_file_stamp()
+            if stamp is None or stamp == self._config_stamp:
+                continue
+            self._config_stamp = stamp
+            try:
+                config = await loop.run_in_executor(None, self._read_config_file)
+                compiled = await loop.run_in_executor(None, CompiledConfig.compile, config, True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.metrics.inc("config_reloads", result="rejected")
+                logger.error(f"[MessageForwarder] 配置文件修改无效，继续使用原配置: {e}")
+                continue
+            previous = self._apply_compiled(compiled)
+            self._warm_reloaded_sources(previous)
+            hot_reload_config = config.get("hot_reload", {})
+            self.hot_reload_interval = float(hot_reload_config.get("poll_interval", self.hot_reload_interval))
+            self.metrics.inc("config_reloads", result="applied")
+            logger.success("[MessageForwarder] 配置已热更新")
+            cold = compiled.cold_changes(previous)
+            if cold:
+                logger.warning(f"[MessageForwarder] 以下配置段的修改需重新启用插件后生效: {cold}")
+
+    def _build_thumbnail_engine(self) -> ThumbnailEngine:
+        """按当前配置创建缩略图引擎"""
+        return ThumbnailEngine(
+            max_concurrency=self.thumbnail_max_concurrency,
+            timeout=self.thumbnail_timeout,
+            fast_seek=self.thumbnail_fast_seek,
+            seek_time=self.thumbnail_seek_time,
+            pipeline=self.thumbnail_pipeline,
+            metrics=self.metrics
+        )
+
+    async def _start_media_stage(self):
+        """创建并预热媒体进程池；失败时退回在事件循环/线程池中处理媒体"""
+        stage = MediaStage(
+            processes=self.media_pool_processes,
+            batch_size=self.media_pool_batch_size,
+            batch_window=self.media_pool_batch_window_ms / 1000,
+            start_method=self.media_pool_start_method,
+            metrics=self.metrics
+        )
+        try:
+            await stage.start()
+        except Exception as e:
+            logger.error(f"[MessageForwarder] 启动媒体进程池失败，媒体处理不使用进程池: {e}")
+            await stage.stop()
+            return
+        self.media_stage = stage
+        logger.info(f"[MessageForwarder] 媒体进程池已启动，进程数: {stage.processes}")
+
+    def _build_dispatcher(self) -> ForwardDispatcher:
+        """按当前配置创建出站调度器；优先级配置无效时退回单一类别"""
+        classes = None
+        if self.priority_enabled:
+            try:
+                classes = PriorityClass.from_config(self.priority_classes_config)
+            except (ValueError, TypeError, AttributeError) as e:
+                logger.error(f"[MessageForwarder] 优先级类别配置错误，不区分优先级: {e}")
+        workers = self.send_queue_workers
+        if self.send_concurrency_enabled:
+            # worker 只提供按来源保序的并行通道，实际在途发送数交给 AIMD 控制；
+            # worker 少于并发上限时在途数无法超过 worker 数，上限只能削减不能增长
+            workers = max(workers, self.send_concurrency_max)
+        return ForwardDispatcher(workers, self.send_queue_max_size, classes, self.metrics)
+
+    def _build_sender_pool(self, bot=None) -> Optional[SenderPool]:
+        """按 [[sender_pool.senders]] 创建发送账号池；配置无效时不启用"""
+        endpoints = []
+        if self.sender_pool_include_primary:
+            endpoints.append(SenderEndpoint("primary", bot))
+        try:
+            for index, sender_config in enumerate(self.sender_pool_senders):
+                name = sender_config.get("name") or f"sender{index + 1}"
+                if any(endpoint.name == name for endpoint in endpoints):
+                    raise ValueError(f"发送账号名称重复: {name}")
+                client = WechatAPIClient(sender_config["ip"], int(sender_config["port"]))
+                client.wxid = sender_config["wxid"]
+                endpoints.append(SenderEndpoint(name, client, sender_config.get("weight", 1)))
+        except (KeyError, ValueError, TypeError) as e:
+            logger.error(f"[MessageForwarder] 发送账号配置错误（需要 ip、port、wxid），不启用多账号发送: {e}")
+            return None
+        if not endpoints:
+            return None
+        logger.info(f"[MessageForwarder] 多账号发送已启用: {[endpoint.name for endpoint in endpoints]}")
+        return SenderPool(
+            endpoints,
+            failure_threshold=self.sender_pool_failure_threshold,
+            cooldown=self.sender_pool_cooldown,
+            failover_keywords=self.sender_pool_failover_keywords
+        )
+
+    def _build_send_concurrency(self) -> AdaptiveConcurrency:
+        return AdaptiveConcurrency(
+            max_keys=self.send_concurrency_max_keys,
+            initial=self.send_concurrency_initial,
+            min_limit=self.send_concurrency_min,
+            max_limit=self.send_concurrency_max,
+            increase=self.send_concurrency_increase,
+            decrease_ratio=self.send_concurrency_decrease_ratio,
+            latency_factor=self.send_concurrency_latency_factor,
+            max_latency=self.send_concurrency_max_latency
+        )
+
+    async def _sender_health_loop(self):
+        while True:
+            await asyncio.sleep(self.sender_pool_health_interval)
+            try:
+                await self.sender_pool.check_health(self.sender_pool_health_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[MessageForwarder] 发送账号健康检查异常: {e}")
+
+    def _register_metric_collectors(self):
+        """注册各组件的统计采集回调（导出时读取组件的当前实例）"""
+        metrics = self.metrics
+        metrics.remove_collectors()
+
+        def component_stats(name):
+            def collect():
+                component = getattr(self, name)
+                return component.stats() if component is not None else {}
+            return collect
+
+        for component, attr in (
+            ("send_queue", "dispatcher"),
+            ("thumbnail", "thumbnail_engine"),
+            ("media_cache", "media_cache"),
+            ("media_budget", "media_budget"),
+            ("dedup", "dedup_index"),
+            ("text_coalesce", "text_coalescer"),
+            ("outbox", "outbox"),
+            ("xml_classifier", "xml_classifier"),
+            ("senders", "sender_pool"),
+            ("recorder", "recorder"),
+            ("send_concurrency", "send_concurrency"),
+            ("media_stage", "media_stage"),
+            ("temp_dir", "temp_janitor"),
+            ("names", "name_resolver"),
+        ):
+            metrics.add_collector(component, component_stats(attr))
+        metrics.add_collector("routing", lambda: {"routes": len(self.compiled.routing_table)})
+
+    async def _start_metrics(self):
+        """按配置启动指标 HTTP 端点与快照文件任务"""
+        self.metrics.enabled = self.metrics_enabled
+        if not self.metrics_enabled:
+            return
+        self._register_metric_collectors()
+        if self.metrics_http_enabled and self._metrics_runner is None:
+            app = aiohttp.web.Application()
+            app.router.add_get("/metrics", self._handle_metrics_request)
+            app.router.add_get("/metrics.json", self._handle_metrics_json_request)
+            runner = aiohttp.web.AppRunner(app, access_log=None)
+            await runner.setup()
+            try:
+                await aiohttp.web.TCPSite(runner, self.metrics_http_host, self.metrics_http_port).start()
+            except OSError as e:
+                logger.error(f"[MessageForwarder] 指标端点启动失败: {e}")
+                await runner.cleanup()
+            else:
+                self._metrics_runner = runner
+                logger.info(f"[MessageForwarder] 指标端点已启动: http://{self.metrics_http_host}:{self.metrics_http_port}/metrics")
+        if self.metrics_snapshot_file and self._metrics_snapshot_task is None:
+            self._metrics_snapshot_task = asyncio.create_task(self._metrics_snapshot_loop())
+
+    async def _stop_metrics(self):
+        """停止指标端点与快照任务，停止前写入最后一次快照"""
+        if self._metrics_snapshot_task is not None:
+            self._metrics_snapshot_task.cancel()
+            await asyncio.gather(self._metrics_snapshot_task, return_exceptions=True)
+            self._metrics_snapshot_task = None
+            self._write_metrics_snapshot()
+        if self._metrics_runner is not None:
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
+
+    async def _handle_metrics_request(self, request):
+        return aiohttp.web.Response(text=self.metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    async def _handle_metrics_json_request(self, request):
+        return aiohttp.web.json_response(self.metrics.snapshot())
+
+    def _write_metrics_snapshot(self):
+        """原子地写入 JSON 快照文件（先写临时文件再替换）"""
+        path = Path(self.metrics_snapshot_file)
+        if not path.is_absolute():
+            path = Path(__file__).parent / path
+        try:
+            tmp_path = path.with_name(path.name + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.metrics.snapshot(), f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"[MessageForwarder] 写入指标快照失败: {e}")
+
+    async def _metrics_snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.metrics_snapshot_interval)
+            self._write_metrics_snapshot()
+
+    def _build_media_cache(self) -> Optional[MediaCache]:
+        """按当前配置创建媒体缓存，未启用时返回 None"""
+        if not self.media_cache_enabled:
+            return None
+        disk_dir = None
+        if self.media_cache_disk_enabled:
+            disk_dir = Path(self.media_cache_disk_dir)
+            if not disk_dir.is_absolute():
+                disk_dir = Path(__file__).parent / disk_dir
+        return MediaCache(
+            max_memory_bytes=int(self.media_cache_max_memory_mb * 1024 * 1024),
+            max_entries=self.media_cache_max_entries,
+            disk_dir=disk_dir,
+            max_disk_bytes=int(self.media_cache_max_disk_mb * 1024 * 1024),
+            forward_ttl=self.compiled.media_forward_ttl
+        )
+
+    async def _open_outbox(self, bot=None):
+        """打开发件箱，并启动后台重试/重放任务"""
+        db_path = Path(self.outbox_db_path)
+        if not db_path.is_absolute():
+            db_path = Path(__file__).parent / db_path
+        outbox = DurableOutbox(
+            db_path,
+            db_path.parent / f"{db_path.stem}_media",
+            max_attempts=self.outbox_max_attempts,
+            base_delay=self.outbox_base_delay,
+            max_delay=self.outbox_max_delay,
+            inline_limit=int(self.outbox_inline_limit_kb * 1024),
+            dead_letter_retention=self.outbox_dead_letter_retention_hours * 3600
+        )
+        try:
+            pending = await outbox.open()
+        except Exception as e:
+            logger.error(f"[MessageForwarder] 打开发件箱失败，发件箱不可用: {e}")
+            await outbox.close()
+            return
+        self.outbox = outbox
+        self._outbox_bot = bot
+        if pending:
+            logger.info(f"[MessageForwarder] 发件箱中有 {pending} 条未发送的转发，将分批重放")
+        self._outbox_task = asyncio.create_task(self._outbox_loop())
+
+    async def _start_recorder(self):
+        """启动流量录制（轨迹写入 recorder.dir，相对路径相对于插件目录）"""
+        directory = Path(self.recorder_dir)
+        if not directory.is_absolute():
+            directory = Path(__file__).parent / directory
+        recorder = TrafficRecorder(
+            directory,
+            flush_interval=self.recorder_flush_interval,
+            max_buffer=self.recorder_max_buffer,
+            inline_limit=int(self.recorder_inline_limit_kb * 1024),
+            max_trace_bytes=int(self.recorder_max_trace_mb * 1024 * 1024)
+        )
+        try:
+            await recorder.start()
+        except Exception as e:
+            logger.error(f"[MessageForwarder] 打开流量轨迹失败，不录制: {e}")
+            await recorder.stop()
+            return
+        self.recorder = recorder
+        logger.info(f"[MessageForwarder] 流量录制已启用: {directory / TrafficRecorder.TRACE_FILE}")
+
+    def _start_name_resolver(self, bot=None):
+        """创建名称解析缓存；启用时已有 bot 则立即在后台预热，否则在第一次标注时预热"""
+        self.name_resolver = NameResolver(
+            self._fetch_contact_names,
+            self._fetch_member_names,
+            ttl=self.name_cache_ttl,
+            negative_ttl=self.name_cache_negative_ttl,
+            max_entries=self.name_cache_max_entries,
+            batch_size=self.name_lookup_batch_size,
+            batch_window=self.name_lookup_batch_window_ms / 1000,
+            timeout=self.name_lookup_timeout
+        )
+        if bot is not None:
+            self._resolver_bot = bot
+            self._warm_name_resolver()
+
+    def _warm_name_resolver(self):
+        if self.attribution_warm and self._resolver_warm_task is None:
+            self._resolver_warm_task = asyncio.create_task(self._warm_names())
+
+    @staticmethod
+    def _listen_wxids(compiled: CompiledConfig) -> List[str]:
+        """监听列表与路由规则中出现的所有来源 wxid"""
+        wxids = list(compiled.listen_wxids)
+        for route in compiled.routing_table.routes:
+            wxids.extend(sorted(route.group_wxids))
+            wxids.extend(sorted(route.user_wxids))
+        return list(dict.fromkeys(wxids))
+
+    def _warm_reloaded_sources(self, previous: CompiledConfig):
+        """热更新新增了来源时，在已有预热任务之后预热这些来源（尚未预热过时由首次预热读取新配置）"""
+        if self.name_resolver is None or self._resolver_warm_task is None:
+            return
+        known = set(self._listen_wxids(previous))
+        added = [wxid for wxid in self._listen_wxids(self.compiled) if wxid not in known]
+        if added:
+            self._resolver_warm_task = asyncio.create_task(self._warm_names(added, self._resolver_warm_task))
+
+    async def _warm_names(self, wxids: Optional[List[str]] = None, previous: Optional[asyncio.Task] = None):
+        """预热名称缓存：监听的群聊与用户名称、群成员显示名；wxids 为空时预热当前配置中的所有来源"""
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        wxids = wxids or self._listen_wxids(self.compiled)
+        if not wxids or self.name_resolver is None:
+            return
+        started_at = time.perf_counter()
+        try:
+            entries = await self.name_resolver.warm(wxids)
+        except Exception as e:
+            logger.warning(f"[MessageForwarder] 名称缓存预热失败: {e}")
+            return
+        logger.info(f"[MessageForwarder] 名称缓存预热完成: {len(wxids)} 个来源，{entries} 条缓存，"
+                    f"耗时 {time.perf_counter() - started_at:.2f}s")
+
+    async def _fetch_contact_names(self, wxids: List[str]) -> Dict[str, str]:
+        """一次批量联系人查询取得多个联系人/群聊的名称"""
+        names = await self._resolver_bot.get_nickname(list(wxids))
+        if isinstance(names, str):
+            names = [names]
+        return {wxid: name for wxid, name in zip(wxids, names or []) if name}
+
+    async def _fetch_member_names(self, chatroom: str) -> Dict[str, str]:
+        """一次成员列表查询取得群内所有成员的显示名（未设置群昵称时使用昵称）"""
+        members = await self._resolver_bot.get_chatroom_member_list(chatroom)
+        return {
+            member["UserName"]: member.get("DisplayName") or member.get("NickName") or ""
+            for member in members or []
+            if isinstance(member, dict) and member.get("UserName")
+        }
 
-    def _is_message_allowed(self, message: dict) -> bool:
-        """检查消息是否符合监听条件"""
-        from_wxid = message.get("FromWxid")
-        sender_wxid = message.get("SenderWxid") # 实际发送消息的用户 wxid (如果是群聊)
-        room_wxid = message.get("FromWxid") if message.get("IsGroup") else None # 群聊 wxid (如果是群聊)
+    async def _outbox_loop(self):
+        """后台循环：分批取出到期的发件箱记录，交给出站队列重试；每小时清理一次过期死信"""
+        purged_at = time.monotonic()
+        while True:
+            try:
+                if time.monotonic() - purged_at >= 3600:
+                    purged_at = time.monotonic()
+                    purged = await self.outbox.purge_dead_letters()
+                    if purged:
+                        logger.info(f"[MessageForwarder] 已清理 {purged} 条过期死信")
+                items = []
+                if self._outbox_bot is not None:
+                    items = await self.outbox.due(self.outbox_replay_batch_size, self._outbox_inflight)
+                for item in items:
+                    self._outbox_inflight.add(item["id"])
+                    message = {"FromWxid": item["source"], "MsgType": item["msg_type"]}
+                    # 过载时被丢弃的重试仍保留在发件箱中，稍后重新取出
+                    await self._enqueue(
+                        message,
+                        functools.partial(self._retry_outbox_item, item),
+                        on_shed=functools.partial(self._outbox_inflight.discard, item["id"])
+                    )
+                if len(items) < self.outbox_replay_batch_size:
+                    await asyncio.sleep(self.outbox_poll_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[MessageForwarder] 发件箱重试循环异常: {e}")
+                await asyncio.sleep(self.outbox_poll_interval)
+
+    async def _retry_outbox_item(self, item: dict):
+        """重试一条发件箱记录"""
+        started_at = time.perf_counter()
+        try:
+            await self._call_action(self._outbox_bot, item["action"], item["target"], *item["args"], **item["kwargs"])
+        except Exception as e:
+            self.metrics.observe("retry", time.perf_counter() - started_at, action=item["action"], result="error")
+            logger.warning(f"[MessageForwarder] 发件箱重试失败 (第 {item['attempts'] + 1} 次): {e}")
+            await self._record_outbox_failure(item["id"], item["attempts"] + 1, e)
+        else:
+            self.metrics.observe("retry", time.perf_counter() - started_at, action=item["action"], result="ok")
+            logger.info(f"[MessageForwarder] 发件箱重试成功: {item['action']} from {item['source']} to {item['target']}")
+            await self.outbox.complete(item["id"])
+        finally:
+            self._outbox_inflight.discard(item["id"])
+
+    async def _record_outbox_failure(self, item_id: int, attempts: int, error: Exception):
+        try:
+            if await self.outbox.fail(item_id, attempts, str(error)):
+                logger.error(f"[MessageForwarder] 转发已重试 {attempts} 次仍失败，移入死信表: {item_id}")
+        except Exception as e:
+            logger.error(f"[MessageForwarder] 更新发件箱失败: {e}")
+
+    async def _open_http_session(self) -> aiohttp.ClientSession:
+        """创建插件级长连接 HTTP 会话（keep-alive 连接池），已存在则直接复用"""
+        if self._http_session is not None and not self._http_session.closed:
+            return self._http_session
+        connector = aiohttp.TCPConnector(
+            limit=self.http_limit,
+            limit_per_host=self.http_limit_per_host,
+            keepalive_timeout=self.http_keepalive_timeout,
+            ttl_dns_cache=300
+        )
+        timeout = aiohttp.ClientTimeout(total=self.http_total_timeout, connect=self.http_connect_timeout)
+        self._http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        logger.debug("[MessageForwarder] 共享HTTP会话已创建，连接上限: {}, 单主机上限: {}", self.http_limit, self.http_limit_per_host)
+        return self._http_session
+
+    async def _close_http_session(self):
+        """关闭共享 HTTP 会话并释放连接池"""
+        session, self._http_session = self._http_session, None
+        if session is not None and not session.closed:
+            await session.close()
+            logger.debug("[MessageForwarder] 共享HTTP会话已关闭")
+
+    async def _post_wechat_api(self, bot: WechatAPIClient, path: str, json_param: dict) -> dict:
+        """通过共享会话直接调用 WechatAPI 接口，返回解析后的 JSON"""
+        session = await self._open_http_session()
+        api_url = f'http://{bot.ip}:{bot.port}{path}'
+        logger.debug("[MessageForwarder] 调用WechatAPI: {}", api_url)
+        async with session.post(api_url, json=json_param) as response:
+            return await response.json(content_type=None)
+
+    def _dedup_key(self, message: dict, content_digest: bool = True) -> Optional[str]:
+        """去重键：优先使用消息 id，没有时按需使用内容摘要"""
+        msg_id = message.get("NewMsgId") or message.get("MsgId")
+        if msg_id:
+            return f"id:{msg_id}"
+        if not content_digest:
+            return None
+        content = message.get("Content")
+        if isinstance(content, dict):
+            content = content.get("string", "")
+        payload = message.get("Video") or message.get("Image") or content or ""
+        # 对完整的 UTF-8 字节计算摘要，只差中文等非 ASCII 字符的两条文本不会得到相同的键
+        return "digest:" + MediaCache.digest(
+            f"{message.get('FromWxid')}\x00{message.get('SenderWxid')}\x00{message.get('MsgType')}\x00{payload}".encode("utf-8")
+        )
+
+    def _is_duplicate(self, message: dict, compiled: CompiledConfig) -> bool:
+        """检查消息是否为重复投递（如重连后重发、多个处理器同时匹配）"""
+        if self.dedup_index is None:
+            return False
+        key = self._dedup_key(message, compiled.dedup_content_digest)
+        if key is None or not self.dedup_index.seen(key):
+            return False
+        logger.debug("[MessageForwarder] 重复消息，跳过转发: {}", key)
+        return True
+
+    def _message_texts(self, message: dict) -> List[str]:
+        """内容过滤使用的文本：文本消息为 Content，应用消息为 appmsg 的 title 与 des"""
+        content = message.get("Content")
+        if isinstance(content, dict):
+            content = content.get("string", "")
+        if not isinstance(content, str) or not content:
+            return []
+        if message.get("MsgType") == 1 or "<" not in content:
+            return [content]
+        info = self.xml_classifier.classify(content)
+        if info.kind == "invalid":
+            return [content]
+        return [text for text in (info.title, info.des) if text]
+
+    def _resolve_targets(self, message: dict) -> Tuple[str, ...]:
+        """按路由表查找消息的转发目标；未匹配任何规则或为重复消息时返回空元组"""
+        started_at = time.perf_counter()
+        # 每条消息只读取一次配置快照，热更新不会让同一条消息看到新旧混合的配置
+        compiled = self.compiled
         message_type = message.get("MsgType") # 消息类型
+        if self._is_duplicate(message, compiled):
+            self.metrics.inc("messages", msg_type=message_type, result="duplicate")
+            return ()
+        from_wxid = message.get("FromWxid") or ""
+        sender_wxid = message.get("SenderWxid") or "" # 实际发送消息的用户 wxid (如果是群聊)
 
-        logger.debug(f"检查消息: from_wxid={from_wxid}, sender_wxid={sender_wxid}, room_wxid={room_wxid}, msg_type={message_type}")
-        logger.debug(f"监听配置: listen_type={self.listen_type}, listen_user_wxids={self.listen_user_wxids}, listen_group_wxids={self.listen_group_wxids}")
+        targets = compiled.routing_table.resolve(from_wxid, sender_wxid, message_type)
+        content_filter = compiled.content_filter
+        if targets and content_filter is not None and content_filter.applies_to(message_type):
+            reason = content_filter.check(self._message_texts(message))
+            if reason is not None:
+                self.metrics.observe("filter", time.perf_counter() - started_at, msg_type=message_type)
+                self.metrics.inc("messages", msg_type=message_type, result="content_filtered")
+                logger.debug("[MessageForwarder] 内容过滤，跳过转发: {} ({})", from_wxid, reason)
+                return ()
+        self.metrics.observe("filter", time.perf_counter() - started_at, msg_type=message_type)
+        self.metrics.inc("messages", msg_type=message_type, result="routed" if targets else "filtered")
+        logger.debug("检查消息: from_wxid={}, sender_wxid={}, msg_type={}, 转发目标={}", from_wxid, sender_wxid, message_type, targets)
+        if not targets:
+            logger.debug("消息来自未监听的源，跳过转发: {}", from_wxid)
+        return targets
 
-        if self.listen_type == "all":
-            logger.debug("监听类型为 'all'，允许转发。")
-            return True
-        elif self.listen_type == "user":
-            # 如果是私聊，from_wxid 是发送者 wxid
-            # 如果是群聊，sender_wxid 是实际发送者 wxid
-            is_allowed = from_wxid in self.listen_user_wxids or sender_wxid in self.listen_user_wxids
-            logger.debug(f"监听类型为 'user'，from_wxid是否在列表: {from_wxid in self.listen_user_wxids}, sender_wxid是否在列表: {sender_wxid in self.listen_user_wxids}，结果: {is_allowed}")
-            return is_allowed
-        elif self.listen_type == "group":
-            # 如果是群聊，room_wxid 是群聊 wxid
-            is_allowed = room_wxid in self.listen_group_wxids
-            logger.debug(f"监听类型为 'group'，room_wxid是否在列表: {room_wxid in self.listen_group_wxids}，结果: {is_allowed}")
-            return is_allowed
-        logger.debug("未知监听类型，拒绝转发。")
-        return False
+    async def _submit_job(self, message: dict, job_func, *args, **kwargs):
+        """将转发任务放入出站队列，按来源会话保证顺序"""
+        await self._enqueue(message, functools.partial(job_func, *args, **kwargs))
 
-    async def _forward_message(self, bot: WechatAPIClient, message: dict, forward_func, *args, **kwargs):
-        """通用消息转发方法"""
-        if not self._is_message_allowed(message):
-            logger.debug(f"消息来自未监听的源，跳过转发: {message.get('from_wxid')}")
+    async def _submit_attributed_job(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...], job_func, *args, **kwargs):
+        """与 _submit_job 相同，启用 media_header 时先发送来源标注文本"""
+        await self._enqueue(message, self._attributed_job(bot, message, targets, functools.partial(job_func, *args, **kwargs)))
+
+    def _attributed_job(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...], job):
+        """启用 media_header 时包装非文本转发任务：任务内第一次真正向某个目标发送前，先向该目标发送来源标注文本
+
+        重复抑制等原因跳过的目标不发送任何内容，因此也不会收到孤立的标注。
+        """
+        if self.name_resolver is None or not self.attribution_media_header:
+            return job
+        return functools.partial(self._run_with_attribution_header, bot, message, targets, job)
+
+    async def _run_with_attribution_header(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...], job):
+        header = (await self._attribution_prefix(bot, message)).rstrip()
+        if not header:
+            await job()
+            return
+        token = _pending_attribution.set({"header": header, "sent": set()})
+        try:
+            await job()
+        finally:
+            _pending_attribution.reset(token)
+
+    async def _send_pending_header(self, message: dict, target_wxid: str, bot: WechatAPIClient):
+        """当前任务带有来源标注且尚未发往该目标时，先发送标注文本"""
+        pending = _pending_attribution.get()
+        if pending is None or target_wxid in pending["sent"]:
             return
+        pending["sent"].add(target_wxid)
+        await self._send_forward(message, target_wxid, bot, "send_text_message", pending["header"])
+
+    async def _attribution_prefix(self, bot: WechatAPIClient, message: dict, template: Optional[str] = None) -> str:
+        """按来源生成标注前缀：{group} 为群名，{sender} 为发送者的群内显示名或昵称，查不到时使用 wxid
 
-        if not self.target_wxid:
-            logger.warning("未配置转发目标WXID，无法转发消息。")
+        名称通常命中缓存；未命中时与同时到达的其他查询合并为批量查询。
+        """
+        resolver = self.name_resolver
+        if resolver is None:
+            return ""
+        if self._resolver_bot is None and bot is not None:
+            self._resolver_bot = bot
+            self._warm_name_resolver()
+        from_wxid = message.get("FromWxid") or ""
+        sender_wxid = message.get("SenderWxid") or from_wxid
+        is_group = from_wxid.endswith("@chatroom")
+        if template is None:
+            template = self.attribution_group_prefix if is_group else self.attribution_private_prefix
+        # 只查询模板中用到的名称
+        group = sender = ""
+        if is_group and "{group}" in template:
+            group = await resolver.contact(from_wxid) or from_wxid
+        if "{sender}" in template:
+            if is_group:
+                sender = await resolver.member(from_wxid, sender_wxid)
+            else:
+                sender = await resolver.contact(sender_wxid)
+            sender = sender or sender_wxid
+        return template.replace("{group}", group).replace("{sender}", sender)
+
+    async def _send_attributed_text(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...], content: str,
+                                    template: Optional[str] = None):
+        """出站 worker 中执行：加上来源标注前缀后发送文本"""
+        prefix = await self._attribution_prefix(bot, message, template)
+        await self._fan_out(message, targets, self._send_forward, bot, "send_text_message", prefix + content)
+
+    async def _enqueue(self, message: dict, job, degrade=None, on_shed=None) -> bool:
+        """按消息类型所属的优先级类别放入出站队列，返回是否被接收（过载时可能被丢弃或降级）"""
+        if self.dispatcher is None:
+            await job()
+            return True
+        return await self.dispatcher.submit(message.get("FromWxid") or "", job, message.get("MsgType"), degrade, on_shed)
+
+    async def _fan_out(self, message: dict, targets: Tuple[str, ...], send_func, *args, **kwargs) -> List[bool]:
+        """把同一消息并发发送到多个目标，返回每个目标的发送结果"""
+        if len(targets) == 1:
+            return [await send_func(message, targets[0], *args, **kwargs)]
+        results = await asyncio.gather(
+            *(send_func(message, target, *args, **kwargs) for target in targets),
+            return_exceptions=True
+        )
+        return [result is True for result in results]
+
+    async def _forward_message(self, bot: WechatAPIClient, message: dict, action: str, *args, **kwargs):
+        """通用消息转发方法：按路由查找目标后放入出站队列，由 worker 实际发送
+
+        action 为发送动作名，即 WechatAPIClient 的发送方法名（如 "send_text_message"），
+        或插件自身实现的 "share_card"；以名字而非函数引用描述发送，发件箱才能持久化与重放。
+        """
+        targets = self._resolve_targets(message)
+        if not targets:
             return
+        await self._submit_job(message, self._fan_out, message, targets, self._send_forward, bot, action, *args, **kwargs)
+
+    async def _send_media_forward(self, message: dict, target_wxid: str, digest: Optional[str], bot: WechatAPIClient, action: str, *args, **kwargs) -> bool:
+        """发送媒体消息；开启重复抑制时跳过有效期内已发往同一目标的相同媒体
+
+        digest 为媒体内容摘要，由调用方每条消息只计算一次后传给所有目标。
+        """
+        cache = self.media_cache
+        if digest and cache.was_forwarded(digest, target_wxid):
+            logger.info(f"相同媒体已在 {self.compiled.duplicate_window_minutes} 分钟内转发到 {target_wxid}，跳过")
+            return True
+        ok = await self._send_forward(message, target_wxid, bot, action, *args, **kwargs)
+        if ok and digest:
+            cache.mark_forwarded(digest, target_wxid)
+        return ok
+
+    async def _call_action(self, bot: WechatAPIClient, action: str, target_wxid: str, *args, **kwargs):
+        """执行发送动作；启用多账号时按目标选择发送账号，账号被限流或掉线时切换到其他账号重试"""
+        pool = self.sender_pool
+        if pool is None:
+            return await self._invoke_action(bot, action, target_wxid, *args, **kwargs)
+        primary = pool.get("primary")
+        if primary is not None and bot is not None and primary.client is not bot:
+            primary.client = bot
+        tried = []
+        while True:
+            endpoint = pool.pick(target_wxid, tried)
+            if endpoint is None:
+                if tried:
+                    raise Exception(f"所有发送账号均不可用: {tried[-1].last_error}")
+                return await self._invoke_action(bot, action, target_wxid, *args, **kwargs)
+            try:
+                result = await self._invoke_action(endpoint.client, action, target_wxid, *args, sender=endpoint.name, **kwargs)
+            except Exception as e:
+                if not pool.record_failure(endpoint, e):
+                    raise
+                tried.append(endpoint)
+                self.metrics.inc("sender_failovers", sender=endpoint.name)
+                logger.warning(f"[MessageForwarder] 发送账号 {endpoint.name} 不可用，切换账号重试: {e}")
+                continue
+            pool.record_success(endpoint)
+            return result
+
+    async def _invoke_action(self, bot: WechatAPIClient, action: str, target_wxid: str, *args, sender: str = "primary", **kwargs):
+        """调用一次 API；启用自适应并发时先取得 (动作, 发送账号) 的并发名额，并按延迟与结果调整上限"""
+        limiter = self.send_concurrency.get(action, sender) if self.send_concurrency is not None else None
+        if limiter is None:
+            return await self._call_api(bot, action, target_wxid, *args, **kwargs)
+        await limiter.acquire()
+        started_at = time.perf_counter()
+        try:
+            result = await self._call_api(bot, action, target_wxid, *args, **kwargs)
+        except asyncio.CancelledError:
+            limiter.release(None, False)
+            raise
+        except Exception:
+            limiter.release(time.perf_counter() - started_at, False)
+            raise
+        limiter.release(time.perf_counter() - started_at, True)
+        return result
+
+    async def _call_api(self, bot: WechatAPIClient, action: str, target_wxid: str, *args, **kwargs):
+        if action == "share_card":
+            return await self._send_share_card_direct(bot, target_wxid, *args, **kwargs)
+        return await getattr(bot, action)(target_wxid, *args, **kwargs)
 
+    async def _send_once(self, message: dict, target_wxid: str, bot: WechatAPIClient, action: str, *args, **kwargs) -> bool:
+        """执行一次发送（失败不进入发件箱），返回是否成功"""
+        await self._send_pending_header(message, target_wxid, bot)
+        started_at = time.perf_counter()
         try:
-            await forward_func(self.target_wxid, *args, **kwargs)
+            await self._call_action(bot, action, target_wxid, *args, **kwargs)
+            self.metrics.observe("send", time.perf_counter() - started_at, action=action, result="ok")
             # 确保msg_type在日志中安全显示，避免NoneType错误
             msg_type_display = message.get('MsgType', '未知类型')
             from_wxid_display = message.get('FromWxid', '未知来源')
-            logger.info(f"成功转发消息: {msg_type_display} from {from_wxid_display} to {self.target_wxid}")
+            logger.info(f"成功转发消息: {msg_type_display} from {from_wxid_display} to {target_wxid}")
+            return True
+        except Exception as e:
+            self.metrics.observe("send", time.perf_counter() - started_at, action=action, result="error")
+            logger.error(f"转发消息失败: {e}")
+            return False
+
+    async def _send_forward(self, message: dict, target_wxid: str, bot: WechatAPIClient, action: str, *args, **kwargs) -> bool:
+        """发送消息，返回是否成功
+
+        启用发件箱时，发送前先持久化记录；发送失败的记录由后台按退避策略重试，
+        超过最大次数后移入死信表。
+        """
+        await self._send_pending_header(message, target_wxid, bot)
+        outbox = self.outbox
+        if outbox is None:
+            return await self._send_once(message, target_wxid, bot, action, *args, **kwargs)
+
+        self._outbox_bot = bot
+        try:
+            item_id = await outbox.add(action, target_wxid, message.get("FromWxid") or "", message.get("MsgType"), args, kwargs)
         except Exception as e:
+            logger.error(f"[MessageForwarder] 写入发件箱失败，直接发送: {e}")
+            return await self._send_once(message, target_wxid, bot, action, *args, **kwargs)
+
+        started_at = time.perf_counter()
+        try:
+            await self._call_action(bot, action, target_wxid, *args, **kwargs)
+        except Exception as e:
+            self.metrics.observe("send", time.perf_counter() - started_at, action=action, result="error")
             logger.error(f"转发消息失败: {e}")
+            await self._record_outbox_failure(item_id, 1, e)
+            return False
+        self.metrics.observe("send", time.perf_counter() - started_at, action=action, result="ok")
+        msg_type_display = message.get('MsgType', '未知类型')
+        from_wxid_display = message.get('FromWxid', '未知来源')
+        logger.info(f"成功转发消息: {msg_type_display} from {from_wxid_display} to {target_wxid}")
+        await outbox.complete(item_id)
+        return True
 
-    async def _save_base64_to_file(self, base64_data: str, file_extension: str = ".mp4") -> Optional[Path]:
-        """将Base64数据保存为临时文件"""
+    async def _save_bytes_to_file(self, data: bytes, file_extension: str = ".mp4") -> Optional[Path]:
+        """将数据保存为临时文件（文件名使用 uuid，避免同一秒内的多个视频互相覆盖）"""
+        temp_filepath = self.temp_dir / f"temp_{uuid.uuid4().hex}{file_extension}"
+        if self.temp_janitor is not None:
+            self.temp_janitor.track(temp_filepath, len(data))
         try:
-            decoded_data = base64.b64decode(base64_data)
-            temp_filepath = self.temp_dir / f"temp_{int(time.time())}{file_extension}"
             with open(temp_filepath, "wb") as f:
-                f.write(decoded_data)
-            logger.debug(f"Base64数据成功保存到临时文件: {temp_filepath}")
+                f.write(data)
+            logger.debug("数据成功保存到临时文件: {}", temp_filepath)
             return temp_filepath
         except Exception as e:
-            logger.error(f"保存Base64数据到文件失败: {e}")
+            logger.error(f"保存数据到临时文件失败: {e}")
+            if self.temp_janitor is not None:
+                self.temp_janitor.untrack(temp_filepath)
             return None
 
-    async def _extract_first_frame_from_video(self, video_path: Path) -> Optional[str]:
-        """从本地视频文件提取第一帧并返回base64字符串"""
-        thumbnail_path = None
+    def _get_thumbnail_engine(self) -> ThumbnailEngine:
+        if self.thumbnail_engine is None:
+            self.thumbnail_engine = self._build_thumbnail_engine()
+        return self.thumbnail_engine
+
+    async def _extract_first_frame_from_video(self, video_path: Path) -> Optional[bytes]:
+        """从本地视频文件提取第一帧，返回JPEG字节"""
         try:
-            thumbnail_path = self.temp_dir / f"temp_thumbnail_{int(time.time())}.jpg"
-            
-            # 使用 subprocess.run，参考 VideoDemand 的实现
-            import subprocess
-            ffmpeg_cmd = [
-                'ffmpeg',
-                '-i', str(video_path),
-                '-ss', '00:00:01',
-                '-vframes', '1',
-                str(thumbnail_path),
-                '-y'
-            ]
-            
-            logger.debug(f"执行ffmpeg命令: {' '.join(ffmpeg_cmd)}")
-            result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True)
-            
-            if result.returncode != 0:
-                logger.error(f"ffmpeg 提取封面失败 (返回码: {result.returncode}): {result.stderr}")
-                logger.debug(f"ffmpeg stdout: {result.stdout}")
-                return None
-            else:
-                logger.debug(f"ffmpeg 提取封面成功")
-
-            # 读取生成的缩略图并转换为base64
-            if thumbnail_path.exists() and thumbnail_path.stat().st_size > 0:
-                with open(thumbnail_path, "rb") as image_file:
-                    image_data = image_file.read()
-                    image_base64 = base64.b64encode(image_data).decode("utf-8")
-                    logger.info(f"成功生成视频缩略图，大小: {len(image_data)} 字节")
-                    return image_base64
-            else:
-                logger.error(f"缩略图文件不存在或为空: {thumbnail_path}")
+            # 通过异步缩略图引擎运行 ffmpeg，不阻塞事件循环；JPEG 从 stdout 读取，不生成缩略图文件
+            image_data = await self._get_thumbnail_engine().extract_frame(video_path)
+            if not image_data:
+                logger.error(f"ffmpeg 未输出缩略图数据: {video_path}")
                 return None
-
+            return image_data
         except Exception as e:
             logger.error(f"提取视频首帧失败: {video_path} - {e}")
             return None
+
+    def _media_reservation(self, media_base64: str, decode: bool = False) -> int:
+        """估算媒体任务在途占用的字节数：base64 载荷本身，加上解码后留在内存中的部分"""
+        size = len(media_base64)
+        if decode:
+            decoded = len(media_base64) * 3 // 4
+            size += min(decoded, self.media_spool_threshold) if self.media_low_memory else decoded
+        return size
+
+    async def _thumbnail_from_base64(self, video_base64_data: str) -> Optional[bytes]:
+        """解码 base64 视频并生成缩略图；解码失败时抛出 ValueError
+
+        低内存模式下分块解码到 SpooledTemporaryFile（在线程池中执行），超过阈值的视频直接落盘，
+        ffmpeg 通过 /dev/fd 读取，内存中不保留完整的解码结果。
+        """
+        if self.media_stage is not None:
+            return await self._thumbnail_in_media_stage(video_base64_data)
+        started_at = time.perf_counter()
+        if not self.media_low_memory:
+            # 解码结果保留在内存中，不写临时文件
+            video_data = base64.b64decode(video_base64_data)
+            self.metrics.observe("decode", time.perf_counter() - started_at, media="video")
+            try:
+                return await self._generate_video_thumbnail(video_data)
+            finally:
+                del video_data
+
+        loop = asyncio.get_running_loop()
+        spool = await loop.run_in_executor(
+            None, spool_base64, video_base64_data, self.media_spool_threshold, str(self.temp_dir)
+        )
+        self.metrics.observe("decode", time.perf_counter() - started_at, media="video_spooled")
+        try:
+            if spool._rolled:
+                logger.debug("[MessageForwarder] 视频已分块解码到临时文件，直接交给 ffmpeg 读取")
+                image_data = await self._get_thumbnail_engine().extract_frame_from_file(spool)
+                if image_data:
+                    logger.info(f"成功生成视频缩略图 (spool)，大小: {len(image_data)} 字节")
+                return image_data
+            return await self._generate_video_thumbnail(spool.read())
         finally:
-            # 清理临时缩略图文件
-            if thumbnail_path and thumbnail_path.exists():
-                try:
-                    thumbnail_path.unlink()
-                    logger.debug(f"清理临时缩略图文件: {thumbnail_path}")
-                except Exception as cleanup_error:
-                    logger.error(f"清理临时缩略图文件失败: {cleanup_error}")
+            spool.close()
+
+    async def _thumbnail_in_media_stage(self, video_base64_data: str) -> Optional[bytes]:
+        """在媒体进程池中解码视频并运行 ffmpeg（解码失败时抛出 ValueError）"""
+        engine = self._get_thumbnail_engine()
+        commands = [engine._build_command("{input}", engine.seek_time)]
+        if engine.seek_time:
+            # 视频短于定位时间时输出为空，退回取第一帧
+            commands.append(engine._build_command("{input}", None))
+        try:
+            image_data = await self.media_stage.run(
+                "video_thumbnail", video_base64_data, commands, engine.timeout, engine.pipeline,
+                self.media_spool_threshold if self.media_low_memory else 0, str(self.temp_dir)
+            )
+        except RuntimeError as e:
+            logger.error(f"媒体进程池生成视频缩略图失败: {e}")
+            return None
+        if image_data:
+            logger.info(f"成功生成视频缩略图 (media_pool)，大小: {len(image_data)} 字节")
+        return image_data
+
+    async def _fit_image(self, image_base64: str) -> str:
+        """按 [media_pool] 的图片字节预算缩放/重新压缩图片（在进程池或线程池中执行），失败时使用原图"""
+        max_bytes = int(self.image_max_kb * 1024)
+        if PILImage is None or not (max_bytes or self.image_max_side):
+            return image_base64
+        if not self.image_max_side and len(image_base64) * 3 // 4 <= max_bytes:
+            return image_base64
+        started_at = time.perf_counter()
+        args = (image_base64, max_bytes, self.image_max_side, self.image_quality)
+        try:
+            if self.media_stage is not None:
+                fitted = await self.media_stage.run("fit_image", *args)
+            else:
+                fitted = await asyncio.get_running_loop().run_in_executor(None, _media_fit_image, *args)
+        except Exception as e:
+            logger.warning(f"[MessageForwarder] 图片重新压缩失败，使用原图: {e}")
+            return image_base64
+        self.metrics.observe("image_fit", time.perf_counter() - started_at, result="resized" if fitted else "kept")
+        if not fitted:
+            return image_base64
+        logger.debug("[MessageForwarder] 图片已重新压缩: {} -> {} 字节", len(image_base64) * 3 // 4, len(fitted) * 3 // 4)
+        return fitted
+
+    async def _generate_video_thumbnail(self, video_data: bytes) -> Optional[bytes]:
+        """为视频生成JPEG缩略图
+
+        优先通过 memfd/管道直接把视频送入 ffmpeg，全程不产生命名临时文件；
+        内存模式失败（如 pipe 模式下 moov 位于文件尾部）时才写入临时文件重试。
+        """
+        engine = self._get_thumbnail_engine()
+        if engine.pipeline != "file":
+            try:
+                image_data = await engine.extract_frame_from_bytes(video_data)
+                if image_data:
+                    logger.info(f"成功生成视频缩略图 ({engine.pipeline})，大小: {len(image_data)} 字节")
+                    return image_data
+            except Exception as e:
+                logger.warning(f"内存管道提取视频首帧失败: {e}")
+            logger.debug("内存管道未能生成缩略图，回退到临时文件方式")
+
+        temp_video_path = await self._save_bytes_to_file(video_data, file_extension=".mp4")
+        if not temp_video_path:
+            return None
+        try:
+            image_data = await self._extract_first_frame_from_video(temp_video_path)
+            if image_data:
+                logger.info(f"成功生成视频缩略图 (file)，大小: {len(image_data)} 字节")
+            return image_data
+        finally:
+            # 清理临时视频文件
+            if self.temp_janitor is not None:
+                self.temp_janitor.untrack(temp_video_path)
+            try:
+                temp_video_path.unlink()
+                logger.debug("清理临时视频文件: {}", temp_video_path)
+            except Exception as cleanup_error:
+                logger.error(f"清理临时视频文件失败: {cleanup_error}")
 
 
     @on_text_message(priority=10)
     async def handle_text_message(self, bot: WechatAPIClient, message: dict):
         """处理文本消息并转发"""
+        if self.recorder is not None:
+            self.recorder.record("text", message)
         content = message.get("Content")
-        if content:
-            await self._forward_message(bot, message, bot.send_text_message, content)
+        if not content:
+            return
+        if self.text_coalescer is not None:
+            targets = self._resolve_targets(message)
+            source = message.get("FromWxid") or ""
+            sender = message.get("SenderWxid") or source
+            if self.name_resolver is not None and targets:
+                # 合并模式在处理器中只读缓存（启用时已预热），未命中时先用 wxid，并在后台查询
+                sender = self.name_resolver.cached(sender, source if source.endswith("@chatroom") else "") or sender
+            for target in targets:
+                self.text_coalescer.add(source, target, sender, content, bot)
+            return
+        if self.name_resolver is not None:
+            targets = self._resolve_targets(message)
+            if targets:
+                await self._submit_job(message, self._send_attributed_text, bot, message, targets, content)
+            return
+        await self._forward_message(bot, message, "send_text_message", content)
+
+    async def _flush_coalesced_text(self, source: str, target: str, text: str, count: int, bot: WechatAPIClient):
+        """把合并后的文本放入出站队列（与该来源的其他消息共用同一 worker）"""
+        message = {"FromWxid": source, "MsgType": 1}
+        logger.debug("[MessageForwarder] 合并 {} 条文本: {} -> {}", count, source, target)
+        if self.name_resolver is not None and source.endswith("@chatroom"):
+            # 各行已带发送者显示名，群聊来源再加一行群名标题
+            await self._submit_job(message, self._send_attributed_text, bot, message, (target,), text,
+                                   self.attribution_coalesce_header)
+            return
+        await self._submit_job(message, self._send_forward, message, target, bot, "send_text_message", text)
 
     @on_image_message(priority=10)
     async def handle_image_message(self, bot: WechatAPIClient, message: dict):
-        """处理图片消息并转发 (使用Base64)"""
+        """处理图片消息并转发（优先 CDN 直接转发，必要时使用Base64）"""
+        if self.recorder is not None:
+            self.recorder.record("image", message)
         # 根据实际消息结构，图片base64数据可能在 'Content' 或 'Image'字段
         # 优先使用 'Image'字段，如果不存在则尝试 'Content'
         base64_data = message.get("Image") or message.get("Content")
+        if not isinstance(base64_data, str) or "<msg" in base64_data:
+            # Content 中是 XML 而不是图片数据
+            base64_data = None
 
-        if base64_data:
-            try:
-                # 使用 send_image_message 发送Base64图片内容
-                await self._forward_message(bot, message, bot.send_image_message, base64_data)
-                logger.success("图片消息转发成功 (使用Base64)")
-            except Exception as e:
-                logger.error(f"处理图片消息失败: {e}")
-        else:
+        if not base64_data and not (self.cdn_forward_image and self._message_xml(message)):
             logger.warning("图片消息缺少Base64内容，无法转发。")
+            return
+        targets = self._resolve_targets(message)
+        if not targets:
+            return
+        try:
+            await self._submit_attributed_job(bot, message, targets, self._process_image_message, bot, message, targets, base64_data)
+            logger.debug("图片消息已加入转发队列")
+        except Exception as e:
+            logger.error(f"处理图片消息失败: {e}")
+
+    async def _process_image_message(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...], base64_data: Optional[str]):
+        """出站 worker 中执行的图片转发：先尝试 CDN 直接转发，失败的目标再用 base64 上传"""
+        if self.cdn_forward_image:
+            targets = await self._try_cdn_forward(bot, message, targets, "cdn_image")
+            if not targets:
+                return
+        if not base64_data:
+            logger.warning(f"图片消息缺少Base64内容，无法转发到: {targets}")
+            return
+        # 使用 send_image_message 发送Base64图片内容（在媒体字节预算内，超出图片字节预算时先重新压缩）
+        self._record_forward_mode("image", "base64", len(targets))
+        async with self.media_budget.reserve(self._media_reservation(base64_data)):
+            base64_data = await self._fit_image(base64_data)
+            digest = self.media_cache.digest(base64_data) if self.media_cache is not None else None
+            await self._fan_out(message, targets, self._send_media_forward, digest, bot, "send_image_message", base64_data)
 
 
     @on_video_message(priority=10)
     async def handle_video_message(self, bot: WechatAPIClient, message: dict):
         """处理视频消息并转发"""
+        if self.recorder is not None:
+            self.recorder.record("video", message)
+        targets = self._resolve_targets(message)
+        if not targets:
+            return
+        # 视频的解码、缩略图与发送都在出站 worker 中完成，处理器立即返回
+        await self._enqueue(
+            message,
+            self._attributed_job(bot, message, targets, functools.partial(self._process_video_message, bot, message, targets)),
+            degrade=functools.partial(self._degraded_video_job, bot, message, targets)
+        )
+
+    def _degraded_video_job(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...], mode: str):
+        """视频类别过载时的降级任务：只走 CDN 转发（cdn_only）、只发送文字提示（link_only），
+        或能走 CDN 时走 CDN、否则发提示（cdn_or_link）。返回 None 表示无法降级"""
+        # 降级任务只保留必要字段，不再引用 base64 视频数据
+        slim = {key: message.get(key) for key in ("FromWxid", "SenderWxid", "MsgType", "MsgId")}
+        if mode in ("cdn_only", "cdn_or_link", ""):
+            xml_content = message.get("Xml") or message.get("Content")
+            if isinstance(xml_content, str) and "<msg" in xml_content:
+                info = self.xml_classifier.classify(xml_content)
+                if info.kind == "cdn_video":
+                    return functools.partial(self._fan_out, slim, targets, self._send_once, bot, "send_cdn_video_msg", xml=info.xml)
+            if mode == "cdn_only":
+                return None
+        if mode in ("link_only", "cdn_or_link", ""):
+            try:
+                notice = self.degrade_notice_template.format(
+                    source=slim["FromWxid"] or "", sender=slim["SenderWxid"] or slim["FromWxid"] or ""
+                )
+            except (KeyError, IndexError, ValueError) as e:
+                logger.error(f"[MessageForwarder] 降级提示模板错误: {e}")
+                return None
+            slim["MsgType"] = 1
+            return functools.partial(self._fan_out, slim, targets, self._send_forward, bot, "send_text_message", notice)
+        return None
+
+    async def _process_video_message(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...]):
+        """出站 worker 中执行的视频转发流程"""
         # 首先尝试使用 CDN 转发方法（如果消息包含 XML 内容）
-        if await self._try_cdn_video_forward(bot, message):
+        targets = await self._try_cdn_video_forward(bot, message, targets)
+        if not targets:
             return
         
-        # 如果 CDN 转发失败，使用传统的 base64 转发方法
-        await self._handle_video_with_base64(bot, message)
+        # CDN 转发失败的目标，使用传统的 base64 转发方法
+        await self._handle_video_with_base64(bot, message, targets)
+
+    async def _try_cdn_video_forward(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...]) -> Tuple[str, ...]:
+        """尝试使用 CDN 方式转发视频消息，返回仍需用备用方法转发的目标"""
+        if not self.cdn_forward_video:
+            return targets
+        return await self._try_cdn_forward(bot, message, targets, "cdn_video")
 
-    async def _try_cdn_video_forward(self, bot: WechatAPIClient, message: dict) -> bool:
-        """尝试使用 CDN 方式转发视频消息"""
+    @staticmethod
+    def _message_xml(message: dict) -> Optional[str]:
+        """取消息中携带的 XML（Xml 或 Content 字段）；先做廉价的子串判断，避免对 base64 内容做摘要或解析"""
+        for key in ("Xml", "Content"):
+            value = message.get(key)
+            if isinstance(value, dict):
+                value = value.get("string")
+            if value and isinstance(value, str) and "<msg" in value:
+                return value
+        return None
+
+    async def _try_cdn_forward(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...], kind: str,
+                               xml_content: Optional[str] = None) -> Tuple[str, ...]:
+        """消息 XML 带有 CDN 引用时，直接把 XML 交给 send_cdn_*_msg 转发（不重新下载上传媒体），
+        返回仍需用备用方法（base64 / 应用消息）转发的目标"""
+        label = self.CDN_LABELS[kind]
         try:
-            # 检查消息是否包含 XML 内容（CDN 视频消息的特征）
-            xml_content = message.get("Xml") or message.get("Content")
-            if xml_content and "<msg>" in xml_content and "cdnvideourl" in xml_content.lower():
-                logger.info("检测到 CDN 视频消息，尝试直接转发")
-                await self._forward_message(
-                    bot,
-                    message,
-                    bot.send_cdn_video_msg,
-                    xml=xml_content
-                )
-                logger.success("CDN 视频消息转发成功")
-                return True
+            xml_content = xml_content or self._message_xml(message)
+            if not xml_content:
+                return targets
+            info = self.xml_classifier.classify(xml_content)
+            if info.kind != kind:
+                return targets
+            logger.info(f"检测到 CDN {label}消息，尝试直接转发")
+            # CDN 转发失败的目标会改用备用方式，因此这里不写入发件箱
+            results = await self._fan_out(message, targets, self._send_once, bot, self.CDN_ACTIONS[kind], xml=info.xml)
+            remaining = tuple(target for target, ok in zip(targets, results) if not ok)
+            if len(remaining) < len(targets):
+                self._record_forward_mode(self.CDN_MEDIA[kind], "cdn", len(targets) - len(remaining))
+                logger.success(f"CDN {label}消息转发成功")
+            if remaining:
+                logger.warning(f"CDN {label}转发失败，将使用备用方法: {remaining}")
+            return remaining
         except Exception as e:
-            logger.warning(f"CDN 视频转发失败，将使用备用方法: {e}")
-        
-        return False
+            logger.warning(f"CDN {label}转发失败，将使用备用方法: {e}")
+        return targets
 
-    async def _handle_video_with_base64(self, bot: WechatAPIClient, message: dict):
+    def _record_forward_mode(self, media: str, mode: str, count: int = 1):
+        """记录媒体实际使用的转发方式（cdn / base64 / app / notice）"""
+        key = f"{media}:{mode}"
+        self.forward_mode_counts[key] = self.forward_mode_counts.get(key, 0) + count
+        self.metrics.inc("forward_mode", count, media=media, mode=mode)
+
+    async def _handle_video_with_base64(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...]):
         """使用 base64 方式处理视频消息转发"""
         # 根据实际消息结构，视频base64数据可能在 'Content' 或 'Video' 字段
         video_base64_data = message.get("Video") or message.get("Content")
@@ -256,74 +4343,90 @@ class MessageForwarder(PluginBase):
             logger.warning("视频消息缺少Base64内容，无法转发。")
             return
 
-        temp_video_path = None
-        
+        # 临时目录超出磁盘配额时等待清理，超时则放弃本次 base64 转发
+        if self.temp_janitor is not None and not await self.temp_janitor.wait_for_space():
+            logger.error(f"[MessageForwarder] 临时目录持续超出配额，放弃转发视频到: {targets}")
+            self.metrics.inc("media_skipped", media="video", reason="temp_quota")
+            return
+
+        # 在途媒体字节预算：超出时等待其他媒体任务完成后再解码/发送
+        async with self.media_budget.reserve(self._media_reservation(video_base64_data, decode=True)):
+            await self._forward_base64_video(bot, message, targets, video_base64_data)
+
+    async def _forward_base64_video(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...], video_base64_data: str):
         try:
             logger.info(f"开始处理视频消息，Base64数据长度: {len(video_base64_data)}")
 
-            # 1. 将Base64视频数据保存到临时文件
-            temp_video_path = await self._save_base64_to_file(video_base64_data, file_extension=".mp4")
-            if not temp_video_path or not temp_video_path.exists():
-                logger.error("保存视频Base64数据到临时文件失败")
-                return
-            
-            logger.info(f"视频文件已保存到: {temp_video_path}")
+            cache = self.media_cache
+            digest = cache.digest(video_base64_data) if cache is not None else None
+            if digest:
+                skipped = tuple(target for target in targets if cache.was_forwarded(digest, target))
+                if skipped:
+                    logger.info(f"相同视频已在 {self.compiled.duplicate_window_minutes} 分钟内转发到 {skipped}，跳过")
+                    targets = tuple(target for target in targets if target not in skipped)
+                if not targets:
+                    return
 
-            # 2. 生成视频缩略图
-            thumb_data = await self._extract_first_frame_from_video(temp_video_path)
-            
-            # 3. 转发视频消息，参考 VideoDemand 的实现
-            if thumb_data:
-                # 有缩略图，发送带缩略图的视频消息
-                await self._forward_message(
-                    bot,
-                    message,
-                    bot.send_video_message,
-                    video=video_base64_data,  # 使用原始视频数据
-                    image=thumb_data  # 传递base64缩略图数据
-                )
-                logger.success("视频消息转发成功 (带缩略图)")
+            # 1. 按内容摘要查找缓存的缩略图，命中则跳过解码与 ffmpeg
+            thumb_image = cache.get_thumbnail(digest) if digest else None
+            self.metrics.inc("thumbnail_lookups", result="miss" if thumb_image is None else "hit")
+            if thumb_image is None:
+                # 2. 解码Base64视频数据并生成缩略图
+                try:
+                    thumb_image = await self._thumbnail_from_base64(video_base64_data)
+                except (ValueError, TypeError) as e:
+                    logger.error(f"解码视频Base64数据失败: {e}")
+                    return
+                if thumb_image and digest:
+                    cache.put_thumbnail(digest, thumb_image)
             else:
-                # 没有缩略图，使用默认方式发送
-                await self._forward_message(
-                    bot,
-                    message,
-                    bot.send_video_message,
-                    video=video_base64_data,
-                    image="None"  # 使用字符串"None"与VideoDemand保持一致
-                )
-                logger.success("视频消息转发成功 (无缩略图)")
+                logger.debug("视频缩略图缓存命中: {}", digest)
+            # 没有缩略图时使用字符串"None"与VideoDemand保持一致
+            thumb_data = base64.b64encode(thumb_image).decode("utf-8") if thumb_image else "None"
+            
+            # 3. 转发视频消息（缩略图只生成一次，并发发送到所有目标），参考 VideoDemand 的实现
+            results = await self._fan_out(
+                message,
+                targets,
+                self._send_forward,
+                bot,
+                "send_video_message",
+                video=video_base64_data,  # 使用原始视频数据
+                image=thumb_data  # 传递base64缩略图数据
+            )
+            self._record_forward_mode("video", "base64", len(targets))
+            for target, ok in zip(targets, results):
+                if ok and digest:
+                    cache.mark_forwarded(digest, target)
+            if any(results):
+                logger.success(f"视频消息转发成功 ({'带缩略图' if thumb_image else '无缩略图'})")
 
         except Exception as e:
             logger.error(f"处理视频消息失败: {e}")
-        finally:
-            # 清理临时视频文件
-            if temp_video_path and temp_video_path.exists():
-                try:
-                    temp_video_path.unlink()
-                    logger.debug(f"清理临时视频文件: {temp_video_path}")
-                except Exception as cleanup_error:
-                    logger.error(f"清理临时视频文件失败: {cleanup_error}")
 
     @on_xml_message(priority=10)
     async def handle_xml_message(self, bot: WechatAPIClient, message: dict):
         """处理XML消息，包括应用消息(类型49)"""
+        if self.recorder is not None:
+            self.recorder.record("xml", message)
         msg_type = message.get("MsgType")
         xml_content = message.get("Content", "")
         
         logger.info(f"[MessageForwarder] 检测到XML消息: MsgType={msg_type}")
-        logger.debug(f"[MessageForwarder] XML内容: {xml_content[:200]}...")
+        logger.debug("[MessageForwarder] XML内容: {}...", xml_content[:200])
         
         # 检查是否包含应用消息内容
         if self._contains_appmsg(xml_content):
             logger.info(f"[MessageForwarder] 检测到应用消息内容，准备转发")
             await self._forward_app_message(bot, message, xml_content)
         else:
-            logger.debug(f"[MessageForwarder] XML消息不包含应用消息内容，跳过转发")
+            logger.debug("[MessageForwarder] XML消息不包含应用消息内容，跳过转发")
 
     @on_other_message(priority=10)
     async def handle_other_message(self, bot: WechatAPIClient, message: dict):
         """处理其他类型消息，包括名片消息"""
+        if self.recorder is not None:
+            self.recorder.record("other", message)
         msg_type = message.get("MsgType")
         
         # 检查是否为名片消息 (MsgType=42)
@@ -339,9 +4442,33 @@ class MessageForwarder(PluginBase):
             if self._contains_appmsg(xml_content):
                 await self._forward_app_message(bot, message, xml_content)
             else:
-                logger.debug(f"[MessageForwarder] 类型49消息不包含应用消息内容，跳过转发")
+                logger.debug("[MessageForwarder] 类型49消息不包含应用消息内容，跳过转发")
+        # 检查是否为表情消息 (MsgType=47)
+        elif msg_type == 47:
+            await self._forward_emoji_message(bot, message)
         else:
-            logger.debug(f"[MessageForwarder] 收到其他类型消息: MsgType={msg_type}")
+            logger.debug("[MessageForwarder] 收到其他类型消息: MsgType={}", msg_type)
+
+    async def _forward_emoji_message(self, bot: WechatAPIClient, message: dict):
+        """按表情的 md5 和长度转发（表情已在微信 CDN 上，不需要重新上传）"""
+        if not self.cdn_forward_emoji:
+            return
+        xml_content = self._message_xml(message)
+        info = self.xml_classifier.classify(xml_content) if xml_content else None
+        if info is None or info.kind != "emoji" or not info.media.get("md5"):
+            logger.debug("[MessageForwarder] 表情消息缺少 md5，跳过转发")
+            return
+        try:
+            total_length = int(info.media.get("len") or 0)
+        except ValueError:
+            total_length = 0
+        targets = self._resolve_targets(message)
+        if not targets:
+            return
+        logger.info(f"[MessageForwarder] 检测到表情消息，按 md5 转发: {info.media['md5']}")
+        self._record_forward_mode("emoji", "cdn", len(targets))
+        await self._submit_attributed_job(bot, message, targets, self._fan_out, message, targets, self._send_forward, bot,
+                                          "send_emoji_message", info.media["md5"], total_length)
 
     async def handle_card_message(self, bot: WechatAPIClient, message: dict):
         """处理名片消息并转发"""
@@ -356,7 +4483,7 @@ class MessageForwarder(PluginBase):
             logger.warning("[MessageForwarder] 名片消息缺少XML内容，无法转发。")
             return
 
-        logger.debug(f"[MessageForwarder] 名片XML内容: {xml_string[:200]}...")
+        logger.debug("[MessageForwarder] 名片XML内容: {}...", xml_string[:200])
 
         try:
             # 解析XML内容提取名片信息
@@ -380,52 +4507,41 @@ class MessageForwarder(PluginBase):
 
     async def _forward_card_message_direct(self, bot: WechatAPIClient, message: dict, card_wxid: str, card_nickname: str, card_alias: str = ""):
         """直接转发名片消息的专用方法"""
-        if not self._is_message_allowed(message):
-            logger.debug(f"消息来自未监听的源，跳过转发: {message.get('FromWxid')}")
-            return
-
-        if not self.target_wxid:
-            logger.warning("未配置转发目标WXID，无法转发消息。")
+        targets = self._resolve_targets(message)
+        if not targets:
             return
-
-        try:
-            await self._send_share_card_direct(bot, self.target_wxid, card_wxid, card_nickname, card_alias)
-            logger.info(f"成功转发名片消息: {card_nickname} ({card_wxid}) from {message.get('FromWxid')} to {self.target_wxid}")
-        except Exception as e:
-            logger.error(f"转发名片消息失败: {e}")
+        logger.debug("[MessageForwarder] 名片消息加入转发队列: {} ({})", card_nickname, card_wxid)
+        await self._submit_attributed_job(
+            bot, message, targets, self._fan_out, message, targets, self._send_forward, bot, "share_card", card_wxid, card_nickname, card_alias
+        )
 
     async def _send_share_card_direct(self, bot: WechatAPIClient, wxid: str, card_wxid: str, card_nickname: str, card_alias: str = ""):
         """直接调用ShareCard API发送名片消息"""
         if not bot.wxid:
             raise Exception("Bot未登录")
 
-        async with aiohttp.ClientSession() as session:
-            json_param = {
-                "Wxid": bot.wxid,
-                "ToWxid": wxid,
-                "CardWxId": card_wxid,
-                "CardNickName": card_nickname,
-                "CardAlias": card_alias
-            }
-            
-            api_url = f'http://{bot.ip}:{bot.port}/api/Msg/ShareCard'
-            logger.debug(f"[MessageForwarder] 调用ShareCard API: {api_url}")
-            logger.debug(f"[MessageForwarder] 请求参数: {json_param}")
-            
-            response = await session.post(api_url, json=json_param)
-            json_resp = await response.json()
+        json_param = {
+            "Wxid": bot.wxid,
+            "ToWxid": wxid,
+            "CardWxId": card_wxid,
+            "CardNickName": card_nickname,
+            "CardAlias": card_alias
+        }
+        logger.debug("[MessageForwarder] 请求参数: {}", json_param)
 
-            if json_resp.get("Success"):
-                logger.info(f"[MessageForwarder] ShareCard API调用成功: 对方wxid:{wxid} 名片wxid:{card_wxid} 名片昵称:{card_nickname}")
-                return json_resp
-            else:
-                error_msg = json_resp.get("Message", "未知错误")
-                logger.error(f"[MessageForwarder] ShareCard API调用失败: {error_msg}")
-                raise Exception(f"ShareCard API调用失败: {error_msg}")
+        json_resp = await self._post_wechat_api(bot, "/api/Msg/ShareCard", json_param)
+
+        if json_resp.get("Success"):
+            logger.info(f"[MessageForwarder] ShareCard API调用成功: 对方wxid:{wxid} 名片wxid:{card_wxid} 名片昵称:{card_nickname}")
+            return json_resp
+        else:
+            error_msg = json_resp.get("Message", "未知错误")
+            logger.error(f"[MessageForwarder] ShareCard API调用失败: {error_msg}")
+            raise Exception(f"ShareCard API调用失败: {error_msg}")
 
     def _preprocess_card_message(self, message: dict):
         """预处理名片消息，设置正确的FromWxid和SenderWxid字段"""
-        logger.debug(f"[MessageForwarder] 名片消息预处理开始，原始消息字段: {list(message.keys())}")
+        logger.opt(lazy=True).debug("[MessageForwarder] 名片消息预处理开始，原始消息字段: {}", lambda: list(message.keys()))
         
         # 处理FromWxid字段
         if "FromWxid" not in message:
@@ -465,131 +4581,77 @@ class MessageForwarder(PluginBase):
                 xml_string = str(xml_content)
             
             # 尝试从XML前缀中提取发送者wxid（格式：发送者id:\n<xml...>）
-            if ":\n" in xml_string:
-                lines = xml_string.split(":\n", 1)
-                if len(lines) > 1:
-                    sender_wxid = lines[0].strip()
-                    message["SenderWxid"] = sender_wxid
-                    logger.debug(f"[MessageForwarder] 群聊名片消息，发送者: {sender_wxid}")
-                else:
-                    message["SenderWxid"] = from_wxid
+            sender_wxid, _ = XmlClassifier.split_prefix(xml_string)
+            if sender_wxid:
+                message["SenderWxid"] = sender_wxid
+                logger.debug("[MessageForwarder] 群聊名片消息，发送者: {}", sender_wxid)
             else:
                 message["SenderWxid"] = from_wxid
         else:
             message["IsGroup"] = False
             message["SenderWxid"] = from_wxid
 
-        logger.debug(f"[MessageForwarder] 名片消息预处理完成: FromWxid={message['FromWxid']}, ToWxid={message['ToWxid']}, SenderWxid={message['SenderWxid']}, IsGroup={message.get('IsGroup', False)}")
+        logger.debug("[MessageForwarder] 名片消息预处理完成: FromWxid={}, ToWxid={}, SenderWxid={}, IsGroup={}", message['FromWxid'], message['ToWxid'], message['SenderWxid'], message.get('IsGroup', False))
 
     def _contains_appmsg(self, xml_content: str) -> bool:
         """检查XML内容是否包含应用消息"""
-        if not xml_content:
+        if not xml_content or not isinstance(xml_content, str):
             return False
-        
-        # 检查是否包含<appmsg>标签
-        return "<appmsg" in xml_content.lower()
+        info = self.xml_classifier.classify(xml_content)
+        if info.kind == "invalid":
+            # 无法解析时仍按标签判断，由转发流程回退为原始XML转发
+            return "<appmsg" in xml_content
+        return info.appmsg is not None
     
     def _extract_appmsg_content(self, xml_content: str) -> Optional[str]:
-        """从XML内容中提取<appmsg>部分"""
-        try:
-            logger.debug(f"[MessageForwarder] 开始提取appmsg内容: {xml_content[:200]}...")
-            
-            # 移除可能的前缀（如：发送者id:\n<xml...>）
-            clean_xml = xml_content
-            if ":\n" in xml_content:
-                clean_xml = xml_content.split(":\n", 1)[1].strip()
-                logger.debug(f"[MessageForwarder] 移除前缀后的XML: {clean_xml[:200]}...")
-            
-            # 解析XML
-            root = ET.fromstring(clean_xml)
-            
-            # 查找appmsg元素
-            appmsg_element = root.find(".//appmsg")
-            if appmsg_element is not None:
-                # 将appmsg元素转换为字符串
-                appmsg_content = ET.tostring(appmsg_element, encoding='unicode')
-                logger.debug(f"[MessageForwarder] 成功提取appmsg内容: {appmsg_content[:200]}...")
-                return appmsg_content
-            else:
-                logger.warning(f"[MessageForwarder] 未找到appmsg元素")
-                return None
-                
-        except ET.ParseError as e:
-            logger.error(f"[MessageForwarder] XML解析失败: {e}")
-            logger.debug(f"[MessageForwarder] 失败的XML内容: {xml_content}")
+        """从XML内容中提取<appmsg>部分（解析结果来自分类器缓存）"""
+        info = self.xml_classifier.classify(xml_content)
+        if info.kind == "invalid":
+            logger.error(f"[MessageForwarder] XML解析失败: {info.error}")
+            logger.debug("[MessageForwarder] 失败的XML内容: {}", xml_content)
             return None
-        except Exception as e:
-            logger.error(f"[MessageForwarder] 提取appmsg内容时发生未知错误: {e}")
-            logger.debug(f"[MessageForwarder] 失败的XML内容: {xml_content}")
+        if info.appmsg is None:
+            logger.warning(f"[MessageForwarder] 未找到appmsg元素")
             return None
+        logger.debug("[MessageForwarder] 成功提取appmsg内容: {}...", info.appmsg[:200])
+        return info.appmsg
     
     async def _forward_app_message(self, bot: WechatAPIClient, message: dict, xml_content: str):
         """转发应用消息"""
-        if not self._is_message_allowed(message):
-            logger.debug(f"消息来自未监听的源，跳过转发: {message.get('FromWxid')}")
-            return
-
-        if not self.target_wxid:
-            logger.warning("未配置转发目标WXID，无法转发消息。")
+        targets = self._resolve_targets(message)
+        if not targets:
             return
+        await self._submit_attributed_job(bot, message, targets, self._send_app_job, bot, message, targets, xml_content)
 
-        try:
-            # 提取appmsg内容
-            appmsg_content = self._extract_appmsg_content(xml_content)
-            if not appmsg_content:
-                logger.warning("[MessageForwarder] 无法提取appmsg内容，使用原始XML转发")
-                appmsg_content = xml_content
-            
-            # 使用send_app_message转发，类型49
-            await bot.send_app_message(self.target_wxid, appmsg_content, 49)
-            
-            msg_type_display = message.get('MsgType', '未知类型')
-            from_wxid_display = message.get('FromWxid', '未知来源')
-            logger.info(f"成功转发应用消息: {msg_type_display} from {from_wxid_display} to {self.target_wxid}")
-            
-        except Exception as e:
-            logger.error(f"转发应用消息失败: {e}")
+    async def _send_app_job(self, bot: WechatAPIClient, message: dict, targets: Tuple[str, ...], xml_content: str):
+        """出站 worker 中执行的应用消息发送：appmsg 只提取一次，再并发发往所有目标"""
+        # 文件消息优先通过 CDN 引用直接转发，失败的目标再作为应用消息发送
+        if self.cdn_forward_file:
+            targets = await self._try_cdn_forward(bot, message, targets, "file", xml_content)
+            if not targets:
+                return
+        # 提取appmsg内容
+        appmsg_content = self._extract_appmsg_content(xml_content)
+        if not appmsg_content:
+            logger.warning("[MessageForwarder] 无法提取appmsg内容，使用原始XML转发")
+            appmsg_content = xml_content
+        # 使用send_app_message转发，类型49
+        self._record_forward_mode("app", "app", len(targets))
+        await self._fan_out(message, targets, self._send_forward, bot, "send_app_message", appmsg_content, 49)
 
     def _parse_card_xml(self, xml_string: str) -> Optional[dict]:
         """解析名片XML内容，提取关键信息"""
-        try:
-            logger.debug(f"[MessageForwarder] 开始解析名片XML: {xml_string[:100]}...")
-            
-            # 移除XML前缀（如果存在，格式：发送者id:\n<xml...>）
-            if ":\n" in xml_string:
-                xml_string = xml_string.split(":\n", 1)[1].strip()
-                logger.debug(f"[MessageForwarder] 移除前缀后的XML: {xml_string[:100]}...")
-            
-            # 处理可能的前缀格式（如：sxkiss_com:\n<xml...>）
-            if xml_string.startswith(xml_string.split(":", 1)[0] + ":") and ":" in xml_string:
-                parts = xml_string.split(":", 1)
-                if len(parts) > 1 and parts[1].strip().startswith("<?xml") or parts[1].strip().startswith("<msg"):
-                    xml_string = parts[1].strip()
-                    logger.debug(f"[MessageForwarder] 移除前缀后的XML: {xml_string[:100]}...")
-
-            # 解析XML
-            root = ET.fromstring(xml_string)
-            
-            # 提取名片信息
-            card_info = {
-                "wxid": root.get("username", ""),
-                "nickname": root.get("nickname", ""),
-                "alias": root.get("alias", "")
-            }
-
-            # 验证必需字段
-            if not card_info["wxid"] or not card_info["nickname"]:
-                logger.warning(f"[MessageForwarder] 名片信息不完整: wxid={card_info['wxid']}, nickname={card_info['nickname']}")
-                return None
-
-            logger.debug(f"[MessageForwarder] 解析名片信息成功: {card_info}")
-            return card_info
-
-        except ET.ParseError as e:
-            logger.error(f"[MessageForwarder] XML解析失败: {e}")
-            logger.debug(f"[MessageForwarder] 失败的XML内容: {xml_string}")
+        info = self.xml_classifier.classify(xml_string)
+        if info.kind == "invalid":
+            logger.error(f"[MessageForwarder] XML解析失败: {info.error}")
+            logger.debug("[MessageForwarder] 失败的XML内容: {}", xml_string)
             return None
-        except Exception as e:
-            logger.error(f"[MessageForwarder] 解析名片XML时发生未知错误: {e}")
-            logger.debug(f"[MessageForwarder] 失败的XML内容: {xml_string}")
+
+        card_info = info.card or {"wxid": "", "nickname": "", "alias": ""}
+        # 验证必需字段
+        if not card_info["wxid"] or not card_info["nickname"]:
+            logger.warning(f"[MessageForwarder] 名片信息不完整: wxid={card_info['wxid']}, nickname={card_info['nickname']}")
             return None
+
+        logger.debug("[MessageForwarder] 解析名片信息成功: {}", card_info)
+        return dict(card_info)
@@ -0,0 +1,16 @@
+"""插件测试公共配置
+
+main.py 依赖 XYBot 运行环境（utils.plugin_base、utils.decorators、WechatAPI），
+在机器人目录外运行、缺少这些模块时跳过测试。
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope="session")
+def forwarder():
+    return pytest.importorskip("main")
@@ -0,0 +1,38 @@
+import asyncio
+
+
+def test_degraded_jobs_respect_lowest_class_capacity(forwarder):
+    async def main():
+        classes = [
+            forwarder.PriorityClass("text", frozenset({1}), 10, "block"),
+            forwarder.PriorityClass("video", frozenset({43}), 1, "degrade", "link_only"),
+            forwarder.PriorityClass("other", None, 2, "drop_newest"),
+        ]
+        metrics = forwarder.Metrics()
+        dispatcher = forwarder.ForwardDispatcher(1, 10, classes, metrics)
+        dispatcher.start()
+        release = asyncio.Event()
+
+        async def blocker():
+            await release.wait()
+
+        async def noop():
+            pass
+
+        assert await dispatcher.submit("g1@chatroom", blocker, 1)
+        await asyncio.sleep(0.01)
+        accepted = [
+            await dispatcher.submit("g1@chatroom", noop, 43, degrade=lambda mode: noop)
+            for _ in range(4)
+        ]
+        video, other = classes[1], classes[2]
+        snapshot = (accepted, video.pending, other.pending, video.degraded, video.shed)
+        release.set()
+        await dispatcher.stop()
+        return snapshot, metrics.snapshot()["counters"]
+
+    (accepted, video_pending, other_pending, degraded, shed), counters = asyncio.run(main())
+    assert accepted == [True, True, True, False]
+    assert (video_pending, other_pending) == (1, 2)
+    assert (degraded, shed) == (2, 1)
+    assert counters["shed{priority=video,policy=degrade}"] == 1
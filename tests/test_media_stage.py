@@ -0,0 +1,26 @@
+import asyncio
+import multiprocessing
+import os
+
+import pytest
+
+
+def _crash():
+    os._exit(1)
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="需要 fork 启动方式")
+def test_broken_pool_resolves_concurrent_batches(forwarder, monkeypatch):
+    monkeypatch.setitem(forwarder.MEDIA_JOBS, "crash", _crash)
+
+    async def main():
+        stage = forwarder.MediaStage(processes=2, batch_size=1, batch_window=0.01, start_method="fork")
+        await stage.start()
+        results = await asyncio.wait_for(
+            asyncio.gather(*(stage.run("crash") for _ in range(4)), return_exceptions=True), timeout=30
+        )
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert stage.restarts == 1
+        await stage.stop()
+
+    asyncio.run(main())
@@ -0,0 +1,11 @@
+def test_render_with_mixed_label_value_types(forwarder):
+    metrics = forwarder.Metrics()
+    metrics.inc("messages", msg_type=1, result="routed")
+    metrics.inc("messages", msg_type=None, result="filtered")
+    metrics.observe("filter", 0.002, msg_type=1)
+    metrics.observe("filter", 0.003, msg_type=None)
+    text = metrics.render_prometheus()
+    assert 'message_forwarder_messages_total{msg_type="None",result="filtered"} 1' in text
+    assert 'message_forwarder_messages_total{msg_type="1",result="routed"} 1' in text
+    assert 'message_forwarder_filter_seconds_count{msg_type="None"} 1' in text
+    assert metrics.snapshot()["counters"]["messages{msg_type=None,result=filtered}"] == 1
@@ -0,0 +1,18 @@
+import asyncio
+
+
+def test_spilled_non_ascii_payload_round_trips(forwarder, tmp_path):
+    content = "<msg><appmsg><title>转发测试</title></appmsg></msg>" * 40
+
+    async def main():
+        outbox = forwarder.DurableOutbox(tmp_path / "outbox.db", tmp_path / "media", inline_limit=256, lease_seconds=0)
+        await outbox.open()
+        item_id = await outbox.add("send_app_message", "wxid_target", "g1@chatroom", 49, (content, 49), {})
+        items = await outbox.due(10)
+        await outbox.close()
+        return item_id, items
+
+    item_id, items = asyncio.run(main())
+    assert [item["id"] for item in items] == [item_id]
+    assert items[0]["args"] == [content, 49]
+    assert not list((tmp_path / "media").glob("*.tmp"))
@@ -0,0 +1,60 @@
+import asyncio
+
+
+def _run_sends(forwarder, limiter, workers, sources, per_source, latency, ok=True):
+    peak = 0
+
+    async def send():
+        nonlocal peak
+        await limiter.acquire()
+        peak = max(peak, limiter.in_flight)
+        start = asyncio.get_running_loop().time()
+        await asyncio.sleep(latency)
+        limiter.release(asyncio.get_running_loop().time() - start, ok)
+
+    async def main():
+        dispatcher = forwarder.ForwardDispatcher(workers, 10000)
+        dispatcher.start()
+        for i in range(per_source):
+            for source in range(sources):
+                assert await dispatcher.submit(f"wxid_{source}", send)
+        await dispatcher.stop(drain_timeout=30)
+
+    asyncio.run(main())
+    return peak
+
+
+def test_limit_grows_under_healthy_latency(forwarder):
+    limiter = forwarder.AimdLimiter(initial=4, max_limit=32)
+    peak = _run_sends(forwarder, limiter, workers=32, sources=64, per_source=20, latency=0.005)
+    assert limiter.limit > 8
+    assert peak > 8
+
+
+def test_limit_shrinks_on_errors(forwarder):
+    limiter = forwarder.AimdLimiter(initial=8, max_limit=32)
+    _run_sends(forwarder, limiter, workers=32, sources=16, per_source=2, latency=0.001, ok=False)
+    assert limiter.limit < 8
+
+
+def test_limiters_are_keyed_by_action_and_sender(forwarder):
+    concurrency = forwarder.AdaptiveConcurrency(max_keys=16)
+    limiter = concurrency.get("send_text_message", "primary")
+    assert concurrency.get("send_text_message", "primary") is limiter
+    assert concurrency.get("send_text_message", "backup") is not limiter
+    assert "send_text_message:primary" in concurrency.stats()["limit"]
+
+
+def test_new_limiter_survives_eviction_when_full(forwarder):
+    concurrency = forwarder.AdaptiveConcurrency(max_keys=2)
+
+    async def main():
+        busy = [concurrency.get("send_text_message", sender) for sender in ("a", "b")]
+        for limiter in busy:
+            await limiter.acquire()
+        limiter = concurrency.get("send_text_message", "c")
+        return limiter, concurrency.get("send_text_message", "c")
+
+    created, again = asyncio.run(main())
+    assert again is created
+    assert concurrency.evicted == 0
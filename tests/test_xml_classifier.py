@@ -0,0 +1,26 @@
+def _appmsg(title: str, des: str) -> str:
+    return (
+        '<msg><appmsg appid="" sdkver="0">'
+        f"<title>{title}</title><des>{des}</des><type>5</type><url>http://example.com/a</url>"
+        "</appmsg></msg>"
+    )
+
+
+def test_cache_distinguishes_non_ascii_only_differences(forwarder):
+    classifier = forwarder.XmlClassifier()
+    first = classifier.classify(_appmsg("第一篇文章", "摘要一"))
+    second = classifier.classify(_appmsg("第二篇文章", "摘要二"))
+    assert first.title == "第一篇文章"
+    assert second.title == "第二篇文章"
+    assert second.des == "摘要二"
+    assert classifier.hits == 0
+
+
+def test_cache_hits_identical_body_with_different_sender(forwarder):
+    classifier = forwarder.XmlClassifier()
+    body = _appmsg("同一篇文章", "描述")
+    classifier.classify("wxid_a:\n" + body)
+    info = classifier.classify("wxid_b:\n" + body)
+    assert classifier.hits == 1
+    assert info.sender == "wxid_b"
+    assert info.title == "同一篇文章"